@@ -20,13 +20,19 @@ import fcntl
 import ocf
 import os
 import platform
-import rtslib
-import rtslib.utils
 import subprocess
 import time
 
 from ocf.util import cached_property
-from rtslib import RTSLibError
+from ocf_rtslib import (
+    blockdev, configfs, fileio, kernel, lookup, stats, timing, util)
+
+# RTSLib is slow to import and many actions never need it
+rtslib = util.LazyModule('rtslib')
+rtslib_utils = util.LazyModule('rtslib.utils')
+
+#: Prefix for the files in rsctmp shared by all the backstore agents.
+STATE_PREFIX = 'backstore'
 
 #: List of kernel modules to load to bring up the target. This includes the
 #: target core module as well as any relevant backstore modules.
@@ -35,27 +41,76 @@ TARGET_CORE_MODULES = [
     'target_core_file',
     'target_core_iblock',
     'target_core_pscsi',
+    'target_core_rd',
 ]
 
 
+class LockTimeout(Exception):
+    pass
+
+
 class LockFile(object):
-    def __init__(self, path):
+    """
+    An exclusive lock on a file, optionally waiting at most `timeout`
+    seconds for it.
+
+    The time spent waiting for the lock and then holding it are recorded in
+    `wait_time` and `hold_time` respectively; `held_time` gives the time it
+    has been held so far while it still is.
+    """
+
+    def __init__(self, path, timeout=None):
         self.path = path
+        self.timeout = timeout
         self.fd = None
+        self.wait_time = None
+        self.hold_time = None
+        self._acquired = None
+
+    def _try_lock(self):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+        else:
+            return True
 
     def write(self):
         self.fd = open(self.path, 'w+')
-        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        start = time.time()
+
+        if self.timeout is None:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        elif not util.wait_for(self._try_lock, start + self.timeout):
+            self.close()
+            raise LockTimeout("timed out waiting for lock: {path}".format(
+                path=self.path))
+
+        self._acquired = time.time()
+        self.wait_time = self._acquired - start
+
+    @property
+    def held_time(self):
+        if self._acquired is None:
+            return self.hold_time
+        return time.time() - self._acquired
 
     def close(self):
         if self.fd is None:
             return
 
+        if self._acquired is not None:
+            self.hold_time = time.time() - self._acquired
+            self._acquired = None
+
         self.fd.close()
         self.fd = None
 
     def __enter__(self):
         self.write()
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
@@ -64,6 +119,65 @@ class LockFile(object):
         self.close()
 
 
+class MasterScore(object):
+    """
+    Publishes a multistate resource's master score using crm_master.
+
+    Calling crm_master costs a fork/exec and a CIB update, so we skip it if
+    we published the same score recently. We still refresh it every `refresh`
+    calls, in case it was changed or lost behind our back.
+    """
+
+    def __init__(self, state, refresh):
+        self.state = state
+        self.refresh = refresh
+
+    def set(self, score, force=False):
+        state = self.state.load(default={})
+        skipped = state.get('skipped', 0)
+        if not force and 'score' in state and state['score'] == score and \
+           skipped < self.refresh:
+            self.state.save({'score': score, 'skipped': skipped + 1})
+            return
+
+        timing.count('subprocess')
+        with timing.phase('crm_master'):
+            if score is None:
+                subprocess.check_call(
+                    ['/usr/sbin/crm_master', '-l', 'reboot', '-D'])
+            else:
+                subprocess.check_call(
+                    ['/usr/sbin/crm_master', '-Q', '-l', 'reboot', '-v',
+                     str(score)])
+
+        self.state.save({'score': score, 'skipped': 0})
+
+
+#: Longest time (seconds) to sleep after a failed promote or demote.
+MAX_ROLE_FAILURE_DELAY = 15
+
+
+def role_change_failed(verb, state, timeout_end):
+    """
+    Handle a failed promote or demote, returning OCF_ERR_GENERIC.
+
+    This avoids too tight a Pacemaker-driven "recovery" loop if the role
+    change keeps failing for some reason. We back off further each time it
+    happens in a row (counted in `state`), but never past `timeout_end`.
+    """
+    failures = state.load(default={}).get('failures', 0)
+    state.save({'failures': failures + 1})
+
+    delay = min(2 ** failures, MAX_ROLE_FAILURE_DELAY)
+    delay = max(0, min(delay, timeout_end - time.time() - 1))
+
+    ocf.log.error("{verb} failed; sleeping {delay:.0f}s to prevent tight "
+                  "recovery loop".format(verb=verb.capitalize(), delay=delay))
+    time.sleep(delay)
+
+    return ocf.OCF_ERR_GENERIC
+
+
 class BackStoreAgent(ocf.ResourceAgent):
     """
     Manages a Linux SCSI Target backing device (LUN)
@@ -74,13 +188,15 @@ class BackStoreAgent(ocf.ResourceAgent):
 
     This resource can be run as a single primitive or as a multistate
     (master/slave) resource. When used in multistate mode, the resource agent
-    manages ALUA attributes for multipathing.
+    manages ALUA attributes for multipathing. Enable notifications
+    (notify=true) on the multistate resource so that every node also reports
+    the state of the other nodes' port groups.
     """
 
     hba_type = ocf.Parameter(
         required=True, shortdesc='Backing store type',
         longdesc="""
-The backing store HBA type, for example 'iblock' or 'fileio'.
+The backing store HBA type: 'iblock', 'fileio' or 'rd_mcp' (ramdisk).
         """)
 
     name = ocf.Parameter(
@@ -94,6 +210,16 @@ may optionally be exposed to the initiator.
         required=True, unique=True, shortdesc='Backing device or file',
         longdesc="""
 The backing device or file for the LUN.
+
+For fileio, this is a comma separated list of key=value options: fd_dev_name
+(the file or block device), fd_dev_size (the size, required for files),
+fd_buffered_io=1 (use buffered I/O) and fd_prealloc. fd_prealloc controls how
+a file is prepared before use: 'none' (the default), 'sparse', 'fallocate'
+(allocate the space up front) or 'zero' (write zeroes, so that no write ever
+has to allocate). Allow for preallocation in the start timeout.
+
+For rd_mcp, this is the size of the ramdisk, in bytes or with a K, M, G or T
+suffix. The memory is allocated when the resource starts.
         """)
 
     unit_serial = ocf.Parameter(
@@ -111,6 +237,24 @@ Backing store attributes to set, in key=value form, separated by spaces.
 Attributes not listed here will use default values set in the kernel.
         """)
 
+    auto_tune = ocf.Parameter(
+        default='false', shortdesc='Tune attributes to the backing device',
+        longdesc="""
+For iblock backing stores, derive attributes such as max_sectors,
+optimal_sectors, emulate_tpu, emulate_tpws, is_nonrot, emulate_write_cache and
+queue_depth from the request queue limits of the backing block device. Any
+attribute given explicitly in attrib takes precedence.
+        """)
+
+    attrib_drift = ocf.Parameter(
+        default='report', shortdesc='Attribute drift policy',
+        longdesc="""
+What to do when a deep monitor (OCF_CHECK_LEVEL 10 or more) finds that the
+backing store attributes no longer match those given in attrib. One of
+'ignore', 'report' (log a warning) or 'repair' (log a warning and write the
+requested values back).
+        """)
+
     alua_hosts = ocf.Parameter(
         shortdesc='List of hosts this resource may run on',
         longdesc="""
@@ -119,10 +263,103 @@ otherwise. It is a space separated list of hostnames that this resource might
 run on, which is used to generate consistent ALUA port group IDs.
         """)
 
+    master_score_refresh = ocf.Parameter(
+        default='6', shortdesc='Master score refresh interval',
+        longdesc="""
+When running in multistate mode, the master score is only published when it
+changes. This sets how many consecutive monitor operations may skip publishing
+an unchanged score before it is sent again anyway.
+        """)
+
+    master_score_mode = ocf.Parameter(
+        default='ports', shortdesc='Master score mode',
+        longdesc="""
+How to work out the master score in multistate mode. With 'ports' it is 1000
+times the number of target ports the LUN is exported through. With
+'performance' the health of the local backing device, from 0 to 999, is added
+to that: it falls with the device's recent average I/O latency and queue
+depth, and drops to 0 after I/O errors. Nodes with the same number of ports
+then prefer the one with the better performing device.
+        """)
+
+    master_score_hysteresis = ocf.Parameter(
+        default='100', shortdesc='Master score hysteresis',
+        longdesc="""
+In 'performance' master score mode, how far the device health must move
+before a new score is published. The current master also adds this to its
+score, so another node must do at least this much better to take over.
+        """)
+
+    timing_log = ocf.Parameter(
+        shortdesc='Action timing log',
+        longdesc="""
+Record how long each phase of every action takes, with counts of configfs
+reads and writes and of processes spawned, as one JSON line per action. Give
+the path of a file to append to, or 'ocf-log' to log them through the OCF
+logging functions. Timings are not recorded if this is unset.
+        """)
+
+    timing_threshold = ocf.Parameter(
+        default='0', shortdesc='Action timing log threshold',
+        longdesc="""
+Only record the timings of actions that take at least this many seconds.
+        """)
+
+    latency_threshold = ocf.Parameter(
+        default='0', shortdesc='Backing device latency threshold (ms)',
+        longdesc="""
+Monitor operations of depth 20 read a block from the backing device with
+O_DIRECT, and fail if the read errors or hangs. If this is set, they also fail
+once the latency of that read, or the average latency of all I/O to the device
+since the previous such monitor, has been above this many milliseconds for
+latency_failures monitors running. 0 disables the latency check.
+        """)
+
+    latency_failures = ocf.Parameter(
+        default='3', shortdesc='Backing device latency failure count',
+        longdesc="""
+How many consecutive depth 20 monitors must find the backing device slower
+than latency_threshold before the resource fails. Slow readings before then
+are logged as warnings.
+        """)
+
+    stats_file = ocf.Parameter(
+        shortdesc='Statistics export file',
+        longdesc="""
+Write the I/O statistics that the kernel keeps for this LUN to this file on
+every monitor, in the Prometheus text format, along with per-second rates since
+the previous monitor. Point this at a .prom file in the node exporter's
+textfile collector directory; each resource needs a file of its own. Statistics
+are not exported if this is unset.
+        """)
+
+    def __init__(self, *args, **kwargs):
+        super(BackStoreAgent, self).__init__(*args, **kwargs)
+        timing.install(self.timing_log, self.timing_threshold, ocf.log.info,
+                       agent='backstore',
+                       instance=os.environ.get('OCF_RESOURCE_INSTANCE'))
+
     @cached_property
     def rtsroot(self):
         return rtslib.RTSRoot()
 
+    @cached_property
+    def so_index(self):
+        path = "{tmp}/{prefix}.index".format(tmp=ocf.env.rsctmp,
+                                             prefix=STATE_PREFIX)
+        return configfs.StorageObjectIndex(path)
+
+    @property
+    @timing.timed('storage_object_lookup')
+    def storage_object_path(self):
+        """
+        The configfs path of our storage object, or None if it doesn't exist.
+
+        This is cheap to evaluate, so use it in preference to storage_object
+        when all that is needed is to read configfs.
+        """
+        return self.so_index.lookup(self.hba_type, self.name)
+
     @property
     def storage_object(self):
         try:
@@ -130,38 +367,179 @@ run on, which is used to generate consistent ALUA port group IDs.
         except AttributeError:
             pass
 
-        try:
-            for bs in self.rtsroot.backstores:
-                # In Linux 4.7 kernels, the hba_info file in configfs
-                # intermittently goes missing. If we get an ENOENT, retry a few
-                # times until it maybe appears.
-                plugin = None
-                for i in range(1, 10):
-                    try:
-                        plugin = bs.plugin
-                    except IOError as e:
-                        if e.errno == errno.ENOENT:
-                            continue
-                        raise
-                    else:
-                        break
-
-                if plugin is None:
-                    break
-
-                if plugin != self.hba_type:
-                    continue
+        path = self.storage_object_path
+        if path is None:
+            return None
 
-                for so in bs.storage_objects:
-                    if so.name == self.name:
-                        self.__storage_object = so
-                        return so
-        except RTSLibError:
-            # target core probably isn't loaded
-            pass
+        so = lookup.storage_object(path)
+        if so is not None:
+            self.__storage_object = so
+
+        return so
+
+    #: Valid values of the attrib_drift parameter.
+    ATTRIB_DRIFT_POLICIES = ('ignore', 'report', 'repair')
+
+    @cached_property
+    def desired_attributes(self):
+        """
+        The attributes requested in ``attrib``, as a list of (name, value)
+        pairs in the order they were given.
+        """
+        if not self.attrib:
+            return []
+
+        return [tuple(attr.split('=', 1)) for attr in self.attrib.split()]
+
+    def _tuned_attributes(self, current):
+        """
+        The attributes derived from the backing device's queue limits, if
+        auto_tune is enabled, as a list of (name, value) pairs.
+        """
+        if self.hba_type != 'iblock' or not util.is_true(self.auto_tune):
+            return []
+
+        sysfs_dir = blockdev.sysfs_path(self.device)
+        if sysfs_dir is None:
+            ocf.log.warning("Cannot find {dev} in sysfs; not tuning".format(
+                dev=self.device))
+            return []
+
+        return blockdev.iblock_attributes(blockdev.queue_limits(sysfs_dir),
+                                          current)
+
+    @timing.timed('attributes')
+    def _reconcile_attributes(self, so_path, repair=True):
+        """
+        Compare the storage object's attributes with ``attrib`` (and those
+        derived by auto_tune), reading them all in one pass, and write only
+        those that differ if `repair` is set.
+
+        Returns the list of (name, value, current_value) tuples that differed.
+        """
+        if not self.desired_attributes and not util.is_true(self.auto_tune):
+            return []
+
+        current = configfs.read_attributes(so_path)
+
+        # Explicitly requested attributes override the tuned ones
+        explicit = set(name for name, _ in self.desired_attributes)
+        desired = [(name, value) for name, value
+                   in self._tuned_attributes(current)
+                   if name not in explicit]
+        desired.extend(self.desired_attributes)
+
+        changes = configfs.attribute_changes(desired, current)
+
+        if repair:
+            for (name, value, _) in changes:
+                ocf.log.debug("Setting attribute {name}={value}".format(
+                    name=name, value=value))
+                configfs.write_attribute(so_path, name, value)
+
+        return changes
+
+    def _check_attributes(self):
+        """
+        Look for attribute drift during a deep monitor, reporting or
+        repairing it according to ``attrib_drift``.
+        """
+        so_path = self.storage_object_path
+        if self.attrib_drift == 'ignore' or so_path is None:
+            return
+
+        changes = self._reconcile_attributes(so_path, repair=False)
+        for (name, value, current) in changes:
+            ocf.log.warning("{so}: attribute {name} is {current}, expected "
+                            "{value}".format(so=self.name, name=name,
+                                             current=current, value=value))
+
+            if self.attrib_drift != 'repair':
+                continue
+
+            try:
+                configfs.write_attribute(so_path, name, value)
+            except IOError as e:
+                # Some attributes can't be changed while the LUN is exported
+                ocf.log.error("{so}: failed to repair attribute {name}: "
+                              "{err}".format(so=self.name, name=name, err=e))
+
+    def _probe_path(self):
+        """
+        Return the path to read from when probing the backing device, or None
+        if there is nothing to probe.
+        """
+        if self.hba_type == 'iblock':
+            return self.device
+        elif self.hba_type == 'fileio':
+            path = fileio.parse_device_options(self.device).get('fd_dev_name')
+
+            # O_DIRECT isn't supported by filesystems without a block device
+            # (such as tmpfs), and there would be no statistics to read
+            if path and blockdev.backing_sysfs_path(path) is not None:
+                return path
 
         return None
 
+    @timing.timed('latency')
+    def _check_latency(self, deadline):
+        """
+        Probe the backing device during a deep monitor, returning False if it
+        has failed or has been too slow for too long.
+        """
+        path = self._probe_path()
+        if path is None:
+            return True
+
+        if time.time() >= deadline:
+            ocf.log.warning("{so}: no time left to probe {path}".format(
+                so=self.name, path=path))
+            return True
+
+        try:
+            elapsed = blockdev.probe_read(path, deadline)
+        except IOError as e:
+            ocf.log.error("{so}: {err}".format(so=self.name, err=e))
+            return False
+
+        if elapsed is None:
+            ocf.log.error("{so}: read from {path} did not complete in time"
+                          .format(so=self.name, path=path))
+            return False
+
+        state = self._state_file('latency')
+        previous = state.load({})
+
+        sysfs = blockdev.backing_sysfs_path(path)
+        stat = blockdev.read_stat(sysfs) if sysfs else None
+        average = blockdev.average_latency(previous.get('stat'), stat)
+
+        threshold = float(self.latency_threshold)
+        limit = int(self.latency_failures)
+        breaches = 0
+
+        latency = elapsed * 1000
+        if threshold and max(latency, average or 0) > threshold:
+            breaches = previous.get('breaches', 0) + 1
+            ocf.log.warning(
+                "{so}: {path} is slow: probe {latency:.1f}ms, average "
+                "{average}, {in_flight} in flight (over {threshold}ms "
+                "{breaches} of {limit} times)".format(
+                    so=self.name, path=path, latency=latency,
+                    average=("{0:.1f}ms".format(average)
+                             if average is not None else 'unknown'),
+                    in_flight=(stat['in_flight'] if stat else 'unknown'),
+                    threshold=threshold, breaches=breaches, limit=limit))
+
+        state.save({'stat': stat, 'breaches': breaches})
+
+        if breaches >= limit:
+            ocf.log.error("{so}: {path} has been too slow for {n} monitors"
+                          .format(so=self.name, path=path, n=breaches))
+            return False
+
+        return True
+
     @cached_property
     def alua_ptgp_name(self):
         if not ocf.env.is_ms:
@@ -179,19 +557,16 @@ run on, which is used to generate consistent ALUA port group IDs.
 
         return self.alua_hosts.split().index(self.alua_ptgp_name) + 16
 
+    def _hba_allocator(self, hba_type):
+        return configfs.HBAIndexAllocator(hba_type)
+
     @property
     def next_free_hba_index(self):
-        indexes = [backstore.index for backstore in self.rtsroot.backstores
-                   if backstore.plugin == self.hba_type]
-
-        backstore_index = None
-        for index in range(1048576):
-            if index not in indexes:
-                backstore_index = index
-                break
-
-        return backstore_index
+        # This must only be used with the storage object lock held, so that
+        # nobody else can claim the same index before we create the HBA.
+        return self._hba_allocator(self.hba_type).reserve()
 
+    @timing.timed('create_storage_object')
     def _create_iblock_storage_object(self):
         # First, create the Backstore object (HBA in old speak)
         bs = rtslib.IBlockBackstore(self.next_free_hba_index, mode='create')
@@ -200,15 +575,15 @@ run on, which is used to generate consistent ALUA port group IDs.
             # Now create the storage object on top
             so = bs.storage_object(self.name, dev=self.device,
                                    wwn=self.unit_serial)
-        except RTSLibError:
+        except rtslib.RTSLibError:
             bs.delete()
             raise
         else:
             return so
 
+    @timing.timed('create_storage_object')
     def _create_fileio_storage_object(self):
-        devopts = {x[0]: x[1] for x in [x.split('=', 1) for x
-                                        in self.device.split(',')]}
+        devopts = fileio.parse_device_options(self.device)
 
         dev_name = devopts.get('fd_dev_name')
         dev_size = devopts.get('fd_dev_size')
@@ -221,12 +596,77 @@ run on, which is used to generate consistent ALUA port group IDs.
             # Now create the storage object on top
             so = bs.storage_object(self.name, dev=dev_name, size=dev_size,
                                    buffered_mode=bufio)
-        except RTSLibError:
+        except rtslib.RTSLibError:
+            bs.delete()
+            raise
+        else:
+            return so
+
+    @timing.timed('create_storage_object')
+    def _create_rd_mcp_storage_object(self):
+        size = util.parse_size(self.device)
+
+        # First, create the Backstore object (HBA in old speak)
+        bs = rtslib.RDMCPBackstore(self.next_free_hba_index, mode='create')
+
+        try:
+            # Now create the storage object on top
+            so = bs.storage_object(self.name, size=size, wwn=self.unit_serial)
+        except rtslib.RTSLibError:
             bs.delete()
             raise
         else:
             return so
 
+    @timing.timed('prepare_device')
+    def _prepare_device(self):
+        """
+        Prepare the backing device before the storage object is created.
+
+        This can take a while, so it happens before the storage object lock
+        is taken.
+        """
+        if self.hba_type == 'rd_mcp':
+            # Refuse to push the node into swap or the OOM killer
+            size = util.parse_size(self.device)
+            available = kernel.mem_available()
+            if available is not None and size > available:
+                ocf.log.error("Not enough memory for a {size} byte ramdisk: "
+                              "{available} bytes available".format(
+                                  size=size, available=available))
+                return ocf.OCF_ERR_GENERIC
+
+        if self.hba_type != 'fileio':
+            return ocf.OCF_SUCCESS
+
+        devopts = fileio.parse_device_options(self.device)
+        mode = devopts.get('fd_prealloc', 'none')
+        if mode == 'none':
+            return ocf.OCF_SUCCESS
+
+        path = devopts['fd_dev_name']
+        size = util.parse_size(devopts['fd_dev_size'])
+
+        needed = fileio.space_needed(path, size, mode)
+        available = fileio.free_space(path)
+        if needed > available:
+            ocf.log.error("Not enough space to preallocate {path}: {needed} "
+                          "bytes needed, {available} available".format(
+                              path=path, needed=needed, available=available))
+            return ocf.OCF_ERR_GENERIC
+
+        try:
+            elapsed = fileio.preallocate(path, size, mode)
+        except (IOError, OSError, subprocess.CalledProcessError) as e:
+            ocf.log.error("Failed to preallocate {path}: {err}".format(
+                path=path, err=e))
+            return ocf.OCF_ERR_GENERIC
+
+        ocf.log.info("Preallocated {path} ({mode}, {size} bytes) in "
+                     "{elapsed:.2f}s".format(path=path, mode=mode, size=size,
+                                             elapsed=elapsed))
+        return ocf.OCF_SUCCESS
+
     # You'd think that RTSLib has a mapping like this somewhere, but you would
     # be wrong. No matter, this will double up as a useful way of restricting
     # which backing store objects this RA supports and abstracting their
@@ -234,18 +674,66 @@ run on, which is used to generate consistent ALUA port group IDs.
     HBA_TYPE_MAP = {
         'iblock': _create_iblock_storage_object,
         'fileio': _create_fileio_storage_object,
+        'rd_mcp': _create_rd_mcp_storage_object,
     }
 
-    def _create_storage_object(self):
-        # Acquire a global lock for prodding RTSLib; the various storage
-        # objects can get into a funny state if two instances poke the same
-        # parts at the same time.
-        lockname = "{tmp}/{typ}.lock".format(tmp=ocf.env.rsctmp,
-                                             typ=ocf.env.resource_type)
-        with LockFile(lockname):
+    def _storage_object_lock(self, hba_type, deadline):
+        # The various storage objects can get into a funny state if two
+        # instances poke the same parts at the same time, and HBA indexes are
+        # allocated per type. Different HBA types don't interfere, so they
+        # each get their own lock.
+        lockname = "{tmp}/{prefix}-{hba}.lock".format(
+            tmp=ocf.env.rsctmp, prefix=STATE_PREFIX, hba=hba_type)
+        return LockFile(lockname, timeout=max(0, deadline - time.time()))
+
+    def _record_lock_metrics(self, hba_type, lock):
+        # This must be called with the lock still held, as that's all that
+        # stops concurrent starts from losing each other's updates
+        state = util.StateFile("{tmp}/{prefix}-{hba}.lock-stats".format(
+            tmp=ocf.env.rsctmp, prefix=STATE_PREFIX, hba=hba_type))
+        hold_time = lock.held_time
+
+        stats = state.load(default={})
+        stats['count'] = stats.get('count', 0) + 1
+        for kind, value in [('wait', lock.wait_time), ('hold', hold_time)]:
+            total = "total_{0}".format(kind)
+            peak = "max_{0}".format(kind)
+            stats[total] = stats.get(total, 0) + value
+            stats[peak] = max(stats.get(peak, 0), value)
+        state.save(stats)
+        timing.recorder.add('lock_wait', lock.wait_time)
+
+        log = ocf.log.info if lock.wait_time >= 1 else ocf.log.debug
+        log("{hba} lock: waited {wait:.3f}s, held {hold:.3f}s".format(
+            hba=hba_type, wait=lock.wait_time, hold=hold_time))
+
+    def _create_storage_object(self, deadline=None):
+        # Callers creating several storage objects at once take the lock
+        # themselves, and pass no deadline
+        if deadline is None:
             return self.HBA_TYPE_MAP[self.hba_type](self)
 
+        # Only the HBA index reservation and creation of the storage object
+        # need to be serialised, so that's all we hold the lock for.
+        with self._storage_object_lock(self.hba_type, deadline) as lock:
+            so = self.HBA_TYPE_MAP[self.hba_type](self)
+            self._record_lock_metrics(self.hba_type, lock)
+
+        return so
+
+    @cached_property
+    def setup_marker(self):
+        return kernel.SetupMarker("{tmp}/{prefix}.setup".format(
+            tmp=ocf.env.rsctmp, prefix=STATE_PREFIX))
+
+    @timing.timed('setup')
     def _setup(self):
+        # If we've already set everything up since boot, and the target core
+        # is still there, there's nothing to do
+        if self.setup_marker.is_set() and \
+           os.path.isdir(configfs.TARGET_ROOT):
+            return ocf.OCF_SUCCESS
+
         # Ensure ALUA and PR state directories exist
         for d in ['/var/target/alua', '/var/target/pr']:
             if not os.path.isdir(d):
@@ -258,68 +746,67 @@ run on, which is used to generate consistent ALUA port group IDs.
 
         # Ensure configfs is loaded
         if not os.path.isdir('/sys/kernel/config'):
-            ret = subprocess.call(['modprobe', 'configfs'])
+            ret = kernel.load_modules(['configfs'])
             if ret:
                 ocf.log.error('failed to modprobe configfs')
                 return ocf.OCF_ERR_INSTALLED
 
-        # Ensure configfs is mounted. We do this by just trying to mount it and
-        # expect a specific error exit from mount if it's already there. We
-        # redirect stdout and stderr to /dev/null while we do this, as it is
-        # noisy otherwise
-        with open('/dev/null', 'w') as devnull:
-            ret = subprocess.call(
-                ['mount', '-t', 'configfs', 'configfs', '/sys/kernel/config'],
-                stdout=devnull, stderr=devnull)
-            if ret not in [0, 32]:
-                # 0 = mounted OK, 32 = already mounted
-                ocf.log.error("failed to mount configfs: {ret}"
-                              .format(ret=ret))
-                return ocf.OCF_ERR_INSTALLED
+        # Ensure configfs is mounted. We redirect stdout and stderr to
+        # /dev/null while we do this, as it is noisy otherwise
+        if not kernel.is_mounted('/sys/kernel/config', 'configfs'):
+            timing.count('subprocess')
+            with open('/dev/null', 'w') as devnull:
+                ret = subprocess.call(
+                    ['mount', '-t', 'configfs', 'configfs',
+                     '/sys/kernel/config'],
+                    stdout=devnull, stderr=devnull)
+                if ret not in [0, 32]:
+                    # 0 = mounted OK, 32 = already mounted
+                    ocf.log.error("failed to mount configfs: {ret}"
+                                  .format(ret=ret))
+                    return ocf.OCF_ERR_INSTALLED
 
         # Ensure the target modules are loaded
-        if not os.path.isdir('/sys/kernel/config/target'):
-            # Get a list of all currently loaded kernel modules
-            with open('/proc/modules', 'r') as fp:
-                loaded_modules = [x.split()[0] for x in fp]
-
-            # Make sure each of the target modules is loaded
-            for mod in TARGET_CORE_MODULES:
-                # Skip if already loaded
-                if mod in loaded_modules:
-                    continue
-
-                ret = subprocess.call(['modprobe', mod])
-                if ret:
-                    ocf.log.error("failed to modprobe {mod}".format(mod=mod))
-                    return ocf.OCF_ERR_INSTALLED
+        if not os.path.isdir(configfs.TARGET_ROOT):
+            # Load all of the missing target modules in one go
+            ret = kernel.load_modules(TARGET_CORE_MODULES)
+            if ret:
+                ocf.log.error("failed to modprobe {mods}".format(
+                    mods=' '.join(TARGET_CORE_MODULES)))
+                return ocf.OCF_ERR_INSTALLED
 
             # Now that the modules are loaded, the directory may have already
             # appeared or we may have to create it, depending on the kernel
             # version.
-            if not os.path.isdir('/sys/kernel/config/target'):
+            if not os.path.isdir(configfs.TARGET_ROOT):
                 try:
-                    os.mkdir('/sys/kernel/config/target')
+                    os.mkdir(configfs.TARGET_ROOT)
                 except OSError:
                     ocf.log.error('failed to create target config directory')
                     return ocf.OCF_ERR_INSTALLED
 
+        self.setup_marker.set()
         return ocf.OCF_SUCCESS
 
+    @timing.timed('alua')
     def _create_alua_ptgp(self, pt_gp_name=None):
         if pt_gp_name is None:
             pt_gp_name = self.alua_ptgp_name
 
         pt_gp_id = self.alua_hosts.split().index(pt_gp_name) + 16
-        so_path = self.storage_object.path
+        so_path = self.storage_object_path
         alua_dir = os.path.join(so_path, 'alua', pt_gp_name)
 
+        # The kernel refuses to change the ID of an existing port group
+        if os.path.isdir(alua_dir):
+            return
+
         ocf.log.debug("Creating ALUA TPG {name}; ID {id}".format(
             name=pt_gp_name, id=pt_gp_id))
 
-        if not os.path.isdir(alua_dir):
-            os.mkdir(alua_dir)
+        os.mkdir(alua_dir)
 
+        timing.count('configfs_write')
         with open(os.path.join(alua_dir, 'tg_pt_gp_id'), 'w') as fd:
             fd.write(str(pt_gp_id) + "\n")
 
@@ -327,39 +814,45 @@ run on, which is used to generate consistent ALUA port group IDs.
         if pt_gp_name is None:
             pt_gp_name = self.alua_ptgp_name
 
-        so_path = self.storage_object.path
-        prop_path = os.path.join(so_path, 'alua', pt_gp_name, prop)
-
-        with open(prop_path, 'r') as fd:
-            return fd.read()
+        return configfs.read_alua(self.storage_object_path, pt_gp_name, prop)
 
+    @timing.timed('alua')
     def set_alua(self, prop, value, pt_gp_name=None):
         if pt_gp_name is None:
             pt_gp_name = self.alua_ptgp_name
 
-        so_path = self.storage_object.path
+        so_path = self.storage_object_path
         prop_path = os.path.join(so_path, 'alua', pt_gp_name, prop)
 
+        timing.count('configfs_write')
         with open(prop_path, 'w') as fd:
             fd.write(value)
 
-    def _set_master_score(self, score):
-        if score is None:
-            subprocess.check_call(
-                ['/usr/sbin/crm_master', '-l', 'reboot', '-D'])
-        else:
-            subprocess.check_call(
-                ['/usr/sbin/crm_master', '-Q', '-l', 'reboot', '-v',
-                 str(score)])
+    def _state_file(self, kind):
+        instance = os.environ.get('OCF_RESOURCE_INSTANCE', self.name)
+        return util.StateFile("{tmp}/{instance}.{kind}".format(
+            tmp=ocf.env.rsctmp, instance=instance, kind=kind))
 
-    def _update_master_score(self, status):
-        # Only update master score if this is a master/slave resource
-        if not ocf.env.is_ms:
-            return
+    @cached_property
+    def master_score(self):
+        return MasterScore(self._state_file('master-score'),
+                           int(self.master_score_refresh))
 
-        if status == ocf.OCF_NOT_RUNNING or self.storage_object is None:
+    @cached_property
+    def role_failure_state(self):
+        return self._state_file('role-failures')
+
+    def _set_master_score(self, score, force=False):
+        self.master_score.set(score, force)
+
+    def _calculate_master_score(self, status):
+        """
+        Work out the master score for the given monitor status, or None if we
+        should not offer to become master at all.
+        """
+        if status == ocf.OCF_NOT_RUNNING or self.storage_object_path is None:
             # We are stopped; we should not offer to become master at all
-            self._set_master_score(None)
+            return None
         elif status == ocf.OCF_SUCCESS or status == ocf.OCF_RUNNING_MASTER:
             # We are in slave or master mode
 
@@ -373,16 +866,46 @@ run on, which is used to generate consistent ALUA port group IDs.
             # fabrics, the node with the most configured fabrics is preferred.
             score = num_target_ports * 1000
 
-            ocf.log.debug("Setting master score to: {score}"
-                          .format(score=score))
+            # Break ties between nodes with the same fabrics in favour of the
+            # healthier backing device; this never outweighs a port.
+            if num_target_ports and self.master_score_mode == 'performance':
+                score += self._health_score(status == ocf.OCF_RUNNING_MASTER)
 
-            self._set_master_score(score)
+            return score
         else:
             # Some kind of error; we should not offer to become master at all
-            self._set_master_score(None)
+            return None
+
+    #: Valid values of the master_score_mode parameter.
+    MASTER_SCORE_MODES = ('ports', 'performance')
+
+    def _health_score(self, master):
+        path = self._probe_path()
+        sysfs = blockdev.backing_sysfs_path(path) if path else None
+        if sysfs is None:
+            return 0
+
+        health = blockdev.HealthScore(self._state_file('health'),
+                                      int(self.master_score_hysteresis))
+        return health.update(blockdev.read_stat(sysfs),
+                             blockdev.io_errors(sysfs), master)
+
+    def _update_master_score(self, status, force=False):
+        # Only update master score if this is a master/slave resource
+        if not ocf.env.is_ms:
+            return
+
+        score = self._calculate_master_score(status)
+        ocf.log.debug("Setting master score to: {score}".format(score=score))
+        self._set_master_score(score, force)
 
     @ocf.Action(timeout=40)
     def start(self):
+        # Preparing the device can take a while, and has to come out of the
+        # same time budget as waiting for the storage object lock
+        deadline = util.action_deadline(
+            ocf.env.reskey.get('CRM_meta_timeout'), 40)
+
         # Make sure our basic infrastructure is present
         ret = self._setup()
         if ret != ocf.OCF_SUCCESS:
@@ -394,10 +917,24 @@ run on, which is used to generate consistent ALUA port group IDs.
             ocf.log.warning("Resource is already running")
             return ret
 
-        so = self._create_storage_object()
+        ret = self._prepare_device()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        try:
+            so = self._create_storage_object(deadline)
+        except LockTimeout as e:
+            ocf.log.error(str(e))
+            return ocf.OCF_ERR_GENERIC
+
+        self.so_index.add(self.hba_type, self.name, so.path)
 
         ocf.log.debug("Created storage object: {so.path}".format(so=so))
 
+        self._configure_storage_object(so)
+        self._update_master_score(ocf.OCF_SUCCESS, force=True)
+
+    def _configure_storage_object(self, so):
         # Configure ALUA
         if ocf.env.is_ms:
             # Create ALUA target port group
@@ -414,13 +951,8 @@ run on, which is used to generate consistent ALUA port group IDs.
             self.set_alua('alua_access_type', '0\n')
             self.set_alua('preferred', '0\n')
 
-        # Now set all the attributes as requested
-        if self.attrib:
-            for attr in self.attrib.split():
-                (name, value) = attr.split('=', 1)
-                so.set_attribute(name, value)
-
-        self._update_master_score(ocf.OCF_SUCCESS)
+        # Now set the attributes that aren't already as requested
+        self._reconcile_attributes(so.path)
 
     @ocf.Action(timeout=120)
     def stop(self):
@@ -445,21 +977,25 @@ run on, which is used to generate consistent ALUA port group IDs.
         # Now delete the device and the HBA
         so.delete()
         so.backstore.delete()
+        self.so_index.remove(self.hba_type, self.name)
 
-        self._update_master_score(ocf.OCF_NOT_RUNNING)
+        self._update_master_score(ocf.OCF_NOT_RUNNING, force=True)
 
         return ocf.OCF_SUCCESS
 
     def _monitor(self):
+        # Monitoring only ever reads configfs directly; building the RTSLib
+        # object graph is far too expensive to do this often.
+
         # If there isn't a storage object with the given type and name, the
         # resource can't be running.
-        so = self.storage_object
-        if so is None:
+        so_path = self.storage_object_path
+        if so_path is None:
             return ocf.OCF_NOT_RUNNING
 
         # If we get this far, the resource is either running or "failed"
         # because it is only part configured.
-        if not so.is_configured():
+        if not configfs.storage_object_configured(so_path):
             return ocf.OCF_ERR_GENERIC
 
         if not ocf.env.is_ms:
@@ -480,110 +1016,155 @@ run on, which is used to generate consistent ALUA port group IDs.
     @ocf.Action(timeout=20, depth=0, interval=10)
     @ocf.Action(timeout=20, depth=0, interval=20, role='Slave')
     @ocf.Action(timeout=20, depth=0, interval=10, role='Master')
+    @ocf.Action(timeout=20, depth=10, interval=300)
+    @ocf.Action(timeout=30, depth=20, interval=60)
     def monitor(self):
         ret = self._monitor()
-        self._update_master_score(ret)
-        return ret
+        running = ret in (ocf.OCF_SUCCESS, ocf.OCF_RUNNING_MASTER)
 
-    @ocf.Action(timeout=90)
-    def promote(self):
-        ret = ocf.OCF_ERR_GENERIC
-        first_try = True
+        if util.check_level() >= 10 and running:
+            self._check_attributes()
 
-        # Keep trying to promote the resource;
-        # wait for the CRM to time us out if this fails
-        while True:
-            status = self._monitor()
+        if util.check_level() >= 20 and running:
+            deadline = util.action_deadline(
+                ocf.env.reskey.get('CRM_meta_timeout'), 30)
+            if not self._check_latency(deadline):
+                ret = ocf.OCF_ERR_GENERIC
 
-            if status == ocf.OCF_SUCCESS:  # in slave mode
-                ocf.log.info('Attempting to promote.')
-
-                # Set ALUA_ACCESS_STATE_ACTIVE_OPTIMIZED and preferred path
-                self.set_alua('alua_access_state', '0\n')
-                self.set_alua('preferred', '1\n')
-
-                # Go around the loop again to make sure we come up as
-                # OCF_RUNNING_MASTER
-            elif status == ocf.OCF_NOT_RUNNING:
-                ocf.log.error('Trying to promote a resource that was not '
-                              'started!')
-                break
-            elif status == ocf.OCF_RUNNING_MASTER:
-                ocf.log.info('Promotion successful.')
-                ret = ocf.OCF_SUCCESS
-                self._update_master_score(status)
-                break
-
-            # Avoid a busy loop
-            if not first_try:
-                time.sleep(1)
-            first_try = False
-
-        # avoid too tight pacemaker driven "recovery" loop if promotion keeps
-        # failing for some reason
-        if ret != ocf.OCF_SUCCESS:
-            ocf.log.error('Promotion failed; sleeping 15s to prevent tight '
-                          'recovery loop')
-            time.sleep(15)
+        if self.stats_file and running:
+            self._export_stats()
 
+        self._update_master_score(ret)
         return ret
 
-    @ocf.Action(timeout=90)
-    def demote(self):
-        ret = ocf.OCF_ERR_GENERIC
-        first_try = True
-
-        # Keep trying to promote the resource;
-        # wait for the CRM to time us out if this fails
-        while True:
+    @timing.timed('stats')
+    def _export_stats(self):
+        instance = os.environ.get('OCF_RESOURCE_INSTANCE', self.name)
+        samples = stats.storage_object_samples(self.storage_object_path,
+                                               resource=instance)
+        stats.export(self.stats_file, self._state_file('stats').path, samples,
+                     ocf.log.warning)
+
+    def _change_role(self, verb, target, alua_state, alua_pref):
+        timeout_ms = ocf.env.reskey.get('CRM_meta_timeout')
+        timeout_end = util.action_deadline(timeout_ms, 90, reserve=0)
+        deadline = util.action_deadline(timeout_ms, 90)
+
+        status = self._monitor()
+        if status == ocf.OCF_NOT_RUNNING:
+            ocf.log.error("Trying to {verb} a resource that was not "
+                          "started!".format(verb=verb))
+            return role_change_failed(verb, self.role_failure_state,
+                                      timeout_end)
+
+        if status != target:
+            ocf.log.info("Attempting to {verb}.".format(verb=verb))
+
+            def check():
+                # Write the ALUA state and check straight away whether it has
+                # taken effect; it normally has.
+                self.set_alua('alua_access_state', alua_state)
+                self.set_alua('preferred', alua_pref)
+                return self._monitor() in (target, ocf.OCF_NOT_RUNNING)
+
+            util.wait_for(check, deadline)
             status = self._monitor()
 
-            if status == ocf.OCF_SUCCESS:  # in slave mode
-                ocf.log.info('Demotion successful.')
-                ret = ocf.OCF_SUCCESS
-                self._update_master_score(status)
-                break
-            elif status == ocf.OCF_NOT_RUNNING:
-                ocf.log.error('Trying to demote a resource that was not '
-                              'started!')
-                break
-            elif status == ocf.OCF_RUNNING_MASTER:
-                ocf.log.info('Attempting to demote.')
-
-                # Set ALUA_ACCESS_STATE_STANDBY and no preference
-                self.set_alua('alua_access_state', '2\n')
-                self.set_alua('preferred', '0\n')
-
-                # Go around the loop again to make sure we come up as a slave
-                # (OCF_SUCCESS)
-
-            # Avoid a busy loop
-            if not first_try:
-                time.sleep(1)
-            first_try = False
-
-        # avoid too tight pacemaker driven "recovery" loop if demotion keeps
-        # failing for some reason
-        if ret != ocf.OCF_SUCCESS:
-            ocf.log.error('Demotion failed; sleeping 15s to prevent tight '
-                          'recovery loop')
-            time.sleep(15)
+        if status != target:
+            return role_change_failed(verb, self.role_failure_state,
+                                      timeout_end)
 
-        return ret
+        ocf.log.info("{verb} successful.".format(verb=verb.capitalize()))
+        self.role_failure_state.remove()
+        self._update_master_score(status, force=True)
+        return ocf.OCF_SUCCESS
+
+    @ocf.Action(timeout=90)
+    def promote(self):
+        # Set ALUA_ACCESS_STATE_ACTIVE_OPTIMIZED and preferred path
+        return self._change_role('promote', ocf.OCF_RUNNING_MASTER,
+                                 '0\n', '1\n')
+
+    @ocf.Action(timeout=90)
+    def demote(self):
+        # Set ALUA_ACCESS_STATE_STANDBY and no preference. We come up as a
+        # slave (OCF_SUCCESS) once this has taken effect.
+        return self._change_role('demote', ocf.OCF_SUCCESS, '2\n', '0\n')
+
+    def _notify_masters(self):
+        """
+        The set of nodes that will be master once the operation being
+        notified about has completed.
+        """
+        reskey = ocf.env.reskey
+
+        def unames(kind):
+            return set(reskey.get(
+                "CRM_meta_notify_{kind}_uname".format(kind=kind), '').split())
+
+        return (unames('master') - unames('demote')) | unames('promote')
+
+    def _set_alua_peers(self, masters):
+        # Our own port group is left to promote and demote; we only mirror
+        # the state of the other nodes' port groups here
+        for pt_gp_name in self.alua_hosts.split():
+            if pt_gp_name == self.alua_ptgp_name:
+                continue
+
+            self._create_alua_ptgp(pt_gp_name)
+            self.set_alua('alua_access_type', '1\n', pt_gp_name)
+
+            if pt_gp_name in masters:
+                # ALUA_ACCESS_STATE_ACTIVE_OPTIMIZED and preferred path
+                self.set_alua('alua_access_state', '0\n', pt_gp_name)
+                self.set_alua('preferred', '1\n', pt_gp_name)
+            else:
+                # ALUA_ACCESS_STATE_STANDBY and no preference
+                self.set_alua('alua_access_state', '2\n', pt_gp_name)
+                self.set_alua('preferred', '0\n', pt_gp_name)
 
     @ocf.Action(timeout=90)
     def notify(self):
-        # TODO: use notifications to set state of all ALUA port groups at the
-        # same time, so that initiators know the state of all port groups by
-        # querying any single target port. This is required by certain
+        # Use notifications to set the state of all the ALUA port groups at
+        # the same time, so that initiators know the state of all port groups
+        # by querying any single target port. This is required by certain
         # initiators like VMware.
-        pass
+        if not ocf.env.is_ms or self.storage_object_path is None:
+            return ocf.OCF_SUCCESS
+
+        reskey = ocf.env.reskey
+        if reskey.get('CRM_meta_notify_type') != 'post' or \
+           reskey.get('CRM_meta_notify_operation') not in ('promote',
+                                                           'demote'):
+            return ocf.OCF_SUCCESS
+
+        self._set_alua_peers(self._notify_masters())
+        return ocf.OCF_SUCCESS
 
     def validate_all(self):
         ret = super(BackStoreAgent, self).validate_all()
         if ret != ocf.OCF_SUCCESS:
             return ret
 
+        ret = self._validate_multistate()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        ret = self._validate_device()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        ret = self._validate_attributes()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        ret = self._validate_latency()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        return self._setup()
+
+    def _validate_multistate(self):
         if ocf.env.is_clone:
             if not ocf.env.is_ms:
                 ocf.log.error('This RA may only be used as a primitive or '
@@ -613,8 +1194,67 @@ run on, which is used to generate consistent ALUA port group IDs.
                     node=self.alua_ptgp_name))
                 return ocf.OCF_ERR_CONFIGURED
 
+            if self.master_score_mode not in self.MASTER_SCORE_MODES:
+                ocf.log.error("master_score_mode must be one of: {modes}"
+                              .format(modes=', '.join(
+                                  self.MASTER_SCORE_MODES)))
+                return ocf.OCF_ERR_CONFIGURED
+
+            try:
+                hysteresis = int(self.master_score_hysteresis)
+            except ValueError:
+                hysteresis = -1
+            if not 0 <= hysteresis <= blockdev.HealthScore.MAX_SCORE:
+                ocf.log.error("master_score_hysteresis must be a number from "
+                              "0 to {max}".format(
+                                  max=blockdev.HealthScore.MAX_SCORE))
+                return ocf.OCF_ERR_CONFIGURED
+
+            try:
+                refresh = int(self.master_score_refresh)
+            except ValueError:
+                refresh = -1
+            if refresh < 0:
+                ocf.log.error('master_score_refresh must be a non-negative '
+                              'number')
+                return ocf.OCF_ERR_CONFIGURED
+
             ocf.log.debug('Running as a multi-state resource')
 
+        return ocf.OCF_SUCCESS
+
+    def _validate_attributes(self):
+        if self.attrib:
+            for attr in self.attrib.split():
+                if '=' not in attr:
+                    ocf.log.error("Invalid attribute setting: {attr}".format(
+                        attr=attr))
+                    return ocf.OCF_ERR_CONFIGURED
+
+        if self.attrib_drift not in self.ATTRIB_DRIFT_POLICIES:
+            ocf.log.error("attrib_drift must be one of: {policies}".format(
+                policies=', '.join(self.ATTRIB_DRIFT_POLICIES)))
+            return ocf.OCF_ERR_CONFIGURED
+
+        return ocf.OCF_SUCCESS
+
+    def _validate_latency(self):
+        try:
+            threshold = float(self.latency_threshold)
+            failures = int(self.latency_failures)
+        except ValueError:
+            ocf.log.error('latency_threshold and latency_failures must be '
+                          'numbers')
+            return ocf.OCF_ERR_CONFIGURED
+
+        if threshold < 0 or failures < 1:
+            ocf.log.error('latency_threshold must not be negative, and '
+                          'latency_failures must be at least 1')
+            return ocf.OCF_ERR_CONFIGURED
+
+        return ocf.OCF_SUCCESS
+
+    def _validate_device(self):
         # Ensure the HBA type is in our list of allowable types
         if self.hba_type not in self.HBA_TYPE_MAP:
             ocf.log.error("Unknown hba_type: {hba}".format(hba=self.hba_type))
@@ -622,7 +1262,7 @@ run on, which is used to generate consistent ALUA port group IDs.
 
         if self.hba_type == 'iblock':
             # Check that the given device is a suitable block device for RTSLib
-            if rtslib.utils.get_block_type(self.device) != 0:
+            if rtslib_utils.get_block_type(self.device) != 0:
                 ocf.log.error("Device is not a TYPE_DISK block device: {dev}"
                               .format(dev=self.device))
                 return ocf.OCF_ERR_CONFIGURED
@@ -634,26 +1274,58 @@ run on, which is used to generate consistent ALUA port group IDs.
             #                     but ignored/optional for block devices
             #   fd_buffered_io  whether IO should be buffered - default is
             #                     unbuffered/synchronous
+            #   fd_prealloc     how to prepare the file before use - one of
+            #                     fileio.PREALLOC_MODES, default is none
 
-            devopts = {x[0]: x[1] for x in [x.split('=', 1) for x
-                                            in self.device.split(',')]}
+            devopts = fileio.parse_device_options(self.device)
 
             name = devopts.get('fd_dev_name')
             size = devopts.get('fd_dev_size')
             bufio = devopts.get('fd_buffered_io')
+            prealloc = devopts.get('fd_prealloc', 'none')
 
             if bufio is not None and bufio != '1':
                 ocf.log.error('fd_buffered_io must be "1" or not set')
                 return ocf.OCF_ERR_CONFIGURED
 
-            if size is None and rtslib.utils.get_block_type(name) != 0:
+            if size is None and rtslib_utils.get_block_type(name) != 0:
                 ocf.log.error('fd_dev_size must be given unless fd_dev_name '
                               'is a block device')
                 return ocf.OCF_ERR_CONFIGURED
+
+            if prealloc not in fileio.PREALLOC_MODES:
+                ocf.log.error("fd_prealloc must be one of: {modes}".format(
+                    modes=', '.join(fileio.PREALLOC_MODES)))
+                return ocf.OCF_ERR_CONFIGURED
+
+            if prealloc != 'none':
+                if size is None or blockdev.sysfs_path(name) is not None:
+                    ocf.log.error('fd_prealloc only applies to files, and '
+                                  'needs fd_dev_size')
+                    return ocf.OCF_ERR_CONFIGURED
+
+                try:
+                    util.parse_size(size)
+                except ValueError as e:
+                    ocf.log.error(str(e))
+                    return ocf.OCF_ERR_CONFIGURED
+        elif self.hba_type == 'rd_mcp':
+            # device is the size of the ramdisk; the kernel allocates it in
+            # whole pages
+            try:
+                size = util.parse_size(self.device)
+            except ValueError as e:
+                ocf.log.error(str(e))
+                return ocf.OCF_ERR_CONFIGURED
+
+            if size < os.sysconf('SC_PAGE_SIZE'):
+                ocf.log.error("Ramdisk size must be at least one page: {dev}"
+                              .format(dev=self.device))
+                return ocf.OCF_ERR_CONFIGURED
         else:
             raise NotImplementedError('Missing checks')
 
-        return self._setup()
+        return ocf.OCF_SUCCESS
 
 if __name__ == '__main__':
     BackStoreAgent.main()
@@ -0,0 +1,80 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import os
+import shutil
+import tempfile
+import unittest
+
+from ocf_rtslib.util import StateFile
+
+
+class FakeSubprocess(object):
+    """
+    Records the commands run through check_call instead of running them.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def check_call(self, args):
+        self.calls.append(args)
+
+
+class MasterScoreTests(unittest.TestCase):
+    def setUp(self):
+        try:
+            from ocf_rtslib import backstore
+        except ImportError:
+            raise unittest.SkipTest('python-ocf is not installed')
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.backstore = backstore
+        self.subprocess = FakeSubprocess()
+
+        self.real_subprocess = backstore.subprocess
+        backstore.subprocess = self.subprocess
+
+        self.score = backstore.MasterScore(
+            StateFile(os.path.join(self.tmpdir, 'master-score')), 2)
+
+    def tearDown(self):
+        self.backstore.subprocess = self.real_subprocess
+        shutil.rmtree(self.tmpdir)
+
+    def scores(self):
+        return [args[-1] if args[-1] != '-D' else None
+                for args in self.subprocess.calls]
+
+    def test_skips_unchanged_score(self):
+        for _ in range(4):
+            self.score.set(1000)
+
+        # Published once, skipped `refresh` times, then refreshed
+        self.assertEqual(self.scores(), ['1000', '1000'])
+
+    def test_publishes_changed_score(self):
+        self.score.set(1000)
+        self.score.set(2000)
+        self.score.set(None)
+
+        self.assertEqual(self.scores(), ['1000', '2000', None])
+
+    def test_force_refresh(self):
+        self.score.set(1000)
+        self.score.set(1000, force=True)
+
+        self.assertEqual(self.scores(), ['1000', '1000'])
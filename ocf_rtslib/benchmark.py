@@ -0,0 +1,249 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Scale benchmarks for the agents, run against a FakeConfigFS tree.
+
+Run this module to time how the configfs reads behind the monitors, and the
+agents' monitor actions themselves, scale with the number of LUNs,
+initiators and portals::
+
+    python -m ocf_rtslib.benchmark [--sizes 10,100,1000] [--initiators 4]
+        [--portals 2] [--latency 0.0001] [--enoent 0.1]
+        [--enoent-files enable,alua_access_state]
+
+The agent actions are run in a fresh interpreter each time, exactly as
+Pacemaker runs them, so they include start-up costs; they are skipped if
+python-ocf isn't installed. Injected latency and ENOENT errors apply to them
+too. Actions that change the configuration (start, stop, promote, demote)
+need RTSLib and a real target, so they aren't covered here.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from ocf_rtslib import configfs
+from ocf_rtslib.fakeconfigfs import AGENT_SCRIPT, FakeConfigFS
+from ocf_rtslib.metadata import AGENTS
+
+
+def timed(func, repeat):
+    """
+    Call `func` `repeat` times, returning the (min, median, max) time taken
+    and the last result.
+    """
+    times = []
+    result = None
+
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+
+    times.sort()
+    return (times[0], times[len(times) // 2], times[-1]), result
+
+
+def run_agent(agent, action, root, rsctmp, params, faults=None):
+    (module, cls) = AGENTS[agent]
+
+    env = dict(os.environ)
+    env.update({
+        'HA_RSCTMP': rsctmp,
+        'OCF_ROOT': '/usr/lib/ocf',
+        'OCF_RA_VERSION_MAJOR': '1',
+        'OCF_RA_VERSION_MINOR': '0',
+        'OCF_RESOURCE_INSTANCE': "bench-{0}".format(agent),
+        'OCF_RESOURCE_TYPE': agent,
+        'OCF_RTSLIB_NO_DAEMON': '1',
+        'OCF_RTSLIB_TARGET_ROOT': root,
+    })
+    for key, value in params.items():
+        env["OCF_RESKEY_{0}".format(key)] = value
+
+    script = AGENT_SCRIPT.format(agent=agent, module=module, cls=cls,
+                                 root=root, faults=faults or {})
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call([sys.executable, '-c', script, action],
+                               env=env, stdout=devnull, stderr=devnull)
+
+
+class Benchmark(object):
+    def __init__(self, size, initiators, portals, repeat=5, latency=0,
+                 enoent=0, enoent_files=None, agents=True):
+        self.size = size
+        self.initiators = initiators
+        self.portals = portals
+        self.repeat = repeat
+        self.faults = {
+            'latency': latency,
+            'enoent': enoent,
+            'names': enoent_files,
+        }
+        self.agents = agents
+
+    def cases(self, fake, info, tmpdir):
+        """
+        Yield (name, function) for each case to time.
+        """
+        core = fake.core
+        middle = info['names'][len(info['names']) // 2]
+        index_path = os.path.join(tmpdir, 'index')
+
+        def cold_lookup():
+            if os.path.exists(index_path):
+                os.unlink(index_path)
+            index = configfs.StorageObjectIndex(index_path, core)
+            return index.lookup(info['plugin'], middle)
+
+        def warm_lookup():
+            index = configfs.StorageObjectIndex(index_path, core)
+            return index.lookup(info['plugin'], middle)
+
+        def so_status():
+            path = warm_lookup()
+            return (configfs.storage_object_configured(path),
+                    configfs.read_alua(path, 'default_tg_pt_gp',
+                                       'alua_access_state'))
+
+        yield ('scan_storage_objects',
+               lambda: configfs.scan_storage_objects(core))
+        yield ('index lookup (cold)', cold_lookup)
+        yield ('index lookup (warm)', warm_lookup)
+        yield ('storage object status', so_status)
+        yield ('TPGSnapshot.load', lambda: configfs.TPGSnapshot.load(
+            'iscsi', info['wwn'], 1, fake.root))
+
+        if not self.agents:
+            return
+
+        rsctmp = os.path.join(tmpdir, 'rsctmp')
+        os.mkdir(rsctmp)
+
+        yield ('backstore monitor', lambda: run_agent(
+            'backstore', 'monitor', fake.root, rsctmp, {
+                'hba_type': info['plugin'],
+                'name': middle,
+                'device': '/dev/null',
+                'unit_serial': 'bench',
+            }, self.faults))
+        yield ('bulk-backstore monitor', lambda: run_agent(
+            'bulk-backstore', 'monitor', fake.root, rsctmp, {
+                'luns': ' '.join("{0}/{1}//dev/null/bench{2}".format(
+                    info['plugin'], name, i)
+                    for i, name in enumerate(info['names'])),
+            }, self.faults))
+        yield ('iscsi monitor', lambda: run_agent(
+            'iscsi', 'monitor', fake.root, rsctmp, {
+                'iqn': info['wwn'],
+                'luns': info['luns'],
+                'initiators': info['initiators'],
+                'portals': info['portals'],
+            }, self.faults))
+
+    def run(self, out=sys.stdout):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fake = FakeConfigFS(os.path.join(tmpdir, 'target'))
+            info = fake.populate(self.size, self.initiators, self.portals)
+
+            with fake.faults(**self.faults):
+                for name, func in self.cases(fake, info, tmpdir):
+                    ((low, median, high), result) = timed(func, self.repeat)
+
+                    # Agents report failure through their exit status
+                    note = ''
+                    if isinstance(result, int) and result != 0:
+                        note = "  (exit status {0})".format(result)
+
+                    size = "{0}/{1}/{2}".format(self.size, self.initiators,
+                                                self.portals)
+                    out.write("{name:<24} {size:>14} {median:>10.6f} "
+                              "{low:>10.6f} {high:>10.6f}{note}\n".format(
+                                  name=name, size=size, median=median,
+                                  low=low, high=high, note=note))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def agents_available():
+    try:
+        import ocf  # noqa
+    except ImportError:
+        return False
+    else:
+        return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='comma separated numbers of LUNs to test')
+    parser.add_argument('--initiators', default='4',
+                        help='comma separated numbers of initiators to test')
+    parser.add_argument('--portals', default='2',
+                        help='comma separated numbers of portals to test')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to add to every configfs read')
+    parser.add_argument('--enoent', type=float, default=0,
+                        help='probability of each configfs file read '
+                        'failing with ENOENT')
+    parser.add_argument('--enoent-files',
+                        help='comma separated names of the files whose reads '
+                        'may fail (default: all)')
+    parser.add_argument('--no-agents', action='store_true',
+                        help="don't time the agent actions")
+    args = parser.parse_args(argv)
+
+    enoent_files = None
+    if args.enoent_files:
+        enoent_files = args.enoent_files.split(',')
+
+    agents = not args.no_agents and agents_available()
+    if not args.no_agents and not agents:
+        sys.stderr.write('python-ocf is not installed; not timing the '
+                         'agent actions\n')
+
+    sys.stdout.write("{0:<24} {1:>14} {2:>10} {3:>10} {4:>10}\n".format(
+        'case', 'luns/acls/nps', 'median', 'min', 'max'))
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    initiators = [int(x) for x in args.initiators.split(',')]
+    portals = [int(x) for x in args.portals.split(',')]
+
+    # Scale each dimension in turn, holding the others at their first value,
+    # so that the matrix stays a sensible size
+    shapes = [(size, initiators[0], portals[0]) for size in sizes]
+    shapes.extend((sizes[0], count, portals[0]) for count in initiators[1:])
+    shapes.extend((sizes[0], initiators[0], count) for count in portals[1:])
+
+    for shape in shapes:
+        Benchmark(*shape, repeat=args.repeat, latency=args.latency,
+                  enoent=args.enoent, enoent_files=enoent_files,
+                  agents=agents).run()
+
+
+if __name__ == '__main__':
+    main()
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
@@ -0,0 +1,394 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Helpers for inspecting the block devices behind our storage objects through
+sysfs.
+"""
+
+import os
+import re
+import stat
+import subprocess
+import time
+
+from ocf_rtslib import timing
+
+SYS_DEV_BLOCK = '/sys/dev/block'
+
+#: Matches the time taken in dd's summary, e.g. "4096 bytes (4.1 kB, 4.0 KiB)
+#: copied, 3.0769e-05 s, 133 MB/s".
+DD_ELAPSED_RE = re.compile(r' copied, ([0-9.eE+-]+) s')
+
+#: The queue limits read by queue_limits().
+QUEUE_LIMITS = [
+    'discard_granularity',
+    'discard_max_bytes',
+    'logical_block_size',
+    'max_hw_sectors_kb',
+    'max_sectors_kb',
+    'nr_requests',
+    'optimal_io_size',
+    'rotational',
+    'write_cache',
+]
+
+
+def sysfs_path(device, sys_dev_block=SYS_DEV_BLOCK):
+    """
+    Return the sysfs directory of the block device `device` (any path to the
+    device node), or None if it isn't a block device.
+    """
+    try:
+        st = os.stat(device)
+    except OSError:
+        return None
+
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+
+    path = os.path.join(sys_dev_block, "{0}:{1}".format(
+        os.major(st.st_rdev), os.minor(st.st_rdev)))
+    if not os.path.isdir(path):
+        return None
+
+    return os.path.realpath(path)
+
+
+def backing_sysfs_path(path):
+    """
+    Return the sysfs directory of the block device holding `path`: the device
+    itself for a device node, or the device of its filesystem for a file.
+    Returns None if there isn't one (tmpfs or NFS, say).
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if stat.S_ISBLK(st.st_mode):
+        dev = st.st_rdev
+    else:
+        dev = st.st_dev
+
+    sysfs = os.path.join(SYS_DEV_BLOCK, "{0}:{1}".format(os.major(dev),
+                                                         os.minor(dev)))
+    if not os.path.isdir(sysfs):
+        return None
+
+    return os.path.realpath(sysfs)
+
+
+def queue_path(sysfs_dir):
+    """
+    Return the queue directory for the device at `sysfs_dir`. Partitions
+    share the queue of the whole disk.
+    """
+    if os.path.exists(os.path.join(sysfs_dir, 'partition')):
+        sysfs_dir = os.path.dirname(sysfs_dir)
+
+    return os.path.join(sysfs_dir, 'queue')
+
+
+def queue_limits(sysfs_dir):
+    """
+    Read the request queue limits of the device at `sysfs_dir`, returning a
+    dictionary of limit name => value (as a string). Limits the kernel
+    doesn't provide are left out.
+    """
+    path = queue_path(sysfs_dir)
+    limits = {}
+
+    for name in QUEUE_LIMITS:
+        try:
+            with open(os.path.join(path, name), 'r') as fp:
+                limits[name] = fp.read().strip()
+        except IOError:
+            continue
+
+    return limits
+
+
+def _int_limit(limits, name):
+    try:
+        return int(limits[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def iblock_attributes(limits, current=None):
+    """
+    Derive iblock storage object attributes to match the given queue limits.
+
+    Returns a list of (name, value) pairs. If `current` (as returned by
+    configfs.read_attributes()) is given, only attributes the storage object
+    actually has are included, and values are capped to the hardware limits
+    the target core reports.
+    """
+    result = []
+
+    block_size = _int_limit(limits, 'logical_block_size') or 512
+
+    # Both are in kilobytes in sysfs but in logical blocks in LIO
+    max_sectors = _int_limit(limits, 'max_sectors_kb')
+    if max_sectors:
+        max_sectors = max_sectors * 1024 // block_size
+        hw_max_sectors = _int_limit(current or {}, 'hw_max_sectors')
+        if hw_max_sectors:
+            max_sectors = min(max_sectors, hw_max_sectors)
+        result.append(('max_sectors', max_sectors))
+
+    # optimal_io_size is in bytes, and 0 if the device doesn't say
+    optimal = _int_limit(limits, 'optimal_io_size')
+    if optimal:
+        optimal = optimal // block_size
+        if max_sectors:
+            optimal = min(optimal, max_sectors)
+        result.append(('optimal_sectors', optimal))
+
+    # Advertise UNMAP and WRITE SAME with UNMAP if the device can discard
+    discard = _int_limit(limits, 'discard_max_bytes')
+    if discard is not None:
+        result.append(('emulate_tpu', int(discard > 0)))
+        result.append(('emulate_tpws', int(discard > 0)))
+
+    rotational = _int_limit(limits, 'rotational')
+    if rotational is not None:
+        result.append(('is_nonrot', int(not rotational)))
+
+    write_cache = limits.get('write_cache')
+    if write_cache is not None:
+        result.append(('emulate_write_cache',
+                       int(write_cache == 'write back')))
+
+    queue_depth = _int_limit(limits, 'nr_requests')
+    if queue_depth:
+        hw_queue_depth = _int_limit(current or {}, 'hw_queue_depth')
+        if hw_queue_depth:
+            queue_depth = min(queue_depth, hw_queue_depth)
+        result.append(('queue_depth', queue_depth))
+
+    if current is not None:
+        result = [(name, value) for name, value in result if name in current]
+
+    return [(name, str(value)) for name, value in result]
+
+
+#: The fields of a block device's stat file, in order (see
+#: Documentation/block/stat.txt). Newer kernels add more after these.
+STAT_FIELDS = [
+    'read_ios',
+    'read_merges',
+    'read_sectors',
+    'read_ticks',
+    'write_ios',
+    'write_merges',
+    'write_sectors',
+    'write_ticks',
+    'in_flight',
+    'io_ticks',
+    'time_in_queue',
+]
+
+
+def read_stat(sysfs_dir):
+    """
+    Read the I/O statistics of the device at `sysfs_dir`, returning a
+    dictionary of STAT_FIELDS names to values, or None if they can't be read.
+    """
+    try:
+        with open(os.path.join(sysfs_dir, 'stat'), 'r') as fp:
+            values = [int(x) for x in fp.read().split()]
+    except (IOError, ValueError):
+        return None
+
+    if len(values) < len(STAT_FIELDS):
+        return None
+
+    return dict(zip(STAT_FIELDS, values))
+
+
+def average_latency(previous, current):
+    """
+    Work out the average time in milliseconds that the reads and writes
+    completed between two read_stat() samples took, or None if there were
+    none (or either sample is missing).
+    """
+    if not previous or not current:
+        return None
+
+    ios = (current['read_ios'] - previous['read_ios'] +
+           current['write_ios'] - previous['write_ios'])
+    ticks = (current['read_ticks'] - previous['read_ticks'] +
+             current['write_ticks'] - previous['write_ticks'])
+
+    # The counters go backwards if the device was replaced
+    if ios <= 0 or ticks < 0:
+        return None
+
+    return ticks / float(ios)
+
+
+def _dd_elapsed(output):
+    """
+    Return the time dd reports its copy took from its summary on stderr, or
+    None if it didn't report one (not every dd does).
+    """
+    match = DD_ELAPSED_RE.search(output)
+    if match is None:
+        return None
+
+    try:
+        return float(match.group(1))
+    except ValueError:
+        return None
+
+
+def probe_read(path, deadline, size=4096):
+    """
+    Read `size` bytes from the start of `path` with O_DIRECT, bypassing the
+    page cache, and return the number of seconds it took; or None if the
+    read didn't finish by `deadline` (a time.time() value).
+
+    The read is done by dd in a child process. A read from a hung device can
+    block uninterruptibly, and we have to be able to walk away from it and
+    report the failure before our own timeout. The time returned is the one
+    dd measures around the read itself, so it doesn't include starting dd.
+    Raises IOError if the read fails.
+    """
+    timing.count('subprocess')
+    start = time.time()
+
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(
+            ['dd', 'if=' + path, 'of=/dev/null', 'bs={0}'.format(size),
+             'count=1', 'iflag=direct'],
+            stdout=devnull, stderr=subprocess.PIPE,
+            env=dict(os.environ, LC_ALL='C'))
+
+    delay = 0.001
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            # Don't wait for it; it may never die. If it does die straight
+            # away, don't leave it a zombie for the rest of the action.
+            proc.kill()
+            proc.poll()
+            return None
+
+        time.sleep(min(delay, max(0, deadline - time.time())))
+        delay = min(delay * 2, 0.1)
+
+    elapsed = time.time() - start
+    output = proc.stderr.read().decode('utf-8', 'replace').strip()
+
+    if proc.returncode != 0:
+        raise IOError("Read from {path} failed: {message}".format(
+            path=path, message=output.splitlines()[0] if output else
+            "dd exited with status {0}".format(proc.returncode)))
+
+    reported = _dd_elapsed(output)
+    return elapsed if reported is None else reported
+
+
+def io_errors(sysfs_dir):
+    """
+    Return the number of I/O errors the SCSI disk at `sysfs_dir` has
+    reported, or None if it doesn't count them (only SCSI devices do).
+    """
+    try:
+        with open(os.path.join(sysfs_dir, 'device', 'ioerr_cnt'), 'r') as fp:
+            return int(fp.read().strip(), 0)
+    except (IOError, ValueError):
+        return None
+
+
+class HealthScore(object):
+    """
+    Scores how well a block device is performing, from 0 (failing) to
+    MAX_SCORE (idle and fast), for weighting master scores.
+
+    The score falls with the average I/O latency and the number of requests
+    in flight, smoothed across samples, and drops to 0 for a while whenever
+    the device reports new I/O errors. To keep the master from flapping
+    between nodes, a new score is only published once it has moved at least
+    `hysteresis` from the last one, and the current master adds `hysteresis`
+    to its own score.
+    """
+
+    MAX_SCORE = 999
+
+    #: Weight given to each new sample when smoothing.
+    SMOOTHING = 0.3
+
+    #: Latency (ms) and requests in flight at which the score halves.
+    LATENCY_SCALE = 10.0
+    QUEUE_SCALE = 32.0
+
+    #: Number of samples to hold the score at 0 after an I/O error.
+    ERROR_HOLD = 30
+
+    def __init__(self, state, hysteresis):
+        self.state = state
+        self.hysteresis = hysteresis
+
+    def _smooth(self, previous, value):
+        if value is None:
+            return previous
+        if previous is None:
+            return float(value)
+        return self.SMOOTHING * value + (1 - self.SMOOTHING) * previous
+
+    def update(self, stat, errors=None, master=False):
+        """
+        Take a new read_stat() sample (and io_errors() count) and return the
+        score to publish.
+        """
+        previous = self.state.load(default={})
+
+        latency = self._smooth(previous.get('latency'),
+                               average_latency(previous.get('stat'), stat))
+        queue = self._smooth(previous.get('queue'),
+                             stat['in_flight'] if stat else None)
+
+        hold = max(previous.get('hold', 0) - 1, 0)
+        last_errors = previous.get('errors')
+        if errors is not None and last_errors is not None and \
+           errors > last_errors:
+            hold = self.ERROR_HOLD
+
+        if hold:
+            score = 0
+        else:
+            score = int(self.MAX_SCORE /
+                        ((1 + (latency or 0) / self.LATENCY_SCALE) *
+                         (1 + (queue or 0) / self.QUEUE_SCALE)))
+
+        # Errors take effect at once; anything else has to be a big enough
+        # change to be worth publishing
+        published = previous.get('score')
+        if published is None or hold or \
+           abs(score - published) >= self.hysteresis:
+            published = score
+
+        self.state.save({'stat': stat, 'errors': errors, 'latency': latency,
+                         'queue': queue, 'hold': hold, 'score': published})
+
+        if master and not hold:
+            return min(published + self.hysteresis, self.MAX_SCORE)
+        return published
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
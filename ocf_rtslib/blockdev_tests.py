@@ -0,0 +1,128 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ocf_rtslib import blockdev
+from ocf_rtslib.util import StateFile
+
+NVME_LIMITS = {
+    'discard_max_bytes': '2199023255040',
+    'logical_block_size': '4096',
+    'max_sectors_kb': '512',
+    'nr_requests': '1023',
+    'optimal_io_size': '131072',
+    'rotational': '0',
+    'write_cache': 'write back',
+}
+
+
+class BlockDevTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_queue_limits_of_partition(self):
+        disk = os.path.join(self.tmpdir, 'sda')
+        part = os.path.join(disk, 'sda1')
+        os.makedirs(os.path.join(disk, 'queue'))
+        os.mkdir(part)
+        with open(os.path.join(part, 'partition'), 'w') as fp:
+            fp.write('1\n')
+        with open(os.path.join(disk, 'queue', 'rotational'), 'w') as fp:
+            fp.write('1\n')
+
+        self.assertEqual(blockdev.queue_limits(part), {'rotational': '1'})
+
+    def test_not_a_block_device(self):
+        self.assertIsNone(blockdev.sysfs_path(self.tmpdir))
+        self.assertIsNone(blockdev.sysfs_path(
+            os.path.join(self.tmpdir, 'missing')))
+
+    def test_average_latency(self):
+        with open(os.path.join(self.tmpdir, 'stat'), 'w') as fp:
+            fp.write("  110 0 880 250  20 0 160 150  3 400 400 0 0 0 0\n")
+        current = blockdev.read_stat(self.tmpdir)
+        self.assertEqual(current['in_flight'], 3)
+
+        previous = dict(current, read_ios=100, read_ticks=200)
+        self.assertEqual(blockdev.average_latency(previous, current), 5.0)
+        self.assertIsNone(blockdev.average_latency(current, current))
+        self.assertIsNone(blockdev.average_latency(None, current))
+
+    def test_health_score(self):
+        score = blockdev.HealthScore(
+            StateFile(os.path.join(self.tmpdir, 'health')), hysteresis=50)
+
+        def sample(ios, ticks, in_flight=0):
+            stat = dict((name, 0) for name in blockdev.STAT_FIELDS)
+            stat.update(read_ios=ios, read_ticks=ticks, in_flight=in_flight)
+            return stat
+
+        self.assertEqual(score.update(sample(0, 0), errors=0), 999)
+
+        # Small changes are damped by the hysteresis
+        self.assertEqual(score.update(sample(100, 10), errors=0), 999)
+        self.assertEqual(score.update(sample(100, 10), errors=0, master=True),
+                         999)
+
+        # A slow device loses score
+        self.assertLess(score.update(sample(200, 5000), errors=0), 700)
+
+        # Errors drop it to zero straight away, and hold it there
+        self.assertEqual(score.update(sample(300, 5100), errors=1), 0)
+        self.assertEqual(score.update(sample(400, 5200), errors=1), 0)
+
+    def test_probe_read_failure(self):
+        with self.assertRaises(IOError):
+            blockdev.probe_read(os.path.join(self.tmpdir, 'missing'),
+                                time.time() + 10)
+
+    def test_dd_elapsed(self):
+        self.assertEqual(blockdev._dd_elapsed(
+            "1+0 records in\n1+0 records out\n4096 bytes (4.1 kB, 4.0 KiB) "
+            "copied, 3.0769e-05 s, 133 MB/s"), 3.0769e-05)
+        self.assertIsNone(blockdev._dd_elapsed("1+0 records in"))
+
+    def test_iblock_attributes(self):
+        self.assertEqual(blockdev.iblock_attributes(NVME_LIMITS), [
+            ('max_sectors', '128'),
+            ('optimal_sectors', '32'),
+            ('emulate_tpu', '1'),
+            ('emulate_tpws', '1'),
+            ('is_nonrot', '1'),
+            ('emulate_write_cache', '1'),
+            ('queue_depth', '1023'),
+        ])
+
+    def test_iblock_attributes_capped(self):
+        current = {'max_sectors': '1024', 'hw_max_sectors': '64',
+                   'optimal_sectors': '1024', 'queue_depth': '128',
+                   'hw_queue_depth': '128', 'emulate_write_cache': '0'}
+
+        self.assertEqual(blockdev.iblock_attributes(NVME_LIMITS, current), [
+            ('max_sectors', '64'),
+            ('optimal_sectors', '32'),
+            ('emulate_write_cache', '1'),
+            ('queue_depth', '128'),
+        ])
@@ -0,0 +1,582 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import ocf
+import os
+
+from ocf.util import cached_property
+from ocf_rtslib import configfs, stats, timing, util
+from ocf_rtslib.backstore import (
+    STATE_PREFIX, BackStoreAgent, LockTimeout, MasterScore,
+    role_change_failed)
+
+# RTSLib is slow to import and many actions never need it
+rtslib = util.LazyModule('rtslib')
+
+#: Human-readable names for the statuses we report per LUN.
+STATUS_NAMES = {
+    ocf.OCF_SUCCESS: 'running',
+    ocf.OCF_NOT_RUNNING: 'not running',
+    ocf.OCF_RUNNING_MASTER: 'master',
+    ocf.OCF_FAILED_MASTER: 'failed master',
+    ocf.OCF_ERR_GENERIC: 'failed',
+}
+
+
+class BulkMember(BackStoreAgent):
+    """
+    A single LUN managed as part of a BulkBackStoreAgent.
+
+    This reuses all of BackStoreAgent's per-LUN logic, but takes the LUN
+    definition from the parent's ``luns`` list rather than the environment,
+    and shares the parent's configfs index, HBA allocators and state.
+    """
+
+    # Shadow BackStoreAgent's per-LUN parameters with plain attributes
+    hba_type = None
+    name = None
+    device = None
+    unit_serial = None
+
+    def __init__(self, parent, hba_type, name, device, unit_serial):
+        # This is not an agent in its own right, so we deliberately don't
+        # call ResourceAgent.__init__()
+        self.parent = parent
+        self.hba_type = hba_type
+        self.name = name
+        self.device = device
+        self.unit_serial = unit_serial
+
+    @property
+    def so_index(self):
+        return self.parent.so_index
+
+    def _hba_allocator(self, hba_type):
+        return self.parent.hba_allocator(hba_type)
+
+    def _state_file(self, kind):
+        return self.parent._state_file("{name}.{kind}".format(
+            name=self.name, kind=kind))
+
+    def _update_master_score(self, status, force=False):
+        # The parent publishes a single score for the whole group
+        pass
+
+
+class BulkBackStoreAgent(ocf.ResourceAgent):
+    """
+    Manages a group of Linux SCSI Target backing devices (LUNs)
+
+    The bulk-backstore resource manages many Linux-IO (LIO) backing LUNs in
+    one resource. Each LUN is handled exactly as by the backstore resource
+    agent, but all of them are created, monitored and removed by a single
+    process, sharing configfs scans and locks.
+
+    This resource can be run as a single primitive or as a multistate
+    (master/slave) resource. When used in multistate mode, every LUN in the
+    group is promoted and demoted together, and notifications (notify=true)
+    keep the other nodes' ALUA port group states up to date.
+    """
+
+    luns = ocf.Parameter(
+        required=True, unique=True, shortdesc='LUNs to manage',
+        longdesc="""
+The LUNs to manage, separated by spaces. Each LUN is given as
+hba_type/name/device/unit_serial, with the same meaning as the parameters of
+the same names of the backstore resource agent, for example
+iblock/vol0//dev/vg0/vol0/5c1c3c4e-4d4b-4b4e-9d86-6f1b1a4c7f21
+        """)
+
+    attrib = ocf.Parameter(
+        shortdesc='Backing store attributes',
+        longdesc="""
+Backing store attributes to set on every LUN, in key=value form, separated by
+spaces. Attributes not listed here will use default values set in the kernel.
+        """)
+
+    auto_tune = ocf.Parameter(
+        default='false', shortdesc='Tune attributes to the backing devices',
+        longdesc="""
+For iblock LUNs, derive attributes such as max_sectors, optimal_sectors,
+emulate_tpu, emulate_tpws, is_nonrot, emulate_write_cache and queue_depth from
+the request queue limits of each backing block device. Any attribute given
+explicitly in attrib takes precedence.
+        """)
+
+    attrib_drift = ocf.Parameter(
+        default='report', shortdesc='Attribute drift policy',
+        longdesc="""
+What to do when a deep monitor (OCF_CHECK_LEVEL 10 or more) finds that a LUN's
+attributes no longer match those given in attrib. One of 'ignore', 'report'
+(log a warning) or 'repair' (log a warning and write the requested values
+back).
+        """)
+
+    alua_hosts = ocf.Parameter(
+        shortdesc='List of hosts this resource may run on',
+        longdesc="""
+This attribute is required when running in multistate mode and ignored
+otherwise. It is a space separated list of hostnames that this resource might
+run on, which is used to generate consistent ALUA port group IDs.
+        """)
+
+    master_score_refresh = ocf.Parameter(
+        default='6', shortdesc='Master score refresh interval',
+        longdesc="""
+When running in multistate mode, the master score is only published when it
+changes. This sets how many consecutive monitor operations may skip publishing
+an unchanged score before it is sent again anyway.
+        """)
+
+    master_score_mode = ocf.Parameter(
+        default='ports', shortdesc='Master score mode',
+        longdesc="""
+How to work out the master score in multistate mode. With 'ports' it is 1000
+times the number of target ports the LUN is exported through. With
+'performance' the health of the local backing device, from 0 to 999, is added
+to that: it falls with the device's recent average I/O latency and queue
+depth, and drops to 0 after I/O errors. Nodes with the same number of ports
+then prefer the one with the better performing device.
+        """)
+
+    master_score_hysteresis = ocf.Parameter(
+        default='100', shortdesc='Master score hysteresis',
+        longdesc="""
+In 'performance' master score mode, how far the device health must move
+before a new score is published. The current master also adds this to its
+score, so another node must do at least this much better to take over.
+        """)
+
+    timing_log = ocf.Parameter(
+        shortdesc='Action timing log',
+        longdesc="""
+Record how long each phase of every action takes, with counts of configfs
+reads and writes and of processes spawned, as one JSON line per action. Give
+the path of a file to append to, or 'ocf-log' to log them through the OCF
+logging functions. Timings are not recorded if this is unset.
+        """)
+
+    timing_threshold = ocf.Parameter(
+        default='0', shortdesc='Action timing log threshold',
+        longdesc="""
+Only record the timings of actions that take at least this many seconds.
+        """)
+
+    latency_threshold = ocf.Parameter(
+        default='0', shortdesc='Backing device latency threshold (ms)',
+        longdesc="""
+Monitor operations of depth 20 read a block from the backing device with
+O_DIRECT, and fail if the read errors or hangs. If this is set, they also fail
+once the latency of that read, or the average latency of all I/O to the device
+since the previous such monitor, has been above this many milliseconds for
+latency_failures monitors running. 0 disables the latency check.
+        """)
+
+    latency_failures = ocf.Parameter(
+        default='3', shortdesc='Backing device latency failure count',
+        longdesc="""
+How many consecutive depth 20 monitors must find the backing device slower
+than latency_threshold before the resource fails. Slow readings before then
+are logged as warnings.
+        """)
+
+    stats_file = ocf.Parameter(
+        shortdesc='Statistics export file',
+        longdesc="""
+Write the I/O statistics that the kernel keeps for these LUNs to this file on
+every monitor, in the Prometheus text format, along with per-second rates since
+the previous monitor. Point this at a .prom file in the node exporter's
+textfile collector directory; each resource needs a file of its own. Statistics
+are not exported if this is unset.
+        """)
+
+    def __init__(self, *args, **kwargs):
+        super(BulkBackStoreAgent, self).__init__(*args, **kwargs)
+        timing.install(self.timing_log, self.timing_threshold, ocf.log.info,
+                       agent='bulk-backstore',
+                       instance=os.environ.get('OCF_RESOURCE_INSTANCE'))
+
+    @cached_property
+    def members(self):
+        """
+        A list of BulkMember objects, one for each entry in ``luns``
+        """
+        result = []
+        seen = set()
+
+        for entry in self.luns.split():
+            try:
+                (hba_type, name, rest) = entry.split('/', 2)
+                (device, unit_serial) = rest.rsplit('/', 1)
+            except ValueError:
+                raise ValueError("Invalid LUN entry: {0}".format(entry))
+
+            if not (hba_type and name and device and unit_serial):
+                raise ValueError("Invalid LUN entry: {0}".format(entry))
+
+            if (hba_type, name) in seen:
+                raise ValueError("Duplicate LUN: {0}/{1}".format(
+                    hba_type, name))
+            seen.add((hba_type, name))
+
+            result.append(BulkMember(self, hba_type, name, device,
+                                     unit_serial))
+
+        return result
+
+    @cached_property
+    def so_index(self):
+        path = "{tmp}/{prefix}.index".format(tmp=ocf.env.rsctmp,
+                                             prefix=STATE_PREFIX)
+        return configfs.StorageObjectIndex(path)
+
+    @cached_property
+    def hba_allocators(self):
+        return {}
+
+    def hba_allocator(self, hba_type):
+        # Share one allocator per HBA type, so that each is only read from
+        # configfs once however many LUNs we create
+        try:
+            return self.hba_allocators[hba_type]
+        except KeyError:
+            allocator = configfs.HBAIndexAllocator(hba_type)
+            self.hba_allocators[hba_type] = allocator
+            return allocator
+
+    def _state_file(self, kind):
+        instance = os.environ.get('OCF_RESOURCE_INSTANCE', 'bulk-backstore')
+        return util.StateFile("{tmp}/{instance}.{kind}".format(
+            tmp=ocf.env.rsctmp, instance=instance, kind=kind))
+
+    @cached_property
+    def master_score(self):
+        return MasterScore(self._state_file('master-score'),
+                           int(self.master_score_refresh))
+
+    @cached_property
+    def role_failure_state(self):
+        return self._state_file('role-failures')
+
+    def _member_statuses(self):
+        statuses = [(member, member._monitor()) for member in self.members]
+
+        for member, status in statuses:
+            ocf.log.debug("{hba}/{name}: {status}".format(
+                hba=member.hba_type, name=member.name,
+                status=STATUS_NAMES.get(status, status)))
+
+        return statuses
+
+    def _report(self, statuses, expected):
+        """
+        Log an error for each LUN whose status is not in `expected`.
+        """
+        for member, status in statuses:
+            if status not in expected:
+                ocf.log.error("{hba}/{name} is {status}".format(
+                    hba=member.hba_type, name=member.name,
+                    status=STATUS_NAMES.get(status, status)))
+
+    def _monitor(self, statuses=None):
+        if statuses is None:
+            statuses = self._member_statuses()
+
+        distinct = set(status for _, status in statuses)
+
+        # All the LUNs agree, whatever their state
+        if len(distinct) == 1:
+            return distinct.pop()
+
+        if ocf.OCF_NOT_RUNNING in distinct or \
+           ocf.OCF_ERR_GENERIC in distinct:
+            # Some LUNs are running, some are not or are broken
+            self._report(statuses, [ocf.OCF_SUCCESS,
+                                    ocf.OCF_RUNNING_MASTER])
+            return ocf.OCF_ERR_GENERIC
+
+        # A mix of master and slave LUNs
+        return ocf.OCF_FAILED_MASTER
+
+    def _update_master_score(self, statuses, force=False):
+        # Only update master score if this is a master/slave resource
+        if not ocf.env.is_ms:
+            return
+
+        # The group is only as good a master as its worst LUN
+        scores = [member._calculate_master_score(status)
+                  for member, status in statuses]
+        score = None if None in scores or not scores else min(scores)
+
+        ocf.log.debug("Setting master score to: {score}".format(score=score))
+        self.master_score.set(score, force)
+
+    @ocf.Action(timeout=120)
+    def start(self):
+        deadline = util.action_deadline(
+            ocf.env.reskey.get('CRM_meta_timeout'), 120)
+
+        # Make sure our basic infrastructure is present; this is the same for
+        # every LUN
+        ret = self.members[0]._setup()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        # Check whether we need to do anything
+        statuses = self._member_statuses()
+        if self._monitor(statuses) == ocf.OCF_SUCCESS:
+            ocf.log.warning("Resource is already running")
+            return ocf.OCF_SUCCESS
+
+        broken = [(member, status) for member, status in statuses
+                  if status not in (ocf.OCF_SUCCESS, ocf.OCF_NOT_RUNNING)]
+        if broken:
+            self._report(broken, [])
+            return ocf.OCF_ERR_GENERIC
+
+        missing = [member for member, status in statuses
+                   if status == ocf.OCF_NOT_RUNNING]
+
+        for member in missing:
+            ret = member._prepare_device()
+            if ret != ocf.OCF_SUCCESS:
+                return ret
+
+        # Take the lock for each HBA type involved just once, always in the
+        # same order, and create all the storage objects under it
+        hba_types = sorted(set(member.hba_type for member in missing))
+        locks = []
+        created = []
+        ret = ocf.OCF_SUCCESS
+
+        try:
+            for hba_type in hba_types:
+                lock = self.members[0]._storage_object_lock(hba_type,
+                                                            deadline)
+                lock.write()
+                locks.append((hba_type, lock))
+
+            for member in missing:
+                try:
+                    so = member._create_storage_object()
+                except (rtslib.RTSLibError, IOError, OSError) as e:
+                    ocf.log.error("{hba}/{name}: failed to create storage "
+                                  "object: {err}".format(
+                                      hba=member.hba_type, name=member.name,
+                                      err=e))
+                    ret = ocf.OCF_ERR_GENERIC
+                    break
+
+                self.so_index.add(member.hba_type, member.name, so.path)
+                created.append((member, so))
+
+                ocf.log.debug("Created storage object: {so.path}".format(
+                    so=so))
+        except LockTimeout as e:
+            ocf.log.error(str(e))
+            return ocf.OCF_ERR_GENERIC
+        finally:
+            for hba_type, lock in reversed(locks):
+                self.members[0]._record_lock_metrics(hba_type, lock)
+                lock.close()
+
+        # Finish setting up whatever we did create, even if we then failed,
+        # so that nothing is left half configured
+        for member, so in created:
+            member._configure_storage_object(so)
+
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        self._update_master_score(self._member_statuses(), force=True)
+        return ocf.OCF_SUCCESS
+
+    @ocf.Action(timeout=240)
+    def stop(self):
+        for member in self.members:
+            member.stop()
+
+        self._update_master_score(
+            [(member, ocf.OCF_NOT_RUNNING) for member in self.members],
+            force=True)
+
+        return ocf.OCF_SUCCESS
+
+    @ocf.Action(timeout=20, depth=0, interval=10)
+    @ocf.Action(timeout=20, depth=0, interval=20, role='Slave')
+    @ocf.Action(timeout=20, depth=0, interval=10, role='Master')
+    @ocf.Action(timeout=60, depth=10, interval=300)
+    @ocf.Action(timeout=120, depth=20, interval=60)
+    def monitor(self):
+        statuses = self._member_statuses()
+        ret = self._monitor(statuses)
+
+        if util.check_level() >= 10:
+            for member, status in statuses:
+                if status in (ocf.OCF_SUCCESS, ocf.OCF_RUNNING_MASTER):
+                    member._check_attributes()
+
+        if util.check_level() >= 20:
+            # Probe every LUN, rather than stopping at the first failure, so
+            # that the log shows all the slow devices
+            deadline = util.action_deadline(
+                ocf.env.reskey.get('CRM_meta_timeout'), 120)
+            failed = [member for member, status in statuses
+                      if status in (ocf.OCF_SUCCESS, ocf.OCF_RUNNING_MASTER)
+                      and not member._check_latency(deadline)]
+            if failed:
+                ret = ocf.OCF_ERR_GENERIC
+
+        if self.stats_file:
+            self._export_stats(statuses)
+
+        self._update_master_score(statuses)
+        return ret
+
+    @timing.timed('stats')
+    def _export_stats(self, statuses):
+        instance = os.environ.get('OCF_RESOURCE_INSTANCE', 'bulk-backstore')
+        samples = []
+        for member, status in statuses:
+            if status in (ocf.OCF_SUCCESS, ocf.OCF_RUNNING_MASTER):
+                samples.extend(stats.storage_object_samples(
+                    member.storage_object_path, resource=instance))
+
+        stats.export(self.stats_file, self._state_file('stats').path, samples,
+                     ocf.log.warning)
+
+    def _change_role(self, verb, target, alua_state, alua_pref):
+        timeout_ms = ocf.env.reskey.get('CRM_meta_timeout')
+        timeout_end = util.action_deadline(timeout_ms, 90, reserve=0)
+        deadline = util.action_deadline(timeout_ms, 90)
+
+        statuses = self._member_statuses()
+        stopped = [(member, status) for member, status in statuses
+                   if status == ocf.OCF_NOT_RUNNING]
+        if stopped:
+            ocf.log.error("Trying to {verb} a resource that was not "
+                          "started!".format(verb=verb))
+            self._report(stopped, [])
+            return role_change_failed(verb, self.role_failure_state,
+                                      timeout_end)
+
+        pending = [member for member, status in statuses if status != target]
+        if pending:
+            ocf.log.info("Attempting to {verb}.".format(verb=verb))
+
+            def check():
+                # Write the ALUA state of every outstanding LUN and check
+                # straight away whether it has taken effect
+                for member in list(pending):
+                    member.set_alua('alua_access_state', alua_state)
+                    member.set_alua('preferred', alua_pref)
+
+                    status = member._monitor()
+                    if status == target:
+                        pending.remove(member)
+                    elif status == ocf.OCF_NOT_RUNNING:
+                        return True
+
+                return not pending
+
+            util.wait_for(check, deadline)
+
+        if pending:
+            self._report([(member, member._monitor()) for member in pending],
+                         [target])
+            return role_change_failed(verb, self.role_failure_state,
+                                      timeout_end)
+
+        ocf.log.info("{verb} successful.".format(verb=verb.capitalize()))
+        self.role_failure_state.remove()
+        self._update_master_score(self._member_statuses(), force=True)
+        return ocf.OCF_SUCCESS
+
+    @ocf.Action(timeout=90)
+    def promote(self):
+        # Set ALUA_ACCESS_STATE_ACTIVE_OPTIMIZED and preferred path
+        return self._change_role('promote', ocf.OCF_RUNNING_MASTER,
+                                 '0\n', '1\n')
+
+    @ocf.Action(timeout=90)
+    def demote(self):
+        # Set ALUA_ACCESS_STATE_STANDBY and no preference
+        return self._change_role('demote', ocf.OCF_SUCCESS, '2\n', '0\n')
+
+    @ocf.Action(timeout=90)
+    def notify(self):
+        if not ocf.env.is_ms:
+            return ocf.OCF_SUCCESS
+
+        reskey = ocf.env.reskey
+        if reskey.get('CRM_meta_notify_type') != 'post' or \
+           reskey.get('CRM_meta_notify_operation') not in ('promote',
+                                                           'demote'):
+            return ocf.OCF_SUCCESS
+
+        masters = self.members[0]._notify_masters()
+        for member in self.members:
+            if member.storage_object_path is not None:
+                member._set_alua_peers(masters)
+
+        return ocf.OCF_SUCCESS
+
+    def validate_all(self):
+        ret = super(BulkBackStoreAgent, self).validate_all()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        try:
+            members = self.members
+        except ValueError as e:
+            ocf.log.error("LUNs list invalid: {0}".format(e))
+            return ocf.OCF_ERR_CONFIGURED
+
+        if not members:
+            ocf.log.error('No LUNs given')
+            return ocf.OCF_ERR_CONFIGURED
+
+        for attr in ['device', 'unit_serial']:
+            values = [getattr(member, attr) for member in members]
+            if len(set(values)) != len(values):
+                ocf.log.error("Each LUN must have a unique {attr}".format(
+                    attr=attr))
+                return ocf.OCF_ERR_CONFIGURED
+
+        ret = members[0]._validate_multistate()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        ret = members[0]._validate_attributes()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        ret = members[0]._validate_latency()
+        if ret != ocf.OCF_SUCCESS:
+            return ret
+
+        for member in members:
+            ret = member._validate_device()
+            if ret != ocf.OCF_SUCCESS:
+                return ret
+
+        return members[0]._setup()
+
+if __name__ == '__main__':
+    BulkBackStoreAgent.main()
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
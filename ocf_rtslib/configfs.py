@@ -0,0 +1,542 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Direct, read-mostly access to the LIO configuration in configfs.
+
+RTSLib builds a full object graph for everything it touches, which is far more
+work than we need just to find out where something lives. The helpers in this
+module look at the configfs directory layout directly.
+"""
+
+import errno
+import os
+import re
+
+from ocf_rtslib import timing
+from ocf_rtslib.util import StateFile
+
+#: Root of the LIO target configuration in configfs. This can be pointed
+#: elsewhere, for example at a FakeConfigFS tree, for testing.
+TARGET_ROOT = os.environ.get('OCF_RTSLIB_TARGET_ROOT',
+                             '/sys/kernel/config/target')
+
+#: Directory holding the target core HBAs and their storage objects.
+CORE_ROOT = os.path.join(TARGET_ROOT, 'core')
+
+#: HBA directories in the core are named <plugin>_<index>, e.g. iblock_0.
+HBA_DIR_RE = re.compile(r'^(?P<plugin>.+)_(?P<index>[0-9]+)$')
+
+#: LUN and mapped LUN directories are named lun_<index>.
+LUN_DIR_RE = re.compile(r'^lun_(?P<index>[0-9]+)$')
+
+
+def listdir(path):
+    """
+    List a configfs directory, treating a vanished directory as empty.
+
+    Things can be deleted from underneath us at any time, so a missing
+    directory is not an error here.
+    """
+    timing.count('configfs_read')
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return []
+        raise
+
+
+def read_file(path):
+    """
+    Read the contents of a configfs attribute file.
+    """
+    timing.count('configfs_read')
+    with open(path, 'r') as fp:
+        return fp.read()
+
+
+def list_hbas(core_root=CORE_ROOT):
+    """
+    Yield (plugin, index, path) for each HBA directory in the target core.
+
+    This uses the directory names only, so it does not depend on the hba_info
+    file that some kernels intermittently fail to provide.
+    """
+    for entry in listdir(core_root):
+        match = HBA_DIR_RE.match(entry)
+        if not match:
+            continue
+
+        path = os.path.join(core_root, entry)
+        if not os.path.isdir(path):
+            continue
+
+        yield (match.group('plugin'), int(match.group('index')), path)
+
+
+def used_hba_indexes(plugin, core_root=CORE_ROOT):
+    """
+    Return the set of HBA indexes in use by the given plugin.
+    """
+    return set(index for (hba_plugin, index, _) in list_hbas(core_root)
+               if hba_plugin == plugin)
+
+
+class HBAIndexAllocator(object):
+    """
+    Hands out unused HBA indexes for a single plugin type.
+
+    The indexes in use are read from configfs once, when the allocator is
+    created. Callers must hold the storage object lock from then until the
+    HBAs for the reserved indexes have been created, otherwise another agent
+    may claim the same index.
+    """
+
+    #: Highest HBA index (exclusive) the target core will accept.
+    MAX_INDEX = 1048576
+
+    def __init__(self, plugin, core_root=CORE_ROOT):
+        self.plugin = plugin
+        self.used = used_hba_indexes(plugin, core_root)
+        self._next = 0
+
+    def reserve(self):
+        """
+        Reserve and return the lowest free index, or None if there are none
+        left.
+        """
+        index = self._next
+        while index in self.used:
+            index += 1
+
+        if index >= self.MAX_INDEX:
+            return None
+
+        self.used.add(index)
+        self._next = index + 1
+        return index
+
+
+def scan_storage_objects(core_root=CORE_ROOT):
+    """
+    Return a dictionary of (plugin, name) => configfs path for every storage
+    object in the target core.
+    """
+    result = {}
+
+    for plugin, _, hba_path in list_hbas(core_root):
+        for name in listdir(hba_path):
+            path = os.path.join(hba_path, name)
+            if os.path.isdir(path):
+                result[(plugin, name)] = path
+
+    return result
+
+
+def parse_storage_object_path(path, core_root=CORE_ROOT):
+    """
+    Split a storage object path into a (plugin, index, name) tuple.
+
+    Returns None if the path does not look like a storage object directory
+    within `core_root`.
+    """
+    (hba_path, name) = os.path.split(os.path.normpath(path))
+    (parent, hba_dir) = os.path.split(hba_path)
+
+    if parent != os.path.normpath(core_root):
+        return None
+
+    match = HBA_DIR_RE.match(hba_dir)
+    if not match or not name:
+        return None
+
+    return (match.group('plugin'), int(match.group('index')), name)
+
+
+def storage_object_configured(path):
+    """
+    Check whether the storage object at `path` is configured (enabled).
+
+    This mirrors RTSLib's StorageObject.is_configured(): storage objects
+    without an enable attribute are always considered enabled.
+    """
+    try:
+        return bool(int(read_file(os.path.join(path, 'enable')).strip()))
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return True
+        raise
+
+
+def read_alua(path, pt_gp_name, prop):
+    """
+    Read an ALUA target port group attribute of the storage object at `path`.
+    """
+    return read_file(os.path.join(path, 'alua', pt_gp_name, prop))
+
+
+def read_attributes(path):
+    """
+    Read every attribute of the storage object at `path` in one pass,
+    returning a dictionary of attribute name => value.
+
+    Attributes that cannot be read (some are write-only) are left out.
+    """
+    attrib_path = os.path.join(path, 'attrib')
+    result = {}
+
+    for name in listdir(attrib_path):
+        try:
+            result[name] = read_file(os.path.join(attrib_path, name)).strip()
+        except IOError:
+            continue
+
+    return result
+
+
+def attribute_changes(desired, current):
+    """
+    Compare the desired attributes, a list of (name, value) pairs, with the
+    `current` attributes as returned by read_attributes().
+
+    Returns a list of (name, value, current_value) tuples for the attributes
+    that differ, in the order they were given. `current_value` is None for an
+    attribute that doesn't exist.
+    """
+    return [(name, value, current.get(name)) for name, value in desired
+            if current.get(name) != value]
+
+
+def write_attribute(path, name, value):
+    """
+    Set an attribute of the storage object at `path`.
+    """
+    timing.count('configfs_write')
+    with open(os.path.join(path, 'attrib', name), 'w') as fp:
+        fp.write(value)
+
+
+class StorageObjectIndex(object):
+    """
+    A persistent cache mapping storage objects to their configfs paths.
+
+    Finding a storage object through RTSLib means walking every backstore and
+    every storage object on the system. This index remembers where each one
+    lives, so that most lookups cost a single stat() of the cached path. Any
+    entry that no longer matches configfs causes the whole index to be
+    rebuilt from a scan of the target core directory.
+
+    The index also remembers which HBA directories existed when it was last
+    rebuilt. While they are unchanged, a storage object missing from the
+    index is taken to be missing from configfs too, so that probing a
+    stopped resource costs one directory listing rather than a full scan.
+    """
+
+    def __init__(self, path, core_root=CORE_ROOT):
+        self.state = StateFile(path)
+        self.core_root = core_root
+        self._entries = None
+        self._hbas = None
+
+    @staticmethod
+    def _key(hba_type, name):
+        return "{0}/{1}".format(hba_type, name)
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            state = self.state.load(default={})
+            if not isinstance(state, dict):
+                state = {}
+
+            entries = state.get('entries')
+            self._entries = entries if isinstance(entries, dict) else {}
+            self._hbas = state.get('hbas')
+
+        return self._entries
+
+    def _list_hbas(self):
+        return sorted(entry for entry in listdir(self.core_root)
+                      if HBA_DIR_RE.match(entry))
+
+    def _is_valid(self, hba_type, name, path):
+        parsed = parse_storage_object_path(path, self.core_root)
+        if parsed is None:
+            return False
+
+        if (parsed[0], parsed[2]) != (hba_type, name):
+            return False
+
+        return os.path.isdir(path)
+
+    def lookup(self, hba_type, name):
+        """
+        Return the configfs path of the given storage object, or None if it
+        does not exist.
+        """
+        path = self.entries.get(self._key(hba_type, name))
+        if path is not None:
+            if self._is_valid(hba_type, name, path):
+                return path
+        elif self._hbas is not None and self._hbas == self._list_hbas():
+            # Nothing has come or gone since the index was built
+            return None
+
+        # The entry is missing or stale; rescan configfs
+        self.rebuild()
+        return self.entries.get(self._key(hba_type, name))
+
+    def rebuild(self):
+        """
+        Rebuild the index from configfs, and persist it if it has changed.
+        """
+        entries = self.entries
+        hbas = self._hbas
+
+        # List the HBAs first, so that any change during the scan makes the
+        # next miss scan again
+        self._hbas = self._list_hbas()
+        scanned = scan_storage_objects(self.core_root)
+        self._entries = dict((self._key(hba_type, name), path)
+                             for (hba_type, name), path in scanned.items())
+
+        if (self._entries, self._hbas) != (entries, hbas):
+            self.save()
+
+    def add(self, hba_type, name, path):
+        self.entries[self._key(hba_type, name)] = path
+        self.save()
+
+    def remove(self, hba_type, name):
+        if self.entries.pop(self._key(hba_type, name), None) is not None:
+            self.save()
+
+    def save(self):
+        """
+        Write the index out. Failing to do so is not fatal; we will simply
+        have to rescan configfs next time.
+        """
+        self.state.save({'entries': self.entries, 'hbas': self._hbas})
+
+
+class TPGSnapshot(object):
+    """
+    A read-only snapshot of a fabric Target Port Group taken straight from
+    configfs.
+
+    This reads just enough of the TPG directory tree to answer whether it is
+    configured as expected, without constructing any RTSLib objects. Use
+    RTSLib to make any changes.
+
+    Attributes:
+
+    ``enable``
+        Whether the TPG is enabled.
+    ``luns``
+        A dictionary of LUN index => storage object path.
+    ``node_acls``
+        A dictionary of initiator WWN => {mapped LUN => TPG LUN index}.
+    ``portals``
+        A set of (ip_address, port) tuples.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.enable = bool(int(read_file(
+            os.path.join(path, 'enable')).strip()))
+        self.luns = self._read_luns()
+        self.node_acls = self._read_node_acls()
+        self.portals = self._read_portals()
+
+    @classmethod
+    def load(cls, fabric, wwn, tag, target_root=TARGET_ROOT):
+        """
+        Snapshot the given TPG, returning None if it does not exist.
+        """
+        path = os.path.join(target_root, fabric, wwn,
+                            "tpgt_{tag}".format(tag=tag))
+        if not os.path.isdir(path):
+            return None
+
+        try:
+            return cls(path)
+        except IOError as e:
+            # The TPG went away while we were looking at it
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    @staticmethod
+    def _lun_dirs(path):
+        for entry in listdir(path):
+            match = LUN_DIR_RE.match(entry)
+            if match:
+                yield (int(match.group('index')), os.path.join(path, entry))
+
+    @staticmethod
+    def _link_target(path):
+        # LUNs and mapped LUNs each contain a single (arbitrarily named)
+        # symlink to the object they refer to. Resolve it lexically: the
+        # links never go through other symlinks, and realpath() costs a
+        # system call for every component of the path, for every link.
+        for entry in listdir(path):
+            link = os.path.join(path, entry)
+            try:
+                target = os.readlink(link)
+            except OSError:
+                continue
+
+            return os.path.normpath(os.path.join(path, target))
+
+        return None
+
+    def _read_luns(self):
+        return dict((index, self._link_target(path)) for index, path
+                    in self._lun_dirs(os.path.join(self.path, 'lun')))
+
+    def _read_node_acls(self):
+        acls_path = os.path.join(self.path, 'acls')
+        node_acls = {}
+
+        for wwn in listdir(acls_path):
+            mapped_luns = {}
+
+            for index, path in self._lun_dirs(os.path.join(acls_path, wwn)):
+                target = self._link_target(path)
+                match = target and LUN_DIR_RE.match(os.path.basename(target))
+                mapped_luns[index] = int(match.group('index')) \
+                    if match else None
+
+            node_acls[wwn] = mapped_luns
+
+        return node_acls
+
+    def _read_portals(self):
+        portals = set()
+
+        for entry in listdir(os.path.join(self.path, 'np')):
+            (ip, _, port) = entry.rpartition(':')
+            if not ip or not port.isdigit():
+                continue
+
+            portals.add((ip.strip('[]'), int(port)))
+
+        return portals
+
+
+class TPGDiff(object):
+    """
+    The differences between a TPGSnapshot and the configuration we want,
+    worked out once for monitor to report and for start to repair.
+
+    `luns` maps LUN indexes to storage object paths, every initiator in
+    `initiators` gets a node ACL with every LUN mapped 1-1, and `portals` is
+    a list of (ip_address, port) tuples. `snapshot` may be None for a TPG
+    that doesn't exist yet.
+
+    Attributes, each a sorted list of what to delete or create to get from
+    the snapshot to the desired configuration:
+
+    ``delete_luns``, ``create_luns``
+        TPG LUN indexes. A LUN pointing at the wrong storage object is in
+        both.
+    ``delete_node_acls``, ``create_node_acls``
+        Initiator WWNs.
+    ``delete_mapped_luns``, ``create_mapped_luns``
+        (initiator WWN, mapped LUN) tuples. Mappings of LUNs that are to be
+        recreated are created again, but not deleted; deleting the TPG LUN
+        takes them with it.
+    ``delete_portals``, ``create_portals``
+        (ip_address, port) tuples.
+
+    ``problems`` lists a message for each difference that means the TPG is
+    not running properly, and ``warnings`` one for each that doesn't.
+    """
+
+    def __init__(self, snapshot, luns, initiators, portals):
+        current_luns = snapshot.luns if snapshot else {}
+        current_acls = snapshot.node_acls if snapshot else {}
+        current_portals = snapshot.portals if snapshot else set()
+
+        self.problems = []
+        self.warnings = []
+
+        self.delete_luns = []
+        self.create_luns = []
+        for lun in sorted(set(current_luns) | set(luns)):
+            if lun not in luns:
+                self.problems.append("Spurious LUN found: {0}".format(lun))
+                self.delete_luns.append(lun)
+            elif lun not in current_luns:
+                self.problems.append("Missing LUN: {0}".format(lun))
+                self.create_luns.append(lun)
+            elif current_luns[lun] != luns[lun]:
+                self.problems.append("Unexpected LUN at index: {0}".format(
+                    lun))
+                self.delete_luns.append(lun)
+                self.create_luns.append(lun)
+
+        recreated = set(self.create_luns)
+        initiators = set(initiators)
+
+        self.delete_node_acls = []
+        self.create_node_acls = []
+        self.delete_mapped_luns = []
+        self.create_mapped_luns = []
+        for wwn in sorted(set(current_acls) | initiators):
+            if wwn not in initiators:
+                self.problems.append("Spurious Node ACL found: {0}".format(
+                    wwn))
+                self.delete_node_acls.append(wwn)
+                continue
+
+            if wwn not in current_acls:
+                self.problems.append("Missing Node ACL: {0}".format(wwn))
+                self.create_node_acls.append(wwn)
+
+            mapped_luns = current_acls.get(wwn, {})
+            for lun in sorted(set(mapped_luns) | set(luns)):
+                if lun not in luns:
+                    self.warnings.append("Spurious LUN mapping found: {0} "
+                                         "{1}".format(wwn, lun))
+                    self.delete_mapped_luns.append((wwn, lun))
+                elif lun not in mapped_luns:
+                    if wwn in current_acls:
+                        self.problems.append("Missing LUN mapping: {0} {1}"
+                                             .format(wwn, lun))
+                    self.create_mapped_luns.append((wwn, lun))
+                elif mapped_luns[lun] != lun:
+                    self.problems.append("LUN mapping not 1-1: {0} {1} != "
+                                         "{2}".format(wwn, lun,
+                                                      mapped_luns[lun]))
+                    self.delete_mapped_luns.append((wwn, lun))
+                    self.create_mapped_luns.append((wwn, lun))
+                elif lun in recreated:
+                    self.create_mapped_luns.append((wwn, lun))
+
+        portals = set(portals)
+        self.delete_portals = sorted(current_portals - portals)
+        self.create_portals = sorted(portals - current_portals)
+        for ip_address, port in self.delete_portals:
+            self.problems.append("Spurious network portal found: {0} {1}"
+                                 .format(ip_address, port))
+        for ip_address, port in self.create_portals:
+            self.problems.append("Missing network portal: {0} {1}".format(
+                ip_address, port))
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
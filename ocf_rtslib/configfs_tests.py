@@ -0,0 +1,293 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ocf_rtslib import configfs
+
+
+class ConfigFSTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.core = os.path.join(self.tmpdir, 'core')
+        os.mkdir(self.core)
+        os.mkdir(os.path.join(self.core, 'alua'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_so(self, plugin, index, name):
+        hba = os.path.join(self.core, "{0}_{1}".format(plugin, index))
+        if not os.path.isdir(hba):
+            os.mkdir(hba)
+            with open(os.path.join(hba, 'hba_info'), 'w') as fp:
+                fp.write("HBA Index: {0} plugin: {1}\n".format(index, plugin))
+
+        path = os.path.join(hba, name)
+        os.mkdir(path)
+        return path
+
+
+class StorageObjectScanTests(ConfigFSTestCase):
+    def test_scan_finds_storage_objects(self):
+        a = self.make_so('iblock', 0, 'vol_a')
+        b = self.make_so('rd_mcp', 3, 'vol_b')
+
+        self.assertEqual(configfs.scan_storage_objects(self.core), {
+            ('iblock', 'vol_a'): a,
+            ('rd_mcp', 'vol_b'): b,
+        })
+
+    def test_scan_missing_core(self):
+        shutil.rmtree(self.core)
+        self.assertEqual(configfs.scan_storage_objects(self.core), {})
+
+    def test_parse_storage_object_path(self):
+        path = self.make_so('fileio', 12, 'vol')
+        self.assertEqual(
+            configfs.parse_storage_object_path(path, self.core),
+            ('fileio', 12, 'vol'))
+
+    def test_parse_foreign_path(self):
+        self.assertIsNone(configfs.parse_storage_object_path(
+            os.path.join(self.tmpdir, 'iblock_0', 'vol'), self.core))
+
+
+class StorageObjectIndexTests(ConfigFSTestCase):
+    def setUp(self):
+        super(StorageObjectIndexTests, self).setUp()
+        self.index_path = os.path.join(self.tmpdir, 'index')
+
+    def new_index(self):
+        return configfs.StorageObjectIndex(self.index_path, self.core)
+
+    def test_lookup_builds_and_persists_index(self):
+        path = self.make_so('iblock', 0, 'vol')
+
+        self.assertEqual(self.new_index().lookup('iblock', 'vol'), path)
+        self.assertTrue(os.path.exists(self.index_path))
+        self.assertEqual(self.new_index().entries, {'iblock/vol': path})
+
+    def test_lookup_missing(self):
+        self.make_so('iblock', 0, 'vol')
+        index = self.new_index()
+
+        self.assertIsNone(index.lookup('fileio', 'vol'))
+        self.assertIsNone(index.lookup('iblock', 'other'))
+
+    def test_miss_after_rebuild_does_not_rescan(self):
+        self.make_so('iblock', 0, 'vol')
+        self.assertIsNone(self.new_index().lookup('iblock', 'other'))
+        os.utime(self.index_path, (0, 0))
+
+        # Without a new HBA, this can only be found by a scan
+        self.make_so('iblock', 0, 'other')
+        self.assertIsNone(self.new_index().lookup('iblock', 'other'))
+        self.assertEqual(os.stat(self.index_path).st_mtime, 0)
+
+    def test_new_hba_is_scanned(self):
+        self.make_so('iblock', 0, 'vol')
+        self.assertIsNone(self.new_index().lookup('iblock', 'other'))
+
+        path = self.make_so('iblock', 1, 'other')
+        self.assertEqual(self.new_index().lookup('iblock', 'other'), path)
+
+    def test_stale_entry_is_rebuilt(self):
+        old = self.make_so('iblock', 0, 'vol')
+        self.new_index().lookup('iblock', 'vol')
+
+        os.rmdir(old)
+        new = self.make_so('iblock', 1, 'vol')
+
+        self.assertEqual(self.new_index().lookup('iblock', 'vol'), new)
+
+    def test_add_and_remove(self):
+        path = self.make_so('iblock', 0, 'vol')
+        index = self.new_index()
+
+        index.add('iblock', 'vol', path)
+        self.assertEqual(self.new_index().entries, {'iblock/vol': path})
+
+        index.remove('iblock', 'vol')
+        self.assertEqual(self.new_index().entries, {})
+
+    def test_corrupt_index_is_ignored(self):
+        path = self.make_so('iblock', 0, 'vol')
+        with open(self.index_path, 'w') as fp:
+            fp.write('not json')
+
+        self.assertEqual(self.new_index().lookup('iblock', 'vol'), path)
+
+
+class HBAIndexAllocatorTests(ConfigFSTestCase):
+    def test_used_indexes_by_plugin(self):
+        self.make_so('iblock', 0, 'a')
+        self.make_so('iblock', 2, 'b')
+        self.make_so('fileio', 1, 'c')
+
+        self.assertEqual(configfs.used_hba_indexes('iblock', self.core),
+                         set([0, 2]))
+
+    def test_reserve_fills_gaps(self):
+        self.make_so('iblock', 0, 'a')
+        self.make_so('iblock', 2, 'b')
+        self.make_so('fileio', 1, 'c')
+
+        allocator = configfs.HBAIndexAllocator('iblock', self.core)
+        self.assertEqual([allocator.reserve() for _ in range(3)], [1, 3, 4])
+
+    def test_reserve_exhausted(self):
+        allocator = configfs.HBAIndexAllocator('iblock', self.core)
+        allocator.used = set(range(allocator.MAX_INDEX))
+
+        self.assertIsNone(allocator.reserve())
+
+
+class TPGSnapshotTests(ConfigFSTestCase):
+    iqn = 'iqn.2015-01.uk.co.tiger-computing:test'
+
+    def setUp(self):
+        super(TPGSnapshotTests, self).setUp()
+        self.tpg = os.path.join(self.tmpdir, 'iscsi', self.iqn, 'tpgt_1')
+        for d in ['lun', 'acls', 'np']:
+            os.makedirs(os.path.join(self.tpg, d))
+
+        with open(os.path.join(self.tpg, 'enable'), 'w') as fp:
+            fp.write('1\n')
+
+    def make_lun(self, index, so_path):
+        path = os.path.join(self.tpg, 'lun', "lun_{0}".format(index))
+        os.mkdir(path)
+        os.symlink(so_path, os.path.join(path, '0123456789'))
+        return path
+
+    def make_mapped_lun(self, wwn, index, lun_path):
+        acl = os.path.join(self.tpg, 'acls', wwn)
+        if not os.path.isdir(acl):
+            os.makedirs(os.path.join(acl, 'fabric_statistics'))
+
+        path = os.path.join(acl, "lun_{0}".format(index))
+        os.mkdir(path)
+        os.symlink(lun_path, os.path.join(path, 'abcdef'))
+
+    def load(self):
+        return configfs.TPGSnapshot.load('iscsi', self.iqn, 1, self.tmpdir)
+
+    def test_missing_tpg(self):
+        self.assertIsNone(configfs.TPGSnapshot.load(
+            'iscsi', self.iqn, 2, self.tmpdir))
+
+    def test_snapshot(self):
+        so_a = self.make_so('iblock', 0, 'a')
+        so_b = self.make_so('fileio', 0, 'b')
+        lun_0 = self.make_lun(0, so_a)
+        lun_1 = self.make_lun(1, so_b)
+        self.make_mapped_lun('iqn.1994-05.com.redhat:client', 0, lun_0)
+        self.make_mapped_lun('iqn.1994-05.com.redhat:client', 1, lun_1)
+        os.mkdir(os.path.join(self.tpg, 'np', '0.0.0.0:3260'))
+        os.mkdir(os.path.join(self.tpg, 'np', '[fe80::1]:3261'))
+
+        tpg = self.load()
+        self.assertTrue(tpg.enable)
+        self.assertEqual(tpg.luns, {0: so_a, 1: so_b})
+        self.assertEqual(tpg.node_acls, {
+            'iqn.1994-05.com.redhat:client': {0: 0, 1: 1},
+        })
+        self.assertEqual(tpg.portals,
+                         set([('0.0.0.0', 3260), ('fe80::1', 3261)]))
+
+    def test_storage_object_configured(self):
+        so = self.make_so('iblock', 0, 'a')
+        self.assertTrue(configfs.storage_object_configured(so))
+
+        with open(os.path.join(so, 'enable'), 'w') as fp:
+            fp.write('0\n')
+        self.assertFalse(configfs.storage_object_configured(so))
+
+    def test_diff(self):
+        client = 'iqn.1994-05.com.redhat:client'
+        so_a = self.make_so('iblock', 0, 'a')
+        so_b = self.make_so('iblock', 1, 'b')
+        lun_0 = self.make_lun(0, so_a)
+        lun_1 = self.make_lun(1, so_a)
+        self.make_mapped_lun(client, 0, lun_0)
+        self.make_mapped_lun(client, 1, lun_1)
+        self.make_mapped_lun(client, 5, lun_0)
+        os.mkdir(os.path.join(self.tpg, 'np', '0.0.0.0:3260'))
+
+        diff = configfs.TPGDiff(self.load(), {0: so_a, 1: so_b, 2: so_b},
+                                [client, 'iqn.1994-05.com.redhat:other'],
+                                [('0.0.0.0', 3260)])
+
+        # LUN 1 points at the wrong storage object, so is recreated along
+        # with its mappings
+        self.assertEqual(diff.delete_luns, [1])
+        self.assertEqual(diff.create_luns, [1, 2])
+        self.assertEqual(diff.delete_node_acls, [])
+        self.assertEqual(diff.create_node_acls,
+                         ['iqn.1994-05.com.redhat:other'])
+        self.assertEqual(diff.delete_mapped_luns, [(client, 5)])
+        self.assertEqual(diff.create_mapped_luns, [
+            (client, 1), (client, 2),
+            ('iqn.1994-05.com.redhat:other', 0),
+            ('iqn.1994-05.com.redhat:other', 1),
+            ('iqn.1994-05.com.redhat:other', 2),
+        ])
+        self.assertEqual(diff.delete_portals, [])
+        self.assertEqual(diff.create_portals, [])
+        self.assertEqual(len(diff.warnings), 1)
+
+        complete = configfs.TPGDiff(self.load(), {0: so_a, 1: so_a},
+                                    [client], [('0.0.0.0', 3260)])
+        self.assertEqual(complete.problems, [])
+
+
+class AttributeTests(ConfigFSTestCase):
+    def setUp(self):
+        super(AttributeTests, self).setUp()
+        self.so = self.make_so('iblock', 0, 'a')
+        os.mkdir(os.path.join(self.so, 'attrib'))
+
+        for name, value in [('block_size', '512'), ('emulate_tpu', '0'),
+                            ('emulate_write_cache', '1')]:
+            with open(os.path.join(self.so, 'attrib', name), 'w') as fp:
+                fp.write(value + '\n')
+
+    def test_read_attributes(self):
+        self.assertEqual(configfs.read_attributes(self.so), {
+            'block_size': '512',
+            'emulate_tpu': '0',
+            'emulate_write_cache': '1',
+        })
+
+    def test_only_changes_are_written(self):
+        desired = [('emulate_write_cache', '0'), ('block_size', '512'),
+                   ('emulate_tpu', '1'), ('no_such_attr', '1')]
+        current = configfs.read_attributes(self.so)
+
+        self.assertEqual(configfs.attribute_changes(desired, current), [
+            ('emulate_write_cache', '0', '1'),
+            ('emulate_tpu', '1', '0'),
+            ('no_such_attr', '1', None),
+        ])
+
+        configfs.write_attribute(self.so, 'emulate_tpu', '1')
+        self.assertEqual(configfs.read_attributes(self.so)['emulate_tpu'],
+                         '1')
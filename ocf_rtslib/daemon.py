@@ -0,0 +1,389 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+An optional per-node daemon that runs agent actions on behalf of the
+``bin/`` entry points.
+
+Every action Pacemaker runs otherwise starts a new Python interpreter and
+imports RTSLib from scratch. The daemon does that once, then forks a child
+for each request, so that each action starts warm. Running each action in
+its own child keeps actions isolated from each other exactly as before, and
+means a misbehaving action can't take the daemon down with it.
+
+The entry points forward their action over a Unix socket if the daemon is
+running, and run it themselves as usual if it isn't. Start the daemon with::
+
+    python -m ocf_rtslib.daemon [socket-path]
+
+The protocol is a single JSON request from the client on one line, and a
+single JSON response::
+
+    {"agent": "backstore", "argv": [...], "env": {...}}
+    {"status": 0, "stdout": "...", "stderr": "..."}
+
+The client keeps its connection open until the response arrives. If it goes
+away first (because lrmd timed it out and killed it, say), the action is
+killed too, as it would have been without the daemon; it is also killed once
+its CRM_meta_timeout has passed. Otherwise a timed out start could carry on
+changing configfs while Pacemaker runs the recovery stop.
+"""
+
+import errno
+import fcntl
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from ocf_rtslib import metadata, timing
+
+#: Default path of the daemon's socket. The bin/ entry points check for this,
+#: and for DISABLE_ENV, themselves before importing this module.
+SOCKET_PATH = '/run/ocf-rtslib.sock'
+
+#: Set this in the environment to make the entry points ignore the daemon.
+DISABLE_ENV = 'OCF_RTSLIB_NO_DAEMON'
+
+#: Modules imported once by the daemon rather than by every action. The agent
+#: modules themselves are imported afresh in each child, once the action's
+#: environment is in place, so that nothing sees the daemon's environment.
+PRELOAD_MODULES = ['rtslib', 'rtslib.utils', 'netaddr']
+
+#: Exit status reported when the daemon fails part way through an action.
+OCF_ERR_GENERIC = 1
+
+#: Returned by Daemon.watch() for an action killed at its deadline.
+TIMED_OUT = -1
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def _recv_line(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if b'\n' in chunk:
+            break
+
+    return b''.join(chunks).split(b'\n', 1)[0]
+
+
+def _deadline(env):
+    """
+    Work out when the action in a request must be killed, from the timeout
+    Pacemaker gave it, or None if it has none.
+    """
+    try:
+        return time.time() + int(env['OCF_RESKEY_CRM_meta_timeout']) / 1000.0
+    except (KeyError, ValueError):
+        return None
+
+
+def _wait_status(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return OCF_ERR_GENERIC
+
+
+def _exit_status(code):
+    # Mirror the interpreter's own handling of SystemExit
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    else:
+        sys.stderr.write("{0}\n".format(code))
+        return 1
+
+
+def run_agent(agent, argv, env, agents=metadata.AGENTS):
+    """
+    Run an agent action in this process, as its entry point would, and
+    return its exit status. This replaces the process environment.
+    """
+    os.environ.clear()
+    os.environ.update(env)
+    sys.argv = argv
+    timing.recorder.reset()
+
+    (module, cls) = agents[agent]
+    try:
+        agent_class = getattr(importlib.import_module(module), cls)
+        agent_class.main()
+    except SystemExit as e:
+        return _exit_status(e.code)
+
+    return 0
+
+
+class Daemon(object):
+    def __init__(self, path=SOCKET_PATH, agents=metadata.AGENTS,
+                 preload=PRELOAD_MODULES):
+        self.path = path
+        self.agents = agents
+        self.preload = preload
+        self.sock = None
+
+    def preload_modules(self):
+        for name in self.preload:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                # The agents report missing modules themselves
+                pass
+
+    def bind(self):
+        # Clear away the socket of a daemon that is no longer running, but
+        # never steal the socket of one that is
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise RuntimeError("daemon already running on {0}".format(
+                    self.path))
+            finally:
+                probe.close()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # Only root may run actions
+        umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+
+        self.sock.listen(128)
+
+    def serve_forever(self):
+        # We never wait for our children; let the kernel reap them
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        while True:
+            try:
+                (conn, _) = self.sock.accept()
+            except socket.error:
+                continue
+
+            if os.fork() == 0:
+                self.sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                status = 0
+                try:
+                    self.handle(conn)
+                except Exception:
+                    status = OCF_ERR_GENERIC
+                finally:
+                    os._exit(status)
+
+            conn.close()
+
+    def handle(self, conn):
+        """
+        Run the requested action and send back its exit status and output.
+
+        The action runs in a child process of its own (in its own process
+        group, to catch anything it spawns), which is killed if the client
+        disconnects or the action's timeout passes.
+        """
+        request = json.loads(_recv_line(conn).decode('utf-8'))
+
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+
+        # The read end of this sees EOF when the action exits. The write end
+        # is closed on exec, so that processes the action runs don't hold it.
+        (exited, running) = os.pipe()
+        flags = fcntl.fcntl(running, fcntl.F_GETFD)
+        fcntl.fcntl(running, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+        pid = os.fork()
+        if pid == 0:
+            status = OCF_ERR_GENERIC
+            try:
+                os.setpgid(0, 0)
+                os.close(exited)
+                conn.close()
+                status = self.run_action(request, stdout, stderr)
+            finally:
+                os._exit(status)
+
+        os.close(running)
+        try:
+            # Do this here too, in case we have to kill it before it does
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+
+        status = self.watch(pid, conn, exited, _deadline(request['env']))
+        if status is None:
+            # The client has gone, so there is nobody to answer
+            conn.close()
+            return
+
+        response = {'status': status}
+        for name, fp in [('stdout', stdout), ('stderr', stderr)]:
+            fp.seek(0)
+            response[name] = fp.read().decode('utf-8', 'replace')
+
+        if status == TIMED_OUT:
+            response['status'] = OCF_ERR_GENERIC
+            response['stderr'] += "ocf-rtslib daemon: action timed out\n"
+
+        conn.sendall(json.dumps(response).encode('utf-8'))
+        conn.close()
+
+    def watch(self, pid, conn, exited, deadline):
+        """
+        Wait for the action in process `pid` to finish, returning its exit
+        status. Kill it, returning TIMED_OUT, if `deadline` passes; or
+        returning None if the client disconnects first.
+        """
+        poller = select.poll()
+        poller.register(exited, select.POLLIN | select.POLLHUP)
+        poller.register(conn, select.POLLIN | select.POLLHUP)
+
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = int(max(0, deadline - time.time()) * 1000)
+
+            try:
+                events = dict(poller.poll(timeout))
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if exited in events:
+                (_, status) = os.waitpid(pid, 0)
+                os.close(exited)
+                return _wait_status(status)
+
+            # The client sends nothing after its request, so any event on
+            # the connection is it closing; no events at all is the deadline
+            self._kill(pid)
+            os.waitpid(pid, 0)
+            os.close(exited)
+            return None if events else TIMED_OUT
+
+    @staticmethod
+    def _kill(pid):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def run_action(self, request, stdout, stderr):
+        """
+        Run the requested action with its output going to the files `stdout`
+        and `stderr`, returning its exit status.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        sys.stdout = os.fdopen(1, 'w')
+        sys.stderr = os.fdopen(2, 'w')
+
+        try:
+            status = run_agent(request['agent'], request['argv'],
+                               request['env'], self.agents)
+        except Exception as e:
+            sys.stderr.write("{0}\n".format(e))
+            status = OCF_ERR_GENERIC
+        finally:
+            # We leave with os._exit(), so atexit handlers never run
+            timing.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        return status
+
+    def run(self):
+        self.preload_modules()
+        self.bind()
+        try:
+            self.serve_forever()
+        finally:
+            self.sock.close()
+            os.unlink(self.path)
+
+
+def forward(agent, argv=None, path=SOCKET_PATH, stdout=None, stderr=None):
+    """
+    Have the daemon run an agent action, copying its output to our own.
+
+    Returns the action's exit status, or None if the daemon isn't running,
+    in which case the caller should run the action itself.
+    """
+    if os.environ.get(DISABLE_ENV) or not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    request = {
+        'agent': agent,
+        'argv': sys.argv if argv is None else argv,
+        'env': dict(os.environ),
+    }
+
+    # Once the daemon has the request we can't run the action ourselves as
+    # well; it may have done something already.
+    try:
+        # Keep our side open: the daemon kills the action if we go away
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        response = json.loads(_recv_all(sock).decode('utf-8'))
+    except (socket.error, ValueError) as e:
+        sys.stderr.write("ocf-rtslib daemon failed: {0}\n".format(e))
+        return OCF_ERR_GENERIC
+    finally:
+        sock.close()
+
+    (stdout or sys.stdout).write(response.get('stdout', ''))
+    (stderr or sys.stderr).write(response.get('stderr', ''))
+    return response.get('status', OCF_ERR_GENERIC)
+
+
+if __name__ == '__main__':
+    Daemon(*sys.argv[1:2]).run()
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
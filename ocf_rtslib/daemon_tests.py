@@ -0,0 +1,186 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import io
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+from ocf_rtslib import daemon
+
+
+class EchoAgent(object):
+    """
+    Stands in for a resource agent: prints its action and exits with the
+    status given in its environment.
+    """
+
+    @classmethod
+    def main(cls):
+        sys.stdout.write("{0} {1}\n".format(
+            sys.argv[1], os.environ.get('OCF_RESOURCE_INSTANCE')))
+        sys.exit(int(os.environ['ECHO_STATUS']))
+
+
+class SleepAgent(object):
+    """
+    Stands in for a resource agent that hangs: records its pid in the file
+    named in its environment, then sleeps.
+    """
+
+    @classmethod
+    def main(cls):
+        with open(os.environ['SLEEP_PIDFILE'], 'w') as fp:
+            fp.write(str(os.getpid()))
+        time.sleep(60)
+
+
+AGENTS = {
+    'echo': ('ocf_rtslib.daemon_tests', 'EchoAgent'),
+    'sleep': ('ocf_rtslib.daemon_tests', 'SleepAgent'),
+}
+
+
+def wait_until(check, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sock')
+        self.pid = None
+
+    def tearDown(self):
+        if self.pid is not None:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+
+        shutil.rmtree(self.tmpdir)
+
+    def start_daemon(self):
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                server = daemon.Daemon(self.path, AGENTS, preload=[])
+                server.bind()
+                server.serve_forever()
+            finally:
+                os._exit(1)
+
+        # Wait for the daemon to accept connections
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                time.sleep(0.01)
+            else:
+                break
+            finally:
+                probe.close()
+
+    def forward(self, status):
+        os.environ['OCF_RESOURCE_INSTANCE'] = 'lun0'
+        os.environ['ECHO_STATUS'] = str(status)
+        out = io.StringIO()
+        try:
+            result = daemon.forward('echo', ['echo', 'monitor'], self.path,
+                                    stdout=out, stderr=io.StringIO())
+        finally:
+            del os.environ['OCF_RESOURCE_INSTANCE']
+            del os.environ['ECHO_STATUS']
+
+        return (result, out.getvalue())
+
+    def test_no_daemon(self):
+        self.assertIsNone(daemon.forward('echo', [], self.path))
+
+    def test_forward(self):
+        self.start_daemon()
+
+        self.assertEqual(self.forward(7), (7, u'monitor lun0\n'))
+        self.assertEqual(self.forward(0), (0, u'monitor lun0\n'))
+
+    def test_stale_socket_is_replaced(self):
+        self.start_daemon()
+        os.kill(self.pid, signal.SIGKILL)
+        os.waitpid(self.pid, 0)
+        self.pid = None
+
+        self.assertIsNone(self.forward(0)[0])
+        self.start_daemon()
+        self.assertEqual(self.forward(0)[0], 0)
+
+    def test_action_killed_when_client_disconnects(self):
+        self.start_daemon()
+        pidfile = os.path.join(self.tmpdir, 'pid')
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(json.dumps({
+            'agent': 'sleep',
+            'argv': ['sleep', 'start'],
+            'env': {'SLEEP_PIDFILE': pidfile},
+        }).encode('utf-8') + b'\n')
+
+        self.assertTrue(wait_until(lambda: os.path.getsize(pidfile)
+                                   if os.path.exists(pidfile) else False))
+        with open(pidfile) as fp:
+            pid = int(fp.read())
+        self.assertTrue(process_exists(pid))
+
+        # As lrmd does when the action times out
+        sock.close()
+        self.assertTrue(wait_until(lambda: not process_exists(pid)))
+
+    def test_action_killed_at_deadline(self):
+        self.start_daemon()
+        os.environ['SLEEP_PIDFILE'] = os.path.join(self.tmpdir, 'pid')
+        os.environ['OCF_RESKEY_CRM_meta_timeout'] = '200'
+        err = io.StringIO()
+        try:
+            start = time.time()
+            result = daemon.forward('sleep', ['sleep', 'start'], self.path,
+                                    stdout=io.StringIO(), stderr=err)
+        finally:
+            del os.environ['SLEEP_PIDFILE']
+            del os.environ['OCF_RESKEY_CRM_meta_timeout']
+
+        self.assertEqual(result, daemon.OCF_ERR_GENERIC)
+        self.assertLess(time.time() - start, 5)
+        self.assertIn('timed out', err.getvalue())
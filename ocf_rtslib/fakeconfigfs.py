@@ -0,0 +1,229 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+A stand-in for the LIO configfs tree, for tests and benchmarks.
+
+FakeConfigFS lays out ordinary directories, files and symlinks in the shape
+of ``/sys/kernel/config/target``. Code that reads configfs through
+ocf_rtslib.configfs can be pointed at it with the root arguments, or by
+setting OCF_RTSLIB_TARGET_ROOT in the environment of an agent. It can also
+inject latency and ENOENT errors into those reads.
+"""
+
+import contextlib
+import errno
+import os
+import random
+import time
+
+from ocf_rtslib import configfs
+
+#: Attributes given to every fake storage object, with their values.
+DEFAULT_ATTRIBUTES = {
+    'block_size': '512',
+    'emulate_tpu': '0',
+    'emulate_write_cache': '0',
+    'hw_max_sectors': '1024',
+    'hw_queue_depth': '128',
+    'max_sectors': '1024',
+    'queue_depth': '128',
+}
+
+
+#: Python code to run an agent action against a FakeConfigFS tree with
+#: faults injected, as faults() only affects the current process. Format it
+#: with the agent's module and class, the tree's root and the arguments to
+#: faults(), and run it with the action as its argument.
+AGENT_SCRIPT = """
+import sys
+sys.argv[0] = {agent!r}
+from ocf_rtslib.fakeconfigfs import FakeConfigFS
+from {module} import {cls}
+with FakeConfigFS({root!r}).faults(**{faults!r}):
+    {cls}.main()
+"""
+
+
+def _write(path, value):
+    with open(path, 'w') as fp:
+        fp.write("{0}\n".format(value))
+
+
+class FakeConfigFS(object):
+    def __init__(self, root):
+        self.root = root
+        self.core = os.path.join(root, 'core')
+
+        if not os.path.isdir(self.core):
+            os.makedirs(os.path.join(self.core, 'alua', 'default_lu_gp'))
+
+    def add_storage_object(self, plugin, index, name, enable=True,
+                           alua=('default_tg_pt_gp',), attributes=None):
+        """
+        Create an HBA (unless it exists) holding a storage object, and return
+        the storage object's path. `alua` names the port groups to create.
+        """
+        hba = os.path.join(self.core, "{0}_{1}".format(plugin, index))
+        if not os.path.isdir(hba):
+            os.mkdir(hba)
+            _write(os.path.join(hba, 'hba_info'), "HBA Index: {0} plugin: "
+                   "{1} version: v4.0".format(index, plugin))
+
+        path = os.path.join(hba, name)
+        os.makedirs(os.path.join(path, 'attrib'))
+        _write(os.path.join(path, 'enable'), int(enable))
+
+        attrs = dict(DEFAULT_ATTRIBUTES)
+        attrs.update(attributes or {})
+        for attr, value in attrs.items():
+            _write(os.path.join(path, 'attrib', attr), value)
+
+        for pt_gp_id, pt_gp_name in enumerate(alua):
+            self.add_alua_ptgp(path, pt_gp_name, pt_gp_id)
+
+        return path
+
+    def add_alua_ptgp(self, so_path, name, pt_gp_id, state=0, preferred=0,
+                      members=()):
+        path = os.path.join(so_path, 'alua', name)
+        os.makedirs(path)
+
+        for prop, value in [('tg_pt_gp_id', pt_gp_id),
+                            ('alua_access_type', 1),
+                            ('alua_access_state', state),
+                            ('preferred', preferred),
+                            ('members', '\n'.join(members))]:
+            _write(os.path.join(path, prop), value)
+
+        return path
+
+    def add_tpg(self, fabric, wwn, tag=1, luns=None, node_acls=None,
+                portals=(), enable=True):
+        """
+        Create a fabric TPG and return its path.
+
+        `luns` maps LUN indexes to storage object paths, `node_acls` maps
+        initiator WWNs to {mapped LUN: TPG LUN} and `portals` is a list of
+        (ip, port) tuples.
+        """
+        path = os.path.join(self.root, fabric, wwn,
+                            "tpgt_{0}".format(tag))
+        for d in ['lun', 'acls', 'np', 'attrib', 'param']:
+            os.makedirs(os.path.join(path, d))
+        _write(os.path.join(path, 'enable'), int(enable))
+
+        for index, so_path in (luns or {}).items():
+            lun = os.path.join(path, 'lun', "lun_{0}".format(index))
+            os.mkdir(lun)
+            os.symlink(so_path, os.path.join(lun, 'storage'))
+            _write(os.path.join(lun, 'alua_tg_pt_gp'), 'default_tg_pt_gp')
+
+        for acl, mapped_luns in (node_acls or {}).items():
+            acl_path = os.path.join(path, 'acls', acl)
+            os.makedirs(os.path.join(acl_path, 'fabric_statistics'))
+
+            for mapped_lun, tpg_lun in mapped_luns.items():
+                mlun = os.path.join(acl_path, "lun_{0}".format(mapped_lun))
+                os.mkdir(mlun)
+                os.symlink(
+                    os.path.join(path, 'lun', "lun_{0}".format(tpg_lun)),
+                    os.path.join(mlun, 'lun'))
+
+        for ip, port in portals:
+            address = "[{0}]".format(ip) if ':' in ip else ip
+            os.mkdir(os.path.join(path, 'np',
+                                  "{0}:{1}".format(address, port)))
+
+        return path
+
+    def populate(self, luns, initiators=0, portals=0, plugin='iblock',
+                 wwn='iqn.2003-01.org.linux-iscsi.test:bench'):
+        """
+        Build a typical configuration: `luns` storage objects, each on its
+        own HBA, and an iSCSI TPG exporting them all to `initiators` ACLs
+        through `portals` network portals.
+
+        Returns a dictionary describing what was created, in the form the
+        agents' parameters take.
+        """
+        names = ["lun{0}".format(i) for i in range(luns)]
+        so_paths = [self.add_storage_object(plugin, i, name)
+                    for i, name in enumerate(names)]
+
+        acls = ["iqn.1994-05.com.redhat:client{0}".format(i)
+                for i in range(initiators)]
+        addresses = [("10.{0}.{1}.{2}".format(i >> 16 & 255, i >> 8 & 255,
+                                              i & 255), 3260)
+                     for i in range(portals)]
+
+        self.add_tpg('iscsi', wwn, luns=dict(enumerate(so_paths)),
+                     node_acls=dict((acl, dict((i, i) for i in range(luns)))
+                                    for acl in acls),
+                     portals=addresses)
+
+        return {
+            'wwn': wwn,
+            'plugin': plugin,
+            'names': names,
+            'so_paths': so_paths,
+            'luns': ' '.join("{0}:{1}/{2}".format(i, plugin, name)
+                             for i, name in enumerate(names)),
+            'initiators': ' '.join(acls),
+            'portals': ' '.join("{0}:{1}".format(ip, port)
+                                for ip, port in addresses),
+        }
+
+    @contextlib.contextmanager
+    def faults(self, latency=0, enoent=0, names=None, seed=0):
+        """
+        Inject faults into ocf_rtslib.configfs reads for the duration of the
+        context.
+
+        Every directory listing and file read is delayed by `latency`
+        seconds. Each file read fails with ENOENT with probability `enoent`,
+        as happens when configfs entries vanish underneath us (or, on Linux
+        4.7, intermittently for hba_info). `names` limits the failures to
+        files with those base names.
+
+        Agent processes don't inherit this; see AGENT_SCRIPT for running an
+        agent with the same faults.
+        """
+        rng = random.Random(seed)
+        listdir = configfs.listdir
+        read_file = configfs.read_file
+
+        def slow_listdir(path):
+            time.sleep(latency)
+            return listdir(path)
+
+        def flaky_read_file(path):
+            time.sleep(latency)
+            if (names is None or os.path.basename(path) in names) and \
+               rng.random() < enoent:
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            return read_file(path)
+
+        configfs.listdir = slow_listdir
+        configfs.read_file = flaky_read_file
+        try:
+            yield self
+        finally:
+            configfs.listdir = listdir
+            configfs.read_file = read_file
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
@@ -0,0 +1,94 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import errno
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ocf_rtslib import benchmark, configfs, fakeconfigfs
+from ocf_rtslib.fakeconfigfs import FakeConfigFS
+
+
+class ReadAgent(object):
+    """
+    Stands in for a resource agent: reads the configfs file named by its
+    argument, exiting with the errno if that fails.
+    """
+
+    @classmethod
+    def main(cls):
+        try:
+            configfs.read_file(sys.argv[1])
+        except IOError as e:
+            sys.exit(e.errno)
+
+
+class FakeConfigFSTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fake = FakeConfigFS(os.path.join(self.tmpdir, 'target'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_populate(self):
+        info = self.fake.populate(3, initiators=2, portals=1)
+
+        self.assertEqual(len(configfs.scan_storage_objects(self.fake.core)),
+                         3)
+
+        tpg = configfs.TPGSnapshot.load('iscsi', info['wwn'], 1,
+                                        self.fake.root)
+        self.assertEqual(tpg.luns, dict(enumerate(info['so_paths'])))
+        self.assertEqual(set(tpg.node_acls), set(info['initiators'].split()))
+        self.assertEqual(tpg.portals, set([('10.0.0.0', 3260)]))
+
+    def test_enoent_injection(self):
+        so = self.fake.add_storage_object('iblock', 0, 'vol')
+        enable = os.path.join(so, 'enable')
+        hba_info = os.path.join(os.path.dirname(so), 'hba_info')
+
+        with self.fake.faults(enoent=1, names=['enable']):
+            with self.assertRaises(IOError) as cm:
+                configfs.read_file(enable)
+            self.assertEqual(cm.exception.errno, errno.ENOENT)
+            self.assertTrue(configfs.read_file(hba_info))
+
+            # A vanished enable attribute reads as enabled, like RTSLib
+            self.assertTrue(configfs.storage_object_configured(so))
+
+        self.assertTrue(configfs.read_file(enable))
+
+    def test_faults_reach_agent_processes(self):
+        so = self.fake.add_storage_object('iblock', 0, 'vol')
+        script = fakeconfigfs.AGENT_SCRIPT.format(
+            agent='read', module='ocf_rtslib.fakeconfigfs_tests',
+            cls='ReadAgent', root=self.fake.root, faults={'enoent': 1})
+
+        ret = subprocess.call([sys.executable, '-c', script,
+                               os.path.join(so, 'enable')])
+        self.assertEqual(ret, errno.ENOENT)
+
+    def test_benchmark_smoke(self):
+        with tempfile.TemporaryFile('w+') as out:
+            benchmark.Benchmark(2, 1, 1, repeat=1, agents=False).run(out)
+            out.seek(0)
+            self.assertEqual(len(out.readlines()), 5)
@@ -0,0 +1,172 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Helpers for fileio backing stores: parsing the device options and preparing
+the backing file.
+"""
+
+import errno
+import os
+import subprocess
+import time
+
+from ocf_rtslib import timing
+
+#: Ways of preparing a fileio backing file before use:
+#:
+#: ``none``
+#:     Leave it to the kernel, as before.
+#: ``sparse``
+#:     Create the file at its full size without allocating any space.
+#: ``fallocate``
+#:     Allocate all the space up front without writing to it.
+#: ``zero``
+#:     Write zeroes to the whole file, so that no write ever has to allocate.
+PREALLOC_MODES = ('none', 'sparse', 'fallocate', 'zero')
+
+#: Chunk size used when zeroing a file.
+ZERO_CHUNK = 1024 * 1024
+
+#: lseek() whences for finding holes. Python 2 doesn't define them, so fall
+#: back to their values on Linux.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+
+def parse_device_options(device):
+    """
+    Split a fileio device parameter string of comma-separated key=value
+    options into a dictionary.
+    """
+    return dict(opt.split('=', 1) for opt in device.split(','))
+
+
+def allocated_size(path):
+    """
+    Return (size, allocated) for the file at `path`: its apparent size and
+    the number of bytes actually allocated on disk. Both are 0 if the file
+    doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (0, 0)
+
+    return (st.st_size, st.st_blocks * 512)
+
+
+def space_needed(path, size, mode):
+    """
+    Return how many more bytes of disk space preallocating `path` to `size`
+    bytes in the given mode would use.
+    """
+    if mode in ('none', 'sparse'):
+        return 0
+
+    (_, allocated) = allocated_size(path)
+    return max(0, size - allocated)
+
+
+def free_space(path):
+    """
+    Return the free space, in bytes, available to us on the filesystem that
+    holds (or would hold) `path`.
+    """
+    st = os.statvfs(os.path.dirname(os.path.abspath(path)))
+    return st.f_bavail * st.f_frsize
+
+
+def _fallocate(fd, path, size):
+    posix_fallocate = getattr(os, 'posix_fallocate', None)
+    if posix_fallocate is not None:
+        posix_fallocate(fd, 0, size)
+    else:
+        timing.count('subprocess')
+        subprocess.check_call(['fallocate', '-l', str(size), path])
+
+
+def _holes(fd, end):
+    """
+    Yield (start, end) for each hole in the first `end` bytes of the open
+    file `fd`.
+    """
+    offset = 0
+    while offset < end:
+        hole = os.lseek(fd, offset, SEEK_HOLE)
+        if hole >= end:
+            break
+
+        try:
+            data = os.lseek(fd, hole, SEEK_DATA)
+        except OSError as e:
+            # The hole runs to the end of the file
+            if e.errno != errno.ENXIO:
+                raise
+            data = end
+
+        yield (hole, min(data, end))
+        offset = data
+
+
+def _zero(fd, start, end):
+    chunk = b'\0' * ZERO_CHUNK
+    os.lseek(fd, start, os.SEEK_SET)
+
+    remaining = end - start
+    while remaining > 0:
+        remaining -= os.write(fd, chunk[:min(remaining, ZERO_CHUNK)])
+
+
+def preallocate(path, size, mode):
+    """
+    Prepare the backing file `path` to be `size` bytes according to `mode`
+    (one of PREALLOC_MODES), returning the number of seconds it took.
+
+    Existing data is never overwritten: an existing file is only ever
+    extended, and ``zero`` only writes to the holes in it and beyond its
+    current end.
+    """
+    start = time.time()
+
+    if mode == 'none':
+        return 0
+
+    (current_size, allocated) = allocated_size(path)
+    if current_size >= size and (mode == 'sparse' or allocated >= size):
+        return time.time() - start
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        if mode == 'zero':
+            end = min(current_size, size)
+            if allocated < end:
+                # Materialise the list first, as writing moves the holes
+                for (hole_start, hole_end) in list(_holes(fd, end)):
+                    _zero(fd, hole_start, hole_end)
+            _zero(fd, current_size, size)
+            os.fsync(fd)
+        elif mode == 'fallocate':
+            _fallocate(fd, path, size)
+        elif current_size < size:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+    return time.time() - start
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
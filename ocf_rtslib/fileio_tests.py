@@ -0,0 +1,75 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ocf_rtslib import fileio
+
+SIZE = 4 * 1024 * 1024
+
+
+class FileIOTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'disk.img')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_device_options(self):
+        self.assertEqual(
+            fileio.parse_device_options(
+                'fd_dev_name=/srv/a=b.img,fd_dev_size=1G'),
+            {'fd_dev_name': '/srv/a=b.img', 'fd_dev_size': '1G'})
+
+    def test_sparse(self):
+        fileio.preallocate(self.path, SIZE, 'sparse')
+        self.assertEqual(os.path.getsize(self.path), SIZE)
+        self.assertEqual(fileio.space_needed(self.path, SIZE, 'sparse'), 0)
+
+    def test_zero_keeps_existing_data(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(b'data')
+
+        fileio.preallocate(self.path, SIZE, 'zero')
+
+        (size, allocated) = fileio.allocated_size(self.path)
+        self.assertEqual(size, SIZE)
+        self.assertGreaterEqual(allocated, SIZE)
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(8), b'data\0\0\0\0')
+
+    def test_zero_fills_holes(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(b'data')
+            fp.truncate(SIZE)
+
+        fileio.preallocate(self.path, SIZE, 'zero')
+
+        (size, allocated) = fileio.allocated_size(self.path)
+        self.assertEqual(size, SIZE)
+        self.assertGreaterEqual(allocated, SIZE)
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(8), b'data\0\0\0\0')
+
+    def test_none_does_nothing(self):
+        fileio.preallocate(self.path, SIZE, 'none')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(fileio.space_needed(self.path, SIZE, 'zero'), SIZE)
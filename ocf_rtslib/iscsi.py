@@ -15,25 +15,22 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import errno
 import ocf
 import os
 import platform
 import re
-import rtslib
-import rtslib.utils
-import subprocess
 import sys
 
-try:
-    import netaddr
-except ImportError:
-    use_netaddr = False
-else:
-    use_netaddr = True
-
 from ocf.util import cached_property
-from rtslib import RTSLibError
+from ocf_rtslib import configfs, kernel, lookup, stats, timing, util
+
+# RTSLib and netaddr are slow to import and many actions never need them
+rtslib = util.LazyModule('rtslib')
+rtslib_utils = util.LazyModule('rtslib.utils')
+netaddr = util.LazyModule('netaddr', required=False)
+
+#: The most differences from the desired configuration that monitor logs.
+MAX_LOGGED_DIFFERENCES = 20
 
 #: List of kernel modules to load to bring up the target. This includes the
 #: target core module as well as any relevant backstore modules.
@@ -51,12 +48,18 @@ class ISCSITargetAgent(ocf.ResourceAgent):
 
     This resource can be run as a single primitive or as a cloned resource,
     but not a multi-state (master/slave) resource.
+
+    Changes to the LUNs, initiators and portals are applied with the reload
+    action, which only adds and removes what has changed, so sessions to the
+    rest of the target carry on undisturbed.
     """
 
     iqn = ocf.Parameter(
-        required=True, shortdesc='iSCSI target IQN', longdesc="""
+        required=True, unique=True, shortdesc='iSCSI target IQN', longdesc="""
 The target iSCSI Qualified Name (IQN). Should follow the conventional
-"iqn.yyyy-mm.<reversed domain name>[:identifier]" syntax.
+"iqn.yyyy-mm.<reversed domain name>[:identifier]" syntax. Changing this
+restarts the resource; changes to any other parameter are applied to the
+running target by the reload action.
         """)
 
     initiators = ocf.Parameter(
@@ -93,6 +96,45 @@ are pairing this RA with the ocf:rtslib:backstore RA running in master/slave
 mode.
         """)
 
+    timing_log = ocf.Parameter(
+        shortdesc='Action timing log',
+        longdesc="""
+Record how long each phase of every action takes, with counts of configfs
+reads and writes and of processes spawned, as one JSON line per action. Give
+the path of a file to append to, or 'ocf-log' to log them through the OCF
+logging functions. Timings are not recorded if this is unset.
+        """)
+
+    timing_threshold = ocf.Parameter(
+        default='0', shortdesc='Action timing log threshold',
+        longdesc="""
+Only record the timings of actions that take at least this many seconds.
+        """)
+
+    workers = ocf.Parameter(
+        default='8', shortdesc='Parallel node ACL configuration',
+        longdesc="""
+How many node ACLs to create and map LUNs to at once when starting or
+reloading. With many initiators and LUNs, doing these in parallel makes start
+much quicker. Set this to 1 to configure them one at a time.
+        """)
+
+    stats_file = ocf.Parameter(
+        shortdesc='Statistics export file',
+        longdesc="""
+Write the I/O statistics that the kernel keeps for this target's LUNs, ports
+and initiator sessions to this file on every monitor, in the Prometheus text
+format, along with per-second rates since the previous monitor. Point this at a
+.prom file in the node exporter's textfile collector directory; each resource
+needs a file of its own. Statistics are not exported if this is unset.
+        """)
+
+    def __init__(self, *args, **kwargs):
+        super(ISCSITargetAgent, self).__init__(*args, **kwargs)
+        timing.install(self.timing_log, self.timing_threshold, ocf.log.info,
+                       agent='iscsi',
+                       instance=os.environ.get('OCF_RESOURCE_INSTANCE'))
+
     @cached_property
     def rtsroot(self):
         return rtslib.RTSRoot()
@@ -116,7 +158,7 @@ mode.
                     yield next(gen)
                 except StopIteration:
                     raise
-                except rtslib.utils.RTSLibNotInCFS:
+                except rtslib_utils.RTSLibNotInCFS:
                     pass
 
         for tgt in _wrapper(self.fabric.targets):
@@ -140,60 +182,49 @@ mode.
         return None
 
     @cached_property
+    def lun_entries(self):
+        """
+        A dictionary of LUN number => (hba_type, name), parsed from ``luns``
+        """
+        result = {}
+        for lun_entry in self.luns.split():
+            (lun, hbaname) = lun_entry.split(':', 1)
+            (hba_type, bs_name) = hbaname.split('/', 1)
+            lun = int(lun)
+
+            if lun in result:
+                raise ValueError("Duplicate LUN number: {0}".format(lun))
+
+            result[lun] = (hba_type, bs_name)
+
+        return result
+
+    @cached_property
+    @timing.timed('storage_object_lookup')
     def storage_objects(self):
         """
         A dictionary of LUN number => storage object
+
+        The storage objects are found with the same single configfs scan as
+        storage_object_paths, and each is then looked up directly through its
+        own backstore rather than by walking every backstore in RTSLib.
         """
-        try:
-            return self.__storage_objects
-        except AttributeError:
-            pass
+        result = {}
 
-        try:
-            result = {}
-            for lun_entry in self.luns.split():
-                (lun, hbaname) = lun_entry.split(':', 1)
-                (hba_type, bs_name) = hbaname.split('/', 1)
-                lun = int(lun)
-
-                if lun in result:
-                    raise ValueError("Duplicate LUN number: {0}".format(lun))
-
-                for bs in self.rtsroot.backstores:
-                    # In Linux 4.7 kernels, the hba_info file in configfs
-                    # intermittently goes missing. If we get an ENOENT, retry a
-                    # few times until it maybe appears.
-                    plugin = None
-                    for i in range(1, 10):
-                        try:
-                            plugin = bs.plugin
-                        except IOError as e:
-                            if e.errno == errno.ENOENT:
-                                continue
-                            raise
-                        else:
-                            break
-
-                    if plugin is None:
-                        continue
-
-                    if plugin != hba_type:
-                        continue
-
-                    for so in bs.storage_objects:
-                        if so.name == bs_name:
-                            result[lun] = so
-                            break
-
-                if lun not in result:
-                    raise ValueError("Backstore not found: {0}".format(
-                        hbaname))
-
-            self.__storage_objects = result
-            return result
-        except RTSLibError:
-            # target core probably isn't loaded
-            return None
+        for lun, path in self.storage_object_paths.iteritems():
+            (plugin, _, name) = configfs.parse_storage_object_path(path)
+            if plugin not in lookup.BACKSTORE_CLASSES:
+                raise ValueError("Unsupported backstore type: {0}".format(
+                    plugin))
+
+            so = lookup.storage_object(path)
+            if so is None:
+                raise ValueError("Backstore not found: {0}/{1}".format(
+                    plugin, name))
+
+            result[lun] = so
+
+        return result
 
     @cached_property
     def alua_ptgp_name(self):
@@ -220,9 +251,9 @@ mode.
         """
         addresses = []
 
-        if use_netaddr:
-            avail_addrs = [netaddr.IPAddress(x) for x in
-                           rtslib.utils.list_eth_ips()]
+        # Only look up the local addresses (and import netaddr) if a subnet
+        # has been given
+        avail_addrs = None
 
         # Inspect each portal address separately
         for portal in self.portals.split():
@@ -237,10 +268,14 @@ mode.
             # Is this a subnet mask?
             if '/' in ip:
                 # We can only handle subnets if we can use netaddr
-                if not use_netaddr:
+                if not netaddr.available:
                     raise ValueError(
                         'Need python netaddr module to use subnets')
 
+                if avail_addrs is None:
+                    avail_addrs = [netaddr.IPAddress(x) for x in
+                                   rtslib_utils.list_eth_ips()]
+
                 # Add all the matching addresses to the list
                 net = netaddr.IPNetwork(ip)
                 for addr in (addr for addr in avail_addrs if addr in net):
@@ -251,34 +286,30 @@ mode.
 
         return addresses
 
+    @timing.timed('setup')
     def _setup(self):
+        iscsi_root = os.path.join(configfs.TARGET_ROOT, 'iscsi')
+
         # Check that the target core is loaded
-        if not os.path.isdir('/sys/kernel/config/target'):
+        if not os.path.isdir(configfs.TARGET_ROOT):
             return ocf.OCF_ERR_INSTALLED
 
-        # Ensure the target modules are loaded
-        if not os.path.isdir('/sys/kernel/config/target/iscsi'):
-            # Get a list of all currently loaded kernel modules
-            with open('/proc/modules', 'r') as fp:
-                loaded_modules = [x.split()[0] for x in fp]
-
-            # Make sure each of the target modules is loaded
-            for mod in TARGET_ISCSI_MODULES:
-                # Skip if already loaded
-                if mod in loaded_modules:
-                    continue
-
-                ret = subprocess.call(['modprobe', mod])
-                if ret:
-                    ocf.log.error("failed to modprobe {mod}".format(mod=mod))
-                    return ocf.OCF_ERR_INSTALLED
+        # Ensure the target modules are loaded. Once the iSCSI target is there
+        # this is all _setup costs, so there's no need for a setup marker.
+        if not os.path.isdir(iscsi_root):
+            # Load all of the missing target modules in one go
+            ret = kernel.load_modules(TARGET_ISCSI_MODULES)
+            if ret:
+                ocf.log.error("failed to modprobe {mods}".format(
+                    mods=' '.join(TARGET_ISCSI_MODULES)))
+                return ocf.OCF_ERR_INSTALLED
 
             # Now that the modules are loaded, the directory may have already
             # appeared or we may have to create it, depending on the kernel
             # version.
-            if not os.path.isdir('/sys/kernel/config/target/iscsi'):
+            if not os.path.isdir(iscsi_root):
                 try:
-                    os.mkdir('/sys/kernel/config/target/iscsi')
+                    os.mkdir(iscsi_root)
                 except OSError:
                     ocf.log.error('failed to create iSCSI target config '
                                   'directory')
@@ -289,43 +320,110 @@ mode.
     @ocf.Action(timeout=40)
     def start(self):
         # Check whether we need to do anything
-        ret = self.monitor()
+        (ret, snapshot, diff) = self._monitor()
         if ret == ocf.OCF_SUCCESS:
             ocf.log.warning('Resource is already running')
             return ret
 
-        # Create the target if it doesn't exist
-        target = self.target
-        if target is None:
-            target = rtslib.Target(self.fabric, wwn=self.iqn, mode='create')
+        with timing.phase('tpg'):
+            # Create the target if it doesn't exist
+            target = self.target
+            if target is None:
+                target = rtslib.Target(self.fabric, wwn=self.iqn,
+                                       mode='create')
 
-        # Create the Target Port Group if it doesn't exist
-        tpg = self.tpg
-        if tpg is None:
-            tpg = rtslib.TPG(target, 1, mode='create')
+            # Create the Target Port Group if it doesn't exist
+            tpg = self.tpg
+            if tpg is None:
+                tpg = rtslib.TPG(target, 1, mode='create')
+                diff = None
 
             # Enable the target as soon as possible. If something goes wrong
             # further down, rtslib will fail to remove a non-enabled TPG, and
             # Pacemaker will fence the node.
-            tpg.enable = True
+            if not tpg.enable:
+                tpg.enable = True
+
+        # If the TPG was already there, only repair what monitor found wrong
+        # with it, so that sessions to everything else carry on undisturbed
+        if diff is None:
+            diff = configfs.TPGDiff(None, self.storage_object_paths,
+                                    self.initiators.split(),
+                                    self.portal_addresses)
+        else:
+            ocf.log.info("Repairing existing TPG")
 
-        # Add the backstore LUNs
+        return self._reconcile(tpg, diff)
+
+    def _reconcile(self, tpg, diff):
+        """
+        Make the changes in `diff` (a configfs.TPGDiff) to the RTSLib TPG
+        `tpg`, returning an OCF status.
+        """
+        node_acls = {}
         luns = {}
-        for lun, so in self.storage_objects.iteritems():
-            lun_obj = rtslib.LUN(tpg, lun, so)
-            luns[lun] = lun_obj
 
-            # Set the ALUA target port group name
-            with open(os.path.join(lun_obj.path, 'alua_tg_pt_gp'), 'w') as fd:
-                fd.write(self.alua_ptgp_name + "\n")
+        def node_acl(wwn):
+            if wwn not in node_acls:
+                node_acls[wwn] = rtslib.NodeACL(tpg, wwn, mode='lookup')
+            return node_acls[wwn]
 
-        # Add the Node ACLs
-        for initiator in self.initiators.split():
-            nacl = rtslib.NodeACL(tpg, initiator, mode='create')
+        def lun(index):
+            if index not in luns:
+                luns[index] = rtslib.LUN(tpg, index)
+            return luns[index]
+
+        # Remove whatever shouldn't be there, mappings first as they hold
+        # references to the LUNs
+        with timing.phase('delete'):
+            for wwn, mapped_lun in diff.delete_mapped_luns:
+                rtslib.MappedLUN(node_acl(wwn), mapped_lun).delete()
+
+            for wwn in diff.delete_node_acls:
+                node_acl(wwn).delete()
+                del node_acls[wwn]
+
+            for index in diff.delete_luns:
+                lun(index).delete()
+                del luns[index]
+
+        # Add the backstore LUNs
+        with timing.phase('luns'):
+            for index in diff.create_luns:
+                lun_obj = rtslib.LUN(tpg, index, self.storage_objects[index])
+                luns[index] = lun_obj
+                self._set_alua_ptgp(lun_obj.path)
+
+        # Add the Node ACLs, and map all of the LUNs to them. Each initiator
+        # is independent of the others, so they are done in parallel; their
+        # mappings are done in turn, as they all go in the same directory.
+        create_node_acls = set(diff.create_node_acls)
+        mappings = {}
+        for wwn, mapped_lun in diff.create_mapped_luns:
+            mappings.setdefault(wwn, []).append((mapped_lun,
+                                                 lun(mapped_lun)))
+
+        def configure_node_acl(wwn):
+            if wwn in create_node_acls:
+                nacl = rtslib.NodeACL(tpg, wwn, mode='create')
+            else:
+                nacl = rtslib.NodeACL(tpg, wwn, mode='lookup')
+
+            for mapped_lun, lun_obj in mappings.get(wwn, []):
+                rtslib.MappedLUN(nacl, mapped_lun, lun_obj)
+
+        with timing.phase('node_acls'):
+            failures = util.run_parallel(
+                configure_node_acl, sorted(create_node_acls | set(mappings)),
+                int(self.workers))
+
+        if failures:
+            for wwn, e in failures:
+                ocf.log.error("Failed to configure node ACL {wwn}: {err}"
+                              .format(wwn=wwn, err=e))
 
-            # Map all of the LUNs to this NACL
-            for mapped_lun, tpg_lun in luns.iteritems():
-                rtslib.MappedLUN(nacl, mapped_lun, tpg_lun)
+            # Keep the portals down until the target is fully configured
+            return ocf.OCF_ERR_GENERIC
 
         # FIXME: We should support authentication properly
         # Disable authentication
@@ -336,9 +434,64 @@ mode.
 
         # Add all the network portals. Do this last so initiators can't login
         # before the target is fully configured.
-        for ip, port in self.portal_addresses:
-            rtslib.NetworkPortal(tpg, ip_address=ip, port=port, mode='create')
+        with timing.phase('portals'):
+            for ip, port in diff.delete_portals:
+                rtslib.NetworkPortal(tpg, ip_address=ip, port=port,
+                                     mode='lookup').delete()
+
+            for ip, port in diff.create_portals:
+                rtslib.NetworkPortal(tpg, ip_address=ip, port=port,
+                                     mode='create')
+
+        return ocf.OCF_SUCCESS
+
+    def _set_alua_ptgp(self, lun_path):
+        # Set the ALUA target port group name
+        timing.count('configfs_write')
+        with open(os.path.join(lun_path, 'alua_tg_pt_gp'), 'w') as fd:
+            fd.write(self.alua_ptgp_name + "\n")
+
+    @ocf.Action(timeout=40)
+    def reload(self):
+        # Bring the running TPG into line with changed parameters, without
+        # disturbing the sessions to LUNs and initiators that haven't changed
+        try:
+            (ret, snapshot, diff) = self._monitor()
+        except ValueError as e:
+            ocf.log.error("LUNs list invalid: {0}".format(e))
+            return ocf.OCF_ERR_GENERIC
+
+        if ret == ocf.OCF_NOT_RUNNING:
+            ocf.log.error("Trying to reload a resource that was not started!")
+            return ocf.OCF_ERR_GENERIC
+
+        tpg = self.tpg
+        if tpg is None:
+            ocf.log.error("TPG disappeared during reload")
+            return ocf.OCF_ERR_GENERIC
+
+        if not tpg.enable:
+            tpg.enable = True
+
+        ret = self._reconcile(tpg, diff)
+        if ret != ocf.OCF_SUCCESS:
+            return ret
 
+        # alua_tpg may have changed too; new LUNs already have the new name
+        for index in set(snapshot.luns) - set(diff.delete_luns):
+            self._set_alua_ptgp(os.path.join(snapshot.path, 'lun',
+                                             "lun_{0}".format(index)))
+
+        ocf.log.info("Reload successful: {luns} LUN(s), {acls} node ACL(s), "
+                     "{mapped} mapped LUN(s) and {portals} portal(s) "
+                     "changed".format(
+                         luns=len(diff.delete_luns) + len(diff.create_luns),
+                         acls=(len(diff.delete_node_acls) +
+                               len(diff.create_node_acls)),
+                         mapped=(len(diff.delete_mapped_luns) +
+                                 len(diff.create_mapped_luns)),
+                         portals=(len(diff.delete_portals) +
+                                  len(diff.create_portals))))
         return ocf.OCF_SUCCESS
 
     @ocf.Action(timeout=60)
@@ -363,101 +516,79 @@ mode.
 
         return ocf.OCF_SUCCESS
 
-    @ocf.Action(timeout=10, depth=0, interval=10)
-    def monitor(self):
-        # Try to locate our TPG object
-        tpg = self.tpg
-        if tpg is None:
-            return ocf.OCF_NOT_RUNNING
+    @cached_property
+    def storage_object_paths(self):
+        """
+        A dictionary of LUN number => storage object configfs path
 
-        if not tpg.enable:
-            ocf.log.error("TPG is not enabled")
-            return ocf.OCF_ERR_GENERIC
+        This is found with a single scan of configfs, without constructing
+        any RTSLib objects.
+        """
+        scanned = configfs.scan_storage_objects()
+        result = {}
 
-        # Check all the LUNs we want are in place
-        storage_objects = self.storage_objects
-        unseen_luns = set(storage_objects.keys())
-        for lun in tpg.luns:
-            # Ensure that we're supposed to have a LUN at this index
+        for lun, (hba_type, bs_name) in self.lun_entries.iteritems():
             try:
-                unseen_luns.remove(lun.lun)
+                result[lun] = scanned[(hba_type, bs_name)]
             except KeyError:
-                ocf.log.error("Spurious LUN found: {0}".format(lun.lun))
-                return ocf.OCF_ERR_GENERIC
-
-            # Check that this LUN's storage object corresponds to the one we
-            # expect in this position
-            if lun.storage_object.path != storage_objects[lun.lun].path:
-                ocf.log.error("Unexpected LUN at index: {0}".format(lun.lun))
-                return ocf.OCF_ERR_GENERIC
-
-        # Check whether we are missing any LUNs
-        if unseen_luns:
-            ocf.log.error("Missing LUN(s)")
-            return ocf.OCF_ERR_GENERIC
+                raise ValueError("Backstore not found: {0}/{1}".format(
+                    hba_type, bs_name))
 
-        # Check all the Node ACLs are in place
-        initiators = set(self.initiators.split())
-        for nacl in tpg.node_acls:
-            # Ensure we're supposed to have this NACL in place
-            try:
-                initiators.remove(nacl.node_wwn)
-            except KeyError:
-                ocf.log.error("Spurious Node ACL found: {0}".format(
-                    nacl.node_wwn))
-                return ocf.OCF_ERR_GENERIC
+        return result
 
-            # Check that all the LUNs are mapped
-            unseen_luns = set(storage_objects.keys())
-            for mlun in nacl.mapped_luns:
-                idx = mlun.mapped_lun
+    @ocf.Action(timeout=10, depth=0, interval=10)
+    def monitor(self):
+        (ret, tpg, diff) = self._monitor()
 
-                # Check for spurious LUN mappings
-                try:
-                    unseen_luns.remove(idx)
-                except KeyError:
-                    ocf.log.error("Spurious LUN mapping found: {0}".format(
-                        idx))
-
-                # Check that the LUN mapping is 1-1
-                if idx != mlun.tpg_lun.lun:
-                    ocf.log.error("LUN mapping not 1-1: {0} != {1}".format(
-                        idx, mlun.tpg_lun.lun))
-                    return ocf.OCF_ERR_GENERIC
-
-                # Check that the LUN mapping points at the LUN we want
-                so = mlun.tpg_lun.storage_object
-                if so.path != storage_objects[idx].path:
-                    ocf.log.error("Unexpected LUN mapping at index {0}".format(
-                        idx))
-                    return ocf.OCF_ERR_GENERIC
-
-            # Check whether we are missing any LUN mappings
-            if unseen_luns:
-                ocf.log.error("Missing LUN mapping(s)")
-                return ocf.OCF_ERR_GENERIC
-
-        # Check for missing ACLs
-        if initiators:
-            ocf.log.error("Missing Node ACL(s)")
-            return ocf.OCF_ERR_GENERIC
+        if ret == ocf.OCF_SUCCESS and self.stats_file:
+            self._export_stats(tpg)
 
-        # Check for Network Portals
-        portals = set(self.portal_addresses)
-        for portal in tpg.network_portals:
-            try:
-                portals.remove((portal.ip_address, portal.port))
-            except KeyError:
-                ocf.log.error("Spurious network portal found: {0} {1}".format(
-                    portal.ip_address, portal.port))
-                return ocf.OCF_ERR_GENERIC
+        return ret
 
-        # Check for missing portals
-        if portals:
-            ocf.log.error("Missing network portal(s)")
-            return ocf.OCF_ERR_GENERIC
+    def _monitor(self):
+        """
+        Compare the TPG in configfs with the configuration we want, returning
+        the monitor status, the TPGSnapshot and the TPGDiff. The snapshot and
+        diff are None if the TPG doesn't exist.
+        """
+        # Monitoring only ever reads configfs directly; building the RTSLib
+        # object graph is far too expensive to do this often.
+        with timing.phase('snapshot'):
+            tpg = configfs.TPGSnapshot.load('iscsi', self.iqn, 1)
+        if tpg is None:
+            return (ocf.OCF_NOT_RUNNING, None, None)
+
+        diff = configfs.TPGDiff(tpg, self.storage_object_paths,
+                                self.initiators.split(),
+                                self.portal_addresses)
+
+        # A badly broken TPG can have thousands of differences; the first
+        # few are enough to go on
+        for (messages, log) in [(diff.warnings, ocf.log.warning),
+                                (diff.problems, ocf.log.error)]:
+            for message in messages[:MAX_LOGGED_DIFFERENCES]:
+                log(message)
+            if len(messages) > MAX_LOGGED_DIFFERENCES:
+                log("... and {0} more".format(
+                    len(messages) - MAX_LOGGED_DIFFERENCES))
 
-        return ocf.OCF_SUCCESS
+        if not tpg.enable:
+            ocf.log.error("TPG is not enabled")
+            return (ocf.OCF_ERR_GENERIC, tpg, diff)
+
+        if diff.problems:
+            return (ocf.OCF_ERR_GENERIC, tpg, diff)
+
+        return (ocf.OCF_SUCCESS, tpg, diff)
+
+    @timing.timed('stats')
+    def _export_stats(self, tpg):
+        instance = os.environ.get('OCF_RESOURCE_INSTANCE', 'iscsi')
+        samples = stats.tpg_samples(tpg.path, resource=instance,
+                                    target=self.iqn)
+        state_path = "{tmp}/{instance}.stats".format(tmp=ocf.env.rsctmp,
+                                                     instance=instance)
+        stats.export(self.stats_file, state_path, samples, ocf.log.warning)
 
     def validate_all(self):
         ret = super(ISCSITargetAgent, self).validate_all()
@@ -485,6 +616,14 @@ mode.
                 ocf.log.error('No valid portal addresses found.')
                 return ocf.OCF_ERR_CONFIGURED
 
+        try:
+            workers = int(self.workers)
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            ocf.log.error('workers must be a whole number, at least 1')
+            return ocf.OCF_ERR_CONFIGURED
+
         try:
             self.storage_objects
         except ValueError as e:
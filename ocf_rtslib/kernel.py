@@ -0,0 +1,121 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Helpers for checking and preparing the kernel environment the agents need,
+without spawning processes unless something actually has to change.
+"""
+
+import os
+import subprocess
+
+from ocf_rtslib import timing
+from ocf_rtslib.util import StateFile
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+
+def module_loaded(name, sys_module='/sys/module'):
+    """
+    Check whether a kernel module is loaded (or built in).
+    """
+    return os.path.isdir(os.path.join(sys_module, name.replace('-', '_')))
+
+
+def load_modules(modules, sys_module='/sys/module'):
+    """
+    Load any of the given kernel modules that aren't already loaded, using a
+    single modprobe call. Returns the modprobe exit status, or 0 if there was
+    nothing to do.
+    """
+    missing = [mod for mod in modules if not module_loaded(mod, sys_module)]
+    if not missing:
+        return 0
+
+    timing.count('subprocess')
+    return subprocess.call(['modprobe', '-a'] + missing)
+
+
+def is_mounted(mountpoint, fstype=None, mounts_path='/proc/mounts'):
+    """
+    Check whether anything (of type `fstype`, if given) is mounted on
+    `mountpoint`.
+    """
+    with open(mounts_path, 'r') as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) < 3 or fields[1] != mountpoint:
+                continue
+
+            if fstype is None or fields[2] == fstype:
+                return True
+
+    return False
+
+
+def mem_available(meminfo_path='/proc/meminfo'):
+    """
+    Return the memory available for new allocations, in bytes, or None if
+    the kernel doesn't report it.
+    """
+    with open(meminfo_path, 'r') as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0] == 'MemAvailable:':
+                # The value is in kB, whatever the unit column says
+                return int(fields[1]) * 1024
+
+    return None
+
+
+def boot_id(path=BOOT_ID_PATH):
+    try:
+        with open(path, 'r') as fp:
+            return fp.read().strip()
+    except IOError:
+        return None
+
+
+class SetupMarker(object):
+    """
+    Records that an agent's environment has been set up since boot.
+
+    Checking and preparing the environment on every operation is comparatively
+    expensive. Once it has succeeded, we drop a marker containing the current
+    boot ID, so that later operations can skip the checks until the next
+    reboot.
+    """
+
+    def __init__(self, path, boot_id_path=BOOT_ID_PATH):
+        self.state = StateFile(path)
+        self.boot_id_path = boot_id_path
+
+    def is_set(self):
+        current = boot_id(self.boot_id_path)
+        if current is None:
+            return False
+
+        marker = self.state.load(default={})
+        return isinstance(marker, dict) and marker.get('boot_id') == current
+
+    def set(self):
+        self.state.save({'boot_id': boot_id(self.boot_id_path)})
+
+    def clear(self):
+        self.state.remove()
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
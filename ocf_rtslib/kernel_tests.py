@@ -0,0 +1,78 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ocf_rtslib import kernel
+
+MOUNTS = """\
+sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0
+configfs /sys/kernel/config configfs rw,relatime 0 0
+"""
+
+
+class KernelTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_is_mounted(self):
+        mounts = self.write('mounts', MOUNTS)
+
+        self.assertTrue(kernel.is_mounted('/sys/kernel/config', 'configfs',
+                                          mounts_path=mounts))
+        self.assertTrue(kernel.is_mounted('/sys', mounts_path=mounts))
+        self.assertFalse(kernel.is_mounted('/sys', 'configfs',
+                                           mounts_path=mounts))
+        self.assertFalse(kernel.is_mounted('/mnt', mounts_path=mounts))
+
+    def test_mem_available(self):
+        meminfo = self.write('meminfo', 'MemTotal:  2048 kB\n'
+                                        'MemAvailable:  1024 kB\n')
+        self.assertEqual(kernel.mem_available(meminfo), 1024 * 1024)
+
+        meminfo = self.write('meminfo', 'MemTotal:  2048 kB\n')
+        self.assertIsNone(kernel.mem_available(meminfo))
+
+    def test_load_modules_nothing_to_do(self):
+        os.mkdir(os.path.join(self.tmpdir, 'target_core_mod'))
+        self.assertTrue(kernel.module_loaded('target-core-mod', self.tmpdir))
+        self.assertEqual(
+            kernel.load_modules(['target_core_mod'], self.tmpdir), 0)
+
+    def test_setup_marker_is_boot_scoped(self):
+        boot_id = self.write('boot_id', 'aaaa\n')
+        marker = kernel.SetupMarker(os.path.join(self.tmpdir, 'marker'),
+                                    boot_id)
+
+        self.assertFalse(marker.is_set())
+        marker.set()
+        self.assertTrue(marker.is_set())
+
+        self.write('boot_id', 'bbbb\n')
+        self.assertFalse(marker.is_set())
@@ -0,0 +1,70 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Look up RTSLib objects directly from their configfs paths.
+
+RTSLib can only find a storage object by walking every backstore in the
+target core. Once a configfs scan (or the storage object index) has told us
+where an object lives, we can construct it through its own backstore
+instead.
+"""
+
+from ocf_rtslib import configfs, timing, util
+
+# RTSLib is slow to import and many actions never need it
+rtslib = util.LazyModule('rtslib')
+
+#: The RTSLib backstore class used to look up each HBA type. This covers
+#: pscsi too, which the backstore agents don't create but the fabric agents
+#: may export.
+BACKSTORE_CLASSES = {
+    'iblock': 'IBlockBackstore',
+    'fileio': 'FileIOBackstore',
+    'pscsi': 'PSCSIBackstore',
+    'rd_mcp': 'RDMCPBackstore',
+}
+
+
+@timing.timed('storage_object_lookup')
+def storage_object(path, core_root=configfs.CORE_ROOT):
+    """
+    Return the RTSLib storage object at the configfs path `path`, or None if
+    it has gone (or isn't a storage object of a type we know).
+    """
+    parsed = configfs.parse_storage_object_path(path, core_root)
+    if parsed is None or parsed[0] not in BACKSTORE_CLASSES:
+        return None
+
+    (plugin, index, name) = parsed
+
+    try:
+        # Look up only the backstore the path points at, rather than walking
+        # every backstore on the system
+        backstore_class = getattr(rtslib, BACKSTORE_CLASSES[plugin])
+        bs = backstore_class(index, mode='lookup')
+
+        for so in bs.storage_objects:
+            if so.name == name:
+                return so
+    except rtslib.RTSLibError:
+        # it was probably deleted since we looked it up
+        pass
+
+    return None
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
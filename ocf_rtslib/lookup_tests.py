@@ -0,0 +1,96 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ocf_rtslib import lookup
+from ocf_rtslib.fakeconfigfs import FakeConfigFS
+
+
+class FakeRTSLibError(Exception):
+    pass
+
+
+class FakeStorageObject(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeRTSLib(object):
+    """
+    Just enough of RTSLib's backstore lookups, listing the storage objects
+    in the HBA directories of a FakeConfigFS.
+    """
+
+    RTSLibError = FakeRTSLibError
+
+    def __init__(self, core):
+        self.core = core
+        self.lookups = []
+
+    def IBlockBackstore(self, index, mode):
+        self.lookups.append(('iblock', index, mode))
+        path = os.path.join(self.core, "iblock_{0}".format(index))
+        if not os.path.isdir(path):
+            raise FakeRTSLibError('No such backstore')
+
+        backstore = type('Backstore', (object,), {})()
+        backstore.storage_objects = [
+            FakeStorageObject(name) for name in sorted(os.listdir(path))
+            if os.path.isdir(os.path.join(path, name))]
+        return backstore
+
+
+class LookupTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fake = FakeConfigFS(os.path.join(self.tmpdir, 'target'))
+        self.rtslib = FakeRTSLib(self.fake.core)
+
+        self.real_rtslib = lookup.rtslib
+        lookup.rtslib = self.rtslib
+
+    def tearDown(self):
+        lookup.rtslib = self.real_rtslib
+        shutil.rmtree(self.tmpdir)
+
+    def test_storage_object(self):
+        self.fake.add_storage_object('iblock', 3, 'a')
+        path = self.fake.add_storage_object('iblock', 4, 'b')
+
+        so = lookup.storage_object(path, self.fake.core)
+        self.assertEqual(so.name, 'b')
+
+        # Only the backstore the path names is looked up
+        self.assertEqual(self.rtslib.lookups, [('iblock', 4, 'lookup')])
+
+    def test_storage_object_gone(self):
+        path = self.fake.add_storage_object('iblock', 0, 'a')
+        shutil.rmtree(os.path.dirname(path))
+
+        self.assertIsNone(lookup.storage_object(path, self.fake.core))
+
+    def test_unknown_path(self):
+        self.assertIsNone(lookup.storage_object(
+            os.path.join(self.fake.core, 'user_0', 'a'), self.fake.core))
+        self.assertIsNone(lookup.storage_object(self.tmpdir,
+                                                self.fake.core))
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
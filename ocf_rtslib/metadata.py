@@ -0,0 +1,113 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Pre-generated OCF meta-data for the resource agents.
+
+The meta-data XML only depends on the agent class definitions, so it is
+generated once when the package is built and shipped alongside the agents.
+The ``bin/`` entry points serve it from there without having to import the
+agent classes at all, and fall back to generating it if it is missing.
+
+Run this module to (re)generate the XML files::
+
+    python -m ocf_rtslib.metadata [output-directory]
+"""
+
+import os
+import subprocess
+import sys
+
+#: Agent name => (module, class) for each resource agent we ship.
+AGENTS = {
+    'backstore': ('ocf_rtslib.backstore', 'BackStoreAgent'),
+    'bulk-backstore': ('ocf_rtslib.bulk', 'BulkBackStoreAgent'),
+    'iscsi': ('ocf_rtslib.iscsi', 'ISCSITargetAgent'),
+}
+
+#: Default directory holding the generated XML files.
+METADATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'metadata')
+
+GENERATE_SCRIPT = """
+import sys
+sys.argv[0] = {agent!r}
+from {module} import {cls}
+{cls}.main()
+"""
+
+
+def metadata_path(agent, directory=METADATA_DIR):
+    return os.path.join(directory, "{0}.xml".format(agent))
+
+
+def generate(agent, cwd=None):
+    """
+    Run the given agent's meta-data action and return its output.
+
+    This runs in a subprocess, exactly as Pacemaker would invoke the agent,
+    so that the output is identical to what the agent produces itself.
+    """
+    (module, cls) = AGENTS[agent]
+    script = GENERATE_SCRIPT.format(agent=agent, module=module, cls=cls)
+
+    proc = subprocess.Popen([sys.executable, '-c', script, 'meta-data'],
+                            stdout=subprocess.PIPE, cwd=cwd)
+    (output, _) = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("{0} meta-data failed: {1}".format(
+            agent, proc.returncode))
+
+    return output
+
+
+def write_all(directory=METADATA_DIR, cwd=None):
+    """
+    Generate the meta-data for all the agents into `directory`.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for agent in sorted(AGENTS):
+        output = generate(agent, cwd=cwd)
+        with open(metadata_path(agent, directory), 'wb') as fp:
+            fp.write(output)
+
+
+def serve(agent, directory=METADATA_DIR):
+    """
+    Write the pre-generated meta-data for `agent` to stdout.
+
+    Returns False if there is no pre-generated meta-data available, in which
+    case the caller should run the agent as normal.
+    """
+    try:
+        with open(metadata_path(agent, directory), 'rb') as fp:
+            output = fp.read()
+    except IOError:
+        return False
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(output)
+    out.flush()
+    return True
+
+
+if __name__ == '__main__':
+    write_all(*sys.argv[1:2])
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
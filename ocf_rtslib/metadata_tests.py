@@ -0,0 +1,82 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ocf_rtslib import metadata
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def require_ocf():
+    try:
+        import ocf  # noqa
+    except ImportError:
+        raise unittest.SkipTest('python-ocf is not installed')
+
+
+class MetadataTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self, agent):
+        stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(io.BytesIO())
+        try:
+            served = metadata.serve(agent, self.tmpdir)
+            sys.stdout.flush()
+            return (served, sys.stdout.buffer.getvalue())
+        finally:
+            sys.stdout = stdout
+
+    def test_write_all(self):
+        require_ocf()
+        metadata.write_all(self.tmpdir)
+
+        for agent in metadata.AGENTS:
+            generated = metadata.generate(agent)
+            self.assertIn(b'<resource-agent', generated)
+
+            with open(metadata.metadata_path(agent, self.tmpdir), 'rb') as fp:
+                self.assertEqual(fp.read(), generated)
+
+            self.assertEqual(self.serve(agent), (True, generated))
+
+    def test_build_py(self):
+        require_ocf()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [sys.executable, 'setup.py', 'build_py', '--build-lib',
+                 self.tmpdir], cwd=SOURCE_DIR, stdout=devnull)
+
+        # This is what gets installed, so it must match the agents exactly
+        directory = os.path.join(self.tmpdir, 'ocf_rtslib', 'metadata')
+        for agent in metadata.AGENTS:
+            with open(metadata.metadata_path(agent, directory), 'rb') as fp:
+                self.assertEqual(fp.read(), metadata.generate(agent))
+
+    def test_serve_missing(self):
+        self.assertEqual(self.serve('backstore'), (False, b''))
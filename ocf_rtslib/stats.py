@@ -0,0 +1,246 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Export LIO I/O statistics from configfs in the Prometheus text format.
+
+The target core keeps SCSI MIB style counters for every storage object
+(``statistics/scsi_lu``), every fabric LUN (``statistics/scsi_tgt_port`` and
+``statistics/scsi_port``) and, for iSCSI, every initiator session
+(``fabric_statistics/iscsi_sess_stats``). The agents collect those for the
+objects they own and write them out for the node exporter's textfile
+collector, together with per-second rates since the previous sample.
+"""
+
+import os
+import time
+
+from ocf_rtslib import configfs
+from ocf_rtslib.util import StateFile
+
+MIB = 1024 * 1024
+
+#: Counters in each storage object's statistics/scsi_lu directory, as
+#: (file, metric, multiplier) tuples.
+LU_COUNTERS = [
+    ('num_cmds', 'lio_lu_commands', 1),
+    ('read_mbytes', 'lio_lu_read_bytes', MIB),
+    ('write_mbytes', 'lio_lu_write_bytes', MIB),
+]
+
+#: Counters in each fabric LUN's statistics/scsi_tgt_port directory.
+TGT_PORT_COUNTERS = [
+    ('in_cmds', 'lio_port_commands', 1),
+    ('read_mbytes', 'lio_port_read_bytes', MIB),
+    ('write_mbytes', 'lio_port_write_bytes', MIB),
+    ('hs_in_cmds', 'lio_port_high_speed_commands', 1),
+]
+
+#: Counters in each fabric LUN's statistics/scsi_port directory.
+PORT_COUNTERS = [
+    ('busy_count', 'lio_port_busy', 1),
+]
+
+#: Counters in each iSCSI node ACL's fabric_statistics/iscsi_sess_stats.
+SESSION_COUNTERS = [
+    ('cmd_pdus', 'lio_iscsi_session_command_pdus', 1),
+    ('rsp_pdus', 'lio_iscsi_session_response_pdus', 1),
+    ('txdata_octs', 'lio_iscsi_session_tx_bytes', 1),
+    ('rxdata_octs', 'lio_iscsi_session_rx_bytes', 1),
+    ('conn_digest_errors', 'lio_iscsi_session_digest_errors', 1),
+    ('conn_timeout_errors', 'lio_iscsi_session_timeout_errors', 1),
+]
+
+
+def read_counters(path, counters, labels):
+    """
+    Read the given counters from the statistics directory `path`, returning
+    a list of (metric, labels, value) samples. Missing or unreadable
+    counters are skipped.
+    """
+    samples = []
+
+    for filename, metric, multiplier in counters:
+        try:
+            value = int(configfs.read_file(
+                os.path.join(path, filename)).strip())
+        except (IOError, ValueError):
+            continue
+
+        samples.append((metric, labels, value * multiplier))
+
+    return samples
+
+
+def storage_object_samples(so_path, **labels):
+    """
+    Collect the statistics of the storage object at `so_path`.
+    """
+    (hba_path, name) = os.path.split(os.path.normpath(so_path))
+    labels.setdefault('hba', os.path.basename(hba_path))
+    labels.setdefault('storage_object', name)
+
+    labels = tuple(sorted(labels.items()))
+    return read_counters(os.path.join(so_path, 'statistics', 'scsi_lu'),
+                         LU_COUNTERS, labels)
+
+
+def tpg_samples(tpg_path, **labels):
+    """
+    Collect the per-LUN port statistics and per-initiator session statistics
+    of the fabric TPG at `tpg_path`.
+    """
+    samples = []
+
+    for entry in sorted(configfs.listdir(os.path.join(tpg_path, 'lun'))):
+        if not configfs.LUN_DIR_RE.match(entry):
+            continue
+
+        stats = os.path.join(tpg_path, 'lun', entry, 'statistics')
+        lun_labels = dict(labels, lun=entry[len('lun_'):])
+        lun_labels = tuple(sorted(lun_labels.items()))
+
+        samples.extend(read_counters(os.path.join(stats, 'scsi_tgt_port'),
+                                     TGT_PORT_COUNTERS, lun_labels))
+        samples.extend(read_counters(os.path.join(stats, 'scsi_port'),
+                                     PORT_COUNTERS, lun_labels))
+
+    for wwn in sorted(configfs.listdir(os.path.join(tpg_path, 'acls'))):
+        stats = os.path.join(tpg_path, 'acls', wwn, 'fabric_statistics',
+                             'iscsi_sess_stats')
+        acl_labels = tuple(sorted(dict(labels, initiator=wwn).items()))
+        samples.extend(read_counters(stats, SESSION_COUNTERS, acl_labels))
+
+    return samples
+
+
+def _key(metric, labels):
+    return metric + ''.join(",{0}={1}".format(k, v) for k, v in labels)
+
+
+def rates(samples, previous, now):
+    """
+    Work out the per-second rate of each sample since the `previous` sample
+    state (as returned by state()), returning rate samples named
+    <metric>_per_second. Counters that went backwards are skipped, as the
+    object was probably recreated.
+    """
+    if not previous:
+        return []
+
+    elapsed = now - previous.get('time', now)
+    values = previous.get('values', {})
+    if elapsed <= 0:
+        return []
+
+    result = []
+    for metric, labels, value in samples:
+        last = values.get(_key(metric, labels))
+        if last is None or value < last:
+            continue
+
+        result.append(("{0}_per_second".format(metric), labels,
+                       (value - last) / float(elapsed)))
+
+    return result
+
+
+def state(samples, now):
+    """
+    Return the state to keep for working out rates next time.
+    """
+    return {
+        'time': now,
+        'values': dict((_key(metric, labels), value)
+                       for metric, labels, value in samples),
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_samples(counters, gauges=()):
+    """
+    Format counter and gauge samples in the Prometheus text format.
+    """
+    lines = []
+    seen = set()
+
+    for kind, samples, suffix in [('counter', counters, '_total'),
+                                  ('gauge', gauges, '')]:
+        for metric, labels, value in samples:
+            name = metric + suffix
+            if name not in seen:
+                lines.append("# TYPE {0} {1}".format(name, kind))
+                seen.add(name)
+
+            label_text = ','.join('{0}="{1}"'.format(k, _escape(v))
+                                  for k, v in labels)
+            lines.append("{0}{{{1}}} {2}".format(name, label_text, value))
+
+    return ''.join(line + "\n" for line in lines)
+
+
+class Exporter(object):
+    """
+    Writes samples to a Prometheus textfile, along with their rates since
+    the last time, kept in `state_path`.
+    """
+
+    def __init__(self, path, state_path):
+        self.path = path
+        self.state = StateFile(state_path)
+
+    def export(self, samples, now=None):
+        if now is None:
+            now = time.time()
+
+        # Sort so that each metric's samples are grouped together
+        samples = sorted(samples)
+        gauges = sorted(rates(samples, self.state.load(), now))
+
+        # Write the file atomically, so the collector never sees half of it
+        tmp_path = "{path}.{pid}".format(path=self.path, pid=os.getpid())
+        try:
+            with open(tmp_path, 'w') as fp:
+                fp.write(format_samples(samples, gauges))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self.state.save(state(samples, now))
+
+
+def export(path, state_path, samples, log=None):
+    """
+    Export `samples` to the textfile `path`, reporting any failure through
+    `log` rather than raising; statistics must never fail an action.
+    """
+    try:
+        Exporter(path, state_path).export(samples)
+    except (IOError, OSError) as e:
+        if log is not None:
+            log("Could not export statistics to {path}: {err}".format(
+                path=path, err=e))
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
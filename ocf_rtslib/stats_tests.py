@@ -0,0 +1,97 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ocf_rtslib import stats
+from ocf_rtslib.fakeconfigfs import FakeConfigFS
+
+
+def write_stats(path, values):
+    os.makedirs(path)
+    for name, value in values.items():
+        with open(os.path.join(path, name), 'w') as fp:
+            fp.write("{0}\n".format(value))
+
+
+class StatsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fake = FakeConfigFS(os.path.join(self.tmpdir, 'target'))
+        self.info = self.fake.populate(1, initiators=1)
+        self.tpg = os.path.join(self.fake.root, 'iscsi', self.info['wwn'],
+                                'tpgt_1')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_storage_object_samples(self):
+        so_path = self.info['so_paths'][0]
+        write_stats(os.path.join(so_path, 'statistics', 'scsi_lu'),
+                    {'num_cmds': 10, 'read_mbytes': 2, 'write_mbytes': 'x'})
+
+        samples = stats.storage_object_samples(so_path, resource='r')
+        labels = (('hba', 'iblock_0'), ('resource', 'r'),
+                  ('storage_object', 'lun0'))
+        self.assertEqual(sorted(samples), [
+            ('lio_lu_commands', labels, 10),
+            ('lio_lu_read_bytes', labels, 2 * stats.MIB),
+        ])
+
+    def test_tpg_samples(self):
+        write_stats(os.path.join(self.tpg, 'lun', 'lun_0', 'statistics',
+                                 'scsi_tgt_port'), {'in_cmds': 5})
+        initiator = self.info['initiators']
+        write_stats(os.path.join(self.tpg, 'acls', initiator,
+                                 'fabric_statistics', 'iscsi_sess_stats'),
+                    {'rxdata_octs': 4096})
+
+        samples = stats.tpg_samples(self.tpg, target='t')
+        self.assertEqual(sorted(samples), [
+            ('lio_iscsi_session_rx_bytes',
+             (('initiator', initiator), ('target', 't')), 4096),
+            ('lio_port_commands', (('lun', '0'), ('target', 't')), 5),
+        ])
+
+    def test_export_rates(self):
+        path = os.path.join(self.tmpdir, 'lio.prom')
+        exporter = stats.Exporter(path, os.path.join(self.tmpdir, 'state'))
+        labels = (('lun', '0'),)
+
+        exporter.export([('lio_port_commands', labels, 100)], now=1000)
+        with open(path) as fp:
+            self.assertEqual(fp.read(),
+                             '# TYPE lio_port_commands_total counter\n'
+                             'lio_port_commands_total{lun="0"} 100\n')
+
+        exporter.export([('lio_port_commands', labels, 300)], now=1010)
+        with open(path) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(lines[-2:], [
+            '# TYPE lio_port_commands_per_second gauge',
+            'lio_port_commands_per_second{lun="0"} 20.0',
+        ])
+
+        # A counter going backwards means the object was recreated
+        self.assertEqual(stats.rates([('m', labels, 1)],
+                                     stats.state([('m', labels, 5)], 0), 10),
+                         [])
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
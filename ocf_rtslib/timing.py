@@ -0,0 +1,157 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Records where the time goes in an agent action.
+
+The agents mark out the phases of their actions (setup, lookups, lock waits,
+configfs writes, crm_master calls and so on) and count the configfs reads and
+writes and the processes they spawn. Recording is always on, as it costs
+next to nothing; the agents only write the results out, as a single JSON
+line per action, if asked to with their timing_log parameter.
+"""
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+
+
+class Recorder(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.phases = {}
+        self.counts = {}
+
+    def add(self, name, duration):
+        """
+        Add `duration` seconds to the phase `name`.
+        """
+        (total, calls) = self.phases.get(name, (0, 0))
+        self.phases[name] = (total + duration, calls + 1)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def record(self, **extra):
+        """
+        Return everything recorded so far as a dictionary, including any
+        `extra` items.
+        """
+        result = {
+            'time': self.start,
+            'total': time.time() - self.start,
+            'phases': dict((name, {'seconds': total, 'calls': calls})
+                           for name, (total, calls) in self.phases.items()),
+            'counts': dict(self.counts),
+        }
+        result.update(extra)
+        return result
+
+
+#: The recorder for this process.
+recorder = Recorder()
+
+phase = recorder.phase
+count = recorder.count
+
+
+def timed(name):
+    """
+    Decorate a function so that every call to it is recorded as phase `name`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with recorder.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_record(record, destination, log=None):
+    """
+    Write a record to `destination`: a file to append to, or 'ocf-log' to
+    send it to `log` (a logging function) instead.
+    """
+    line = json.dumps(record, sort_keys=True)
+
+    if destination == 'ocf-log':
+        if log is not None:
+            log("timing: {0}".format(line))
+        return
+
+    try:
+        with open(destination, 'a') as fp:
+            fp.write(line + "\n")
+    except (IOError, OSError):
+        # Instrumentation must never break the agent
+        pass
+
+
+_reports = []
+
+
+def install(destination, threshold=0, log=None, **extra):
+    """
+    Arrange for the action's record to be written to `destination` when the
+    process exits, provided the action took at least `threshold` seconds
+    (which may be given as a string). Does nothing if `destination` is empty,
+    or if already installed.
+    """
+    if not destination or _reports:
+        return
+
+    try:
+        threshold = float(threshold)
+    except (TypeError, ValueError):
+        threshold = 0
+
+    def report():
+        record = recorder.record(
+            action=(sys.argv[1] if len(sys.argv) > 1 else None),
+            pid=os.getpid(), **extra)
+        if record['total'] >= threshold:
+            write_record(record, destination, log)
+
+    _reports.append(report)
+
+
+@atexit.register
+def flush():
+    """
+    Write out the action's record now, if one is due. Processes that leave
+    with os._exit() must call this themselves.
+    """
+    while _reports:
+        _reports.pop()()
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
@@ -0,0 +1,66 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ocf_rtslib import timing
+
+
+class TimingTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'timing.log')
+        timing.recorder.reset()
+
+    def tearDown(self):
+        del timing._reports[:]
+        shutil.rmtree(self.tmpdir)
+
+    def test_record(self):
+        @timing.timed('work')
+        def work():
+            timing.count('configfs_read', 2)
+
+        work()
+        work()
+
+        record = timing.recorder.record(action='monitor')
+        self.assertEqual(record['phases']['work']['calls'], 2)
+        self.assertEqual(record['counts'], {'configfs_read': 4})
+        self.assertEqual(record['action'], 'monitor')
+
+    def test_flush_writes_one_line(self):
+        timing.install(self.log, '0', agent='backstore')
+        timing.install(os.path.join(self.tmpdir, 'other.log'))
+        timing.flush()
+        timing.flush()
+
+        with open(self.log) as fp:
+            lines = fp.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['agent'], 'backstore')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'other.log')))
+
+    def test_threshold(self):
+        timing.install(self.log, '3600')
+        timing.flush()
+        self.assertFalse(os.path.exists(self.log))
@@ -0,0 +1,233 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import importlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+#: Delays (in seconds) between successive checks in wait_for(). The final
+#: delay is repeated until the deadline passes.
+BACKOFF_SCHEDULE = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+#: Sizes as accepted by parse_size().
+SIZE_RE = re.compile(r'^(?P<value>[0-9]+)(?P<unit>[kmgt]?)b?$', re.I)
+
+
+class LazyModule(object):
+    """
+    A stand-in for a module that is only imported when it is first used.
+
+    Pacemaker runs the agents afresh for every operation, including trivial
+    ones such as meta-data, so we avoid paying for heavy imports until an
+    action actually needs them. Attribute access on this object imports the
+    real module and forwards to it.
+
+    If a required module is missing, the agent exits with OCF_ERR_INSTALLED,
+    just as it would have done had the import failed at start-up.
+    """
+
+    def __init__(self, name, required=True):
+        self.__name = name
+        self.__required = required
+        self.__module = None
+
+    def _load(self):
+        if self.__module is None:
+            try:
+                self.__module = importlib.import_module(self.__name)
+            except ImportError:
+                if not self.__required:
+                    raise
+
+                sys.stderr.write(
+                    "Failed to import {0}\n".format(self.__name))
+                sys.exit(5)  # OCF_ERR_INSTALLED
+
+        return self.__module
+
+    @property
+    def available(self):
+        """
+        Whether the module can be imported. This imports it if necessary.
+        """
+        try:
+            self._load()
+        except ImportError:
+            return False
+        else:
+            return True
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<LazyModule {0!r}>".format(self.__name)
+
+
+def is_true(value):
+    """
+    Interpret a boolean resource parameter the way ocf_is_true does.
+    """
+    return str(value).lower() in ('yes', 'true', '1', 'on')
+
+
+def parse_size(size):
+    """
+    Convert a size, in bytes or with a K, M, G or T suffix (powers of 1024),
+    to a number of bytes. Raises ValueError if it is not a valid size.
+    """
+    match = SIZE_RE.match(size.strip())
+    if not match:
+        raise ValueError("Invalid size: {0}".format(size))
+
+    exponent = ' kmgt'.index(match.group('unit').lower() or ' ')
+    return int(match.group('value')) * 1024 ** exponent
+
+
+def check_level():
+    """
+    The monitor depth Pacemaker asked for, from OCF_CHECK_LEVEL.
+    """
+    try:
+        return int(os.environ.get('OCF_CHECK_LEVEL', 0))
+    except ValueError:
+        return 0
+
+
+def action_deadline(timeout_ms, default, reserve=0.1):
+    """
+    Work out when an action has to give up, as a time.time() value.
+
+    `timeout_ms` is the action timeout in milliseconds as Pacemaker passes it
+    in OCF_RESKEY_CRM_meta_timeout, or None to use `default` (seconds). A
+    fraction `reserve` of the timeout is held back, so that the action can
+    still report its failure before Pacemaker kills it.
+    """
+    try:
+        timeout = int(timeout_ms) / 1000.0
+    except (TypeError, ValueError):
+        timeout = default
+
+    return time.time() + timeout * (1 - reserve)
+
+
+def wait_for(check, deadline, schedule=BACKOFF_SCHEDULE):
+    """
+    Call `check` until it returns a true value or `deadline` passes.
+
+    The first check happens immediately; after that we back off following
+    `schedule`. Returns the final result of `check`.
+    """
+    delays = iter(schedule)
+    delay = 0
+
+    while True:
+        result = check()
+        if result:
+            return result
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return result
+
+        delay = next(delays, delay)
+        time.sleep(min(delay, remaining))
+
+
+def run_parallel(func, items, workers):
+    """
+    Call `func` on each of `items`, on up to `workers` threads at once.
+
+    Every item is tried, whatever happens to the others. Returns a list of
+    (item, exception) pairs, in the order of `items`, for each call that
+    raised an exception.
+    """
+    items = list(items)
+    failures = {}
+    lock = threading.Lock()
+    pending = iter(enumerate(items))
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    (i, item) = next(pending)
+                except StopIteration:
+                    return
+
+            try:
+                func(item)
+            except Exception as e:
+                failures[i] = e
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max(workers, 1), len(items)))]
+    if len(threads) == 1:
+        # Not worth a thread
+        worker()
+    else:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return [(items[i], failures[i]) for i in sorted(failures)]
+
+
+class StateFile(object):
+    """
+    A small JSON document persisted between agent invocations.
+
+    These normally live in the resource agent temporary directory (rsctmp),
+    which is cleared on boot. State is only ever an optimisation, so a
+    missing, unreadable or unwritable file is never an error.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, default=None):
+        try:
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return default
+
+    def save(self, data):
+        tmp_path = "{path}.{pid}".format(path=self.path, pid=os.getpid())
+
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump(data, fp)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+# vi:tw=0:wm=0:nowrap:ai:et:ts=8:softtabstop=4:shiftwidth=4
@@ -0,0 +1,165 @@
+# This file is part of ocf-rtslib.
+# Copyright (C) 2015  Tiger Computing Ltd. <info@tiger-computing.co.uk>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from ocf_rtslib import util
+from ocf_rtslib.util import LazyModule, StateFile
+
+
+class LazyModuleTests(unittest.TestCase):
+    def test_import_on_first_use(self):
+        sys.modules.pop('colorsys', None)
+        colorsys = LazyModule('colorsys')
+        self.assertNotIn('colorsys', sys.modules)
+
+        self.assertEqual(colorsys.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertIn('colorsys', sys.modules)
+
+    def test_optional_module_missing(self):
+        module = LazyModule('ocf_rtslib_no_such_module', required=False)
+        self.assertFalse(module.available)
+        self.assertRaises(ImportError, getattr, module, 'anything')
+
+    def test_required_module_missing(self):
+        module = LazyModule('ocf_rtslib_no_such_module')
+        with self.assertRaises(SystemExit) as cm:
+            module.anything
+        self.assertEqual(cm.exception.code, 5)
+
+
+class ImportTimeTests(unittest.TestCase):
+    #: Maximum time (seconds) allowed to import both agent modules
+    BUDGET = 0.5
+
+    #: Modules that must not be imported just by loading the agents
+    HEAVY_MODULES = ['rtslib', 'netaddr']
+
+    SCRIPT = """
+import json, sys, time
+start = time.time()
+import ocf_rtslib.backstore, ocf_rtslib.bulk, ocf_rtslib.iscsi
+elapsed = time.time() - start
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
+    def setUp(self):
+        try:
+            import ocf  # noqa
+        except ImportError:
+            raise unittest.SkipTest('python-ocf is not installed')
+
+    def test_agent_import_budget(self):
+        output = subprocess.check_output([sys.executable, '-c', self.SCRIPT])
+        result = json.loads(output.decode('utf-8'))
+
+        for module in self.HEAVY_MODULES:
+            self.assertNotIn(module, result['modules'])
+
+        self.assertLess(result['elapsed'], self.BUDGET)
+
+
+class StateFileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state = StateFile(os.path.join(self.tmpdir, 'state'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        self.assertIsNone(self.state.load())
+        self.state.save({'score': 1000, 'skipped': 2})
+        self.assertEqual(self.state.load(), {'score': 1000, 'skipped': 2})
+
+        self.state.remove()
+        self.assertEqual(self.state.load(default={}), {})
+
+    def test_unwritable_is_ignored(self):
+        state = StateFile(os.path.join(self.tmpdir, 'missing', 'state'))
+        state.save({})
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class ParseSizeTests(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(util.parse_size('4096'), 4096)
+        self.assertEqual(util.parse_size('10M'), 10 * 1024 ** 2)
+        self.assertEqual(util.parse_size('2gb'), 2 * 1024 ** 3)
+        self.assertRaises(ValueError, util.parse_size, '1.5G')
+
+
+class WaitTests(unittest.TestCase):
+    def test_action_deadline(self):
+        now = time.time()
+        self.assertAlmostEqual(util.action_deadline('20000', 90, reserve=0),
+                               now + 20, delta=1)
+        self.assertAlmostEqual(util.action_deadline(None, 90),
+                               now + 81, delta=1)
+
+    def test_wait_for_success(self):
+        results = iter([False, False, True])
+        self.assertTrue(util.wait_for(lambda: next(results),
+                                      time.time() + 5, (0, 0)))
+
+    def test_wait_for_deadline(self):
+        calls = []
+
+        def check():
+            calls.append(None)
+            return False
+
+        self.assertFalse(util.wait_for(check, time.time() + 0.05, (0.01,)))
+        self.assertTrue(len(calls) > 1)
+
+
+class RunParallelTests(unittest.TestCase):
+    def test_failures_are_reported_per_item(self):
+        done = []
+
+        def func(item):
+            if item % 3 == 0:
+                raise ValueError(item)
+            done.append(item)
+
+        failures = util.run_parallel(func, range(10), 4)
+        self.assertEqual([item for item, _ in failures], [0, 3, 6, 9])
+        self.assertTrue(all(isinstance(e, ValueError) for _, e in failures))
+        self.assertEqual(sorted(done), [1, 2, 4, 5, 7, 8])
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def func(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        self.assertEqual(util.run_parallel(func, range(20), 3), [])
+        self.assertLessEqual(running[1], 3)
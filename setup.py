@@ -17,8 +17,12 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import os
+
+from distutils import log
 from distutils.util import convert_path
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 
 # Read the version number from nrpe_ng/version.py. This avoids needing to
 # query setuptools for the version at run-time.
@@ -27,6 +31,27 @@ ver_path = convert_path('ocf_rtslib/version.py')
 with open(ver_path) as ver_file:
     exec(ver_file.read(), main_ns)
 
+
+class build_py_metadata(build_py):
+    """
+    Generate the agents' OCF meta-data XML alongside the built package, so
+    that the agents can serve it without importing the agent classes.
+    """
+
+    def run(self):
+        build_py.run(self)
+
+        from ocf_rtslib.metadata import write_all
+        directory = os.path.join(self.build_lib, 'ocf_rtslib', 'metadata')
+
+        try:
+            write_all(directory, cwd=os.path.dirname(os.path.abspath(
+                __file__)))
+        except Exception as e:
+            # The agents work without it; they just generate it every time
+            log.warn("not generating agent meta-data: {0}".format(e))
+
+
 setup(
     name='ocf-rtslib',
     version=main_ns['__version__'],
@@ -51,4 +76,7 @@ setup(
         'Topic :: System :: Systems Administration',
     ],
     packages=find_packages(),
+    cmdclass={
+        'build_py': build_py_metadata,
+    },
 )